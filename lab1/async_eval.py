@@ -0,0 +1,366 @@
+"""
+This module implements asynchronous evaluation. The trainer publishes snapshots of its weights
+to shared memory and continues training, while an evaluator process computes the test loss,
+accuracy and confusion matrix of every snapshot and sends the results back.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from data_parallel_numpy import single_blas_thread
+
+# Default constants
+EVAL_BATCH_SIZE_DEFAULT = 1000
+SNAPSHOT_SLOTS_DEFAULT = 2
+
+
+def cifar10_test_set(data_dir, normalization='mean'):
+    """
+    Normalized CIFAR10 test images and class labels, see AsyncEvaluator's data_fn. Use with
+    functools.partial, the arguments are sent to the evaluator instead of the images.
+    """
+    import cifar10_utils
+    cifar10 = cifar10_utils.get_cifar10(data_dir=data_dir, one_hot=False, normalization=normalization)
+    return cifar10.test.images, cifar10.test.labels
+
+
+def evaluate_logits(logits_fn, images, labels, n_classes, batch_size=EVAL_BATCH_SIZE_DEFAULT):
+    """
+    Computes the mean cross-entropy, accuracy and confusion matrix of a model on a dataset,
+    batch_size datapoints at a time.
+
+    :param logits_fn: callable mapping a batch of images to logits [batch_size, n_classes]
+    :param images: array-like of images, indexed by slices
+    :param labels: class indices [n_datapoints]
+    :return: dict with 'loss', 'accuracy' and 'confusion_matrix' [n_classes, n_classes], rows
+             are true classes and columns predicted classes, as tf.confusion_matrix
+    """
+    n_datapoints = len(labels)
+    nll = 0.
+    confusion_matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+    for start in range(0, n_datapoints, batch_size):
+        logits = np.asarray(logits_fn(images[start:start + batch_size]), dtype=np.float64)
+        y = np.asarray(labels[start:start + logits.shape[0]])
+
+        # log-softmax of the true class
+        shifted = logits - np.max(logits, axis=1, keepdims=True)
+        log_norm = np.log(np.sum(np.exp(shifted), axis=1))
+        nll -= np.sum(shifted[np.arange(len(y)), y] - log_norm)
+
+        predictions = np.argmax(logits, axis=1)
+        confusion_matrix += np.bincount(y * n_classes + predictions, minlength=n_classes ** 2).reshape(
+            n_classes, n_classes)
+
+    return {'loss': nll / n_datapoints,
+            'accuracy': np.trace(confusion_matrix) / n_datapoints,
+            'confusion_matrix': confusion_matrix}
+
+
+class MLPSnapshotModel(object):
+    """
+    Evaluation copy of a NumPy MLP: a snapshot is its flat parameter vector, which the
+    evaluator wraps in an MLP of the same architecture without copying.
+    """
+
+    def __init__(self, net, batch_size=EVAL_BATCH_SIZE_DEFAULT):
+        """
+        Args:
+          net: mlp_numpy.MLP being trained.
+          batch_size: number of datapoints per forward pass of the evaluator.
+        """
+        self.config = net.get_config()
+        self.batch_size = batch_size
+        self.snapshot_shapes = [(net.parameters.params.shape, net.parameters.params.dtype.str)]
+        self._nets = {}
+
+    def snapshot(self, net):
+        """
+        Arrays published for the current weights of net, in the trainer.
+        """
+        return [net.parameters.params]
+
+    def setup(self):
+        """
+        Called once in the evaluator.
+        """
+        pass
+
+    def logits_fn(self, arrays):
+        """
+        Returns the logits function of a snapshot, in the evaluator.
+        """
+        from mlp_numpy import MLP
+        from training_stats import StatsCollector
+
+        params = arrays[0]
+        key = params.__array_interface__['data'][0]
+        if key not in self._nets:
+            # one network per snapshot slot, built on the slot's memory
+            self._nets[key] = MLP(params=params, stats=StatsCollector(enabled=False), **self.config)
+        net = self._nets[key]
+        return lambda x: net.predict(x, batch_size=self.batch_size)
+
+
+def tf_snapshot_variables():
+    """
+    Variables of the default graph that inference needs: the trainable ones and the moving
+    averages, e.g. of batch normalization, without optimizer slots or the global step.
+    """
+    import tensorflow as tf
+
+    variables = {}
+    for variable in tf.trainable_variables() + tf.model_variables() + tf.moving_average_variables():
+        variables.setdefault(variable.name, variable)
+    return list(variables.values())
+
+
+def tf_summary(result, prefix='test_'):
+    """
+    tf.Summary of the loss and accuracy of an evaluation result, for a tf.summary.FileWriter.
+    """
+    import tensorflow as tf
+
+    return tf.Summary(value=[tf.Summary.Value(tag=prefix + 'nl_likelihood', simple_value=result['loss']),
+                             tf.Summary.Value(tag=prefix + 'accuracy', simple_value=result['accuracy'])])
+
+
+class TFSnapshotModel(object):
+    """
+    Evaluation copy of a TensorFlow model: a snapshot holds the values of its variables, which
+    the evaluator loads into its own copy of the graph, built by build_fn on the CPU.
+    """
+
+    def __init__(self, variables, build_fn, build_args=()):
+        """
+        Args:
+          variables: tf.Variables of the trained graph that make up a snapshot, see
+                     tf_snapshot_variables. The graph built by build_fn must have variables
+                     of the same names.
+          build_fn: picklable function, e.g. defined at module level in the trainer, that builds
+                    the inference graph and returns (input placeholder, logits tensor, feed dict
+                    of further placeholders such as the training mode).
+          build_args: arguments of build_fn, e.g. the FLAGS namespace.
+        """
+        self.variables = variables
+        self.names = [variable.name for variable in variables]
+        self.snapshot_shapes = [(tuple(variable.get_shape().as_list()), variable.dtype.base_dtype.as_numpy_dtype)
+                                for variable in variables]
+        self.build_fn = build_fn
+        self.build_args = build_args
+
+    def __getstate__(self):
+        # tf.Variables stay in the trainer
+        state = dict(self.__dict__)
+        state['variables'] = None
+        return state
+
+    def snapshot(self, session):
+        """
+        Arrays published for the current values of the variables, in the trainer.
+        """
+        return session.run(self.variables)
+
+    def setup(self):
+        """
+        Builds the graph in the evaluator.
+        """
+        import tensorflow as tf
+
+        self._inputs, self._logits, self._feed = self.build_fn(*self.build_args)
+        graph_variables = {variable.name: variable for variable in tf.global_variables()}
+        self._variables = [graph_variables[name] for name in self.names]
+
+        # the evaluator stays off the GPU of the trainer
+        self._session = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+        self._session.run(tf.global_variables_initializer())
+
+    def logits_fn(self, arrays):
+        """
+        Loads a snapshot into the graph and returns its logits function, in the evaluator.
+        """
+        for variable, value in zip(self._variables, arrays):
+            variable.load(value, self._session)
+
+        def logits(x):
+            x = np.reshape(x, [len(x)] + self._inputs.get_shape().as_list()[1:])
+            feed_dict = dict(self._feed)
+            feed_dict[self._inputs] = x
+            return self._session.run(self._logits, feed_dict=feed_dict)
+
+        return logits
+
+
+def _evaluator(model, data_fn, n_classes, batch_size, slot_buffers, conn):
+    """
+    Evaluator loop: evaluates the snapshot slot named by every ('eval', step, slot) request
+    and sends back (step, slot, results), or (step, slot, exception) if it failed.
+    """
+    handles, slots = [], []
+    for buffers in slot_buffers:
+        arrays = []
+        for name, shape, dtype in buffers:
+            shm = shared_memory.SharedMemory(name=name)
+            handles.append(shm)
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        slots.append(arrays)
+
+    try:
+        # a failed setup is reported as the result of every request
+        try:
+            model.setup()
+            images, labels = data_fn()
+            setup_error = None
+        except Exception as e:
+            setup_error = e
+
+        while True:
+            command = conn.recv()
+            if command[0] != 'eval':
+                break
+            _, step, slot = command
+            try:
+                if setup_error is not None:
+                    raise setup_error
+                start = time.perf_counter()
+                results = evaluate_logits(model.logits_fn(slots[slot]), images, labels, n_classes, batch_size)
+                results['eval_time'] = time.perf_counter() - start
+            except Exception as e:
+                results = e
+            conn.send((step, slot, results))
+    finally:
+        del slots
+        model = None
+        for shm in handles:
+            shm.close()
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates weight snapshots in a separate process while training continues.
+
+    publish copies the weights into a free slot of shared memory and returns immediately;
+    the evaluator picks up the slots in order. If every slot still waits for evaluation, the
+    snapshot is skipped (and counted in n_skipped), so training never waits for evaluation.
+    poll returns the results that arrived since the last call, and records them in the stats
+    at the step of their snapshot.
+    """
+
+    def __init__(self, model, data_fn, n_classes, batch_size=EVAL_BATCH_SIZE_DEFAULT,
+                 n_slots=SNAPSHOT_SLOTS_DEFAULT, stats=None, stats_prefix='test_'):
+        """
+        Starts the evaluator process.
+
+        Args:
+          model: MLPSnapshotModel or TFSnapshotModel.
+          data_fn: picklable function returning the evaluation (images, class labels), called
+                   once in the evaluator, e.g. functools.partial(cifar10_test_set, data_dir).
+          n_classes: number of classes.
+          batch_size: number of datapoints per forward pass.
+          n_slots: number of snapshots in shared memory, one is evaluated while the others wait.
+          stats: optional StatsCollector, receives stats_prefix + 'nl_likelihood' and 'accuracy'.
+          stats_prefix: prefix of the recorded stats.
+        """
+        self.model = model
+        self.stats = stats
+        self.stats_prefix = stats_prefix
+        self.n_published = 0
+        self.n_skipped = 0
+
+        self._shm = []
+        self._slots = []
+        slot_buffers = []
+        for _ in range(n_slots):
+            arrays, buffers = [], []
+            for shape, dtype in model.snapshot_shapes:
+                nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                shm = shared_memory.SharedMemory(create=True, size=nbytes)
+                self._shm.append(shm)
+                arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+                buffers.append((shm.name, shape, np.dtype(dtype).str))
+            self._slots.append(arrays)
+            slot_buffers.append(buffers)
+        self._free = list(range(n_slots))
+
+        ctx = mp.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        with single_blas_thread():
+            self._process = ctx.Process(target=_evaluator,
+                                        args=(model, data_fn, n_classes, batch_size, slot_buffers, child_conn))
+            self._process.daemon = True
+            self._process.start()
+
+    def publish(self, step, source):
+        """
+        Publishes a snapshot of the weights for evaluation.
+
+        Args:
+          step: training step, reported with the results.
+          source: passed to model.snapshot, the MLP or the tf.Session.
+        Returns:
+          True if the snapshot was queued, False if it was skipped.
+        """
+        if not self._free:
+            self.n_skipped += 1
+            return False
+        slot = self._free.pop(0)
+        for array, value in zip(self._slots[slot], self.model.snapshot(source)):
+            np.copyto(array, value)
+        self._conn.send(('eval', step, slot))
+        self.n_published += 1
+        return True
+
+    def poll(self, wait=False):
+        """
+        Returns the results that have arrived, oldest first, as dicts with 'step', 'loss',
+        'accuracy', 'confusion_matrix' and 'eval_time'. Raises the evaluator's exception if an
+        evaluation failed.
+
+        Args:
+          wait: Flag for waiting until every published snapshot is evaluated.
+        """
+        results = []
+        while self.pending() and (wait or self._conn.poll()):
+            step, slot, result = self._conn.recv()
+            self._free.append(slot)
+            if isinstance(result, Exception):
+                raise result
+            result['step'] = step
+            if self.stats is not None:
+                self.stats.record(self.stats_prefix + 'nl_likelihood', result['loss'], step=step)
+                self.stats.record(self.stats_prefix + 'accuracy', result['accuracy'], step=step)
+            results.append(result)
+        return results
+
+    def pending(self):
+        """
+        Number of published snapshots without results yet.
+        """
+        return len(self._slots) - len(self._free)
+
+    def close(self):
+        """
+        Stops the evaluator and releases the shared memory. Results not polled are dropped,
+        call poll(wait=True) first to keep them.
+        """
+        if self._process is not None:
+            self._conn.send(('stop',))
+            self._process.join()
+            self._process = None
+        self._slots = []
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,155 @@
+"""
+This module implements batch-vectorized data augmentation of CIFAR10 images in NumPy.
+Every transformation handles a whole batch [batch_size, height, width, channels] with a
+few array operations, with random parameters drawn per image.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def random_crop(images, padding, rng):
+    """
+    Pads every image with `padding` zeros on each side and crops it back to its size at a
+    random offset, as a single gather for the whole batch.
+
+    :param images: float array [batch_size, height, width, channels]
+    :param padding: number of pixels added on each side
+    :param rng: np.random.RandomState
+    :return: new float array of the same shape
+    """
+    batch_size, height, width, _ = images.shape
+    padded = np.pad(images, ((0, 0), (padding, padding), (padding, padding), (0, 0)), mode='constant')
+
+    offsets = rng.randint(0, 2 * padding + 1, size=(2, batch_size))
+    rows = offsets[0][:, np.newaxis] + np.arange(height)
+    cols = offsets[1][:, np.newaxis] + np.arange(width)
+    return padded[np.arange(batch_size)[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+
+
+def random_flip(images, rng):
+    """
+    Mirrors a random half of the images horizontally, in place.
+
+    :param images: float array [batch_size, height, width, channels]
+    :param rng: np.random.RandomState
+    :return: images
+    """
+    flip = rng.rand(images.shape[0]) < 0.5
+    images[flip] = images[flip, :, ::-1]
+    return images
+
+
+def affine_transform(images, matrices, offsets):
+    """
+    Resamples every image with its own affine coordinate map: output pixel p = (row, col)
+    takes the value at matrices[b] . p + offsets[b] of input image b, bilinearly interpolated.
+    Coordinates outside the image are clipped to the border (fill_mode='nearest').
+
+    :param images: float array [batch_size, height, width, channels]
+    :param matrices: float array [batch_size, 2, 2]
+    :param offsets: float array [batch_size, 2]
+    :return: new float32 array of the same shape
+    """
+    batch_size, height, width, channels = images.shape
+
+    rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    grid = np.stack([rows.ravel(), cols.ravel()]).astype(np.float32)
+
+    # source coordinates of every output pixel [batch_size, 2, height * width]
+    source = np.matmul(matrices.astype(np.float32), grid) + offsets.astype(np.float32)[:, :, np.newaxis]
+    y = np.clip(source[:, 0], 0, height - 1)
+    x = np.clip(source[:, 1], 0, width - 1)
+
+    y0 = np.floor(y).astype(np.int64)
+    x0 = np.floor(x).astype(np.int64)
+    y1 = np.minimum(y0 + 1, height - 1)
+    x1 = np.minimum(x0 + 1, width - 1)
+    wy = (y - y0).astype(np.float32)[:, :, np.newaxis]
+    wx = (x - x0).astype(np.float32)[:, :, np.newaxis]
+
+    # gather the 4 neighbours of every output pixel from the flattened batch
+    flat = np.asarray(images, dtype=np.float32).reshape(-1, channels)
+    base = (np.arange(batch_size) * height * width)[:, np.newaxis]
+
+    def gather(yi, xi):
+        return flat[base + yi * width + xi]
+
+    top = gather(y0, x0) * (1 - wx) + gather(y0, x1) * wx
+    bottom = gather(y1, x0) * (1 - wx) + gather(y1, x1) * wx
+    return (top * (1 - wy) + bottom * wy).reshape(images.shape)
+
+
+def random_affine_maps(batch_size, height, width, rng, rotation_range=0., shift_range=0., shear_range=0.,
+                       zoom_range=0.):
+    """
+    Draws an affine coordinate map per image for affine_transform, composed of a rotation,
+    a shear and a zoom around the image center and a shift. The ranges follow the
+    ImageDataGenerator arguments of the same names.
+
+    :param rotation_range: maximum rotation in degrees
+    :param shift_range: maximum shift as a fraction of the height and width
+    :param shear_range: maximum shear angle in radians, unlike rotation_range
+    :param zoom_range: zoom factors are drawn from [1 - zoom_range, 1 + zoom_range] per axis
+    :return: matrices [batch_size, 2, 2], offsets [batch_size, 2]
+    """
+    theta = np.deg2rad(rng.uniform(-rotation_range, rotation_range, batch_size))
+    shear = rng.uniform(-shear_range, shear_range, batch_size)
+    zoom = rng.uniform(1 - zoom_range, 1 + zoom_range, size=(batch_size, 2))
+    shift = rng.uniform(-shift_range, shift_range, size=(batch_size, 2)) * [height, width]
+
+    rotation = np.empty((batch_size, 2, 2))
+    rotation[:, 0, 0], rotation[:, 0, 1] = np.cos(theta), -np.sin(theta)
+    rotation[:, 1, 0], rotation[:, 1, 1] = np.sin(theta), np.cos(theta)
+
+    shearing = np.zeros((batch_size, 2, 2))
+    shearing[:, 0, 0], shearing[:, 0, 1], shearing[:, 1, 1] = 1., -np.sin(shear), np.cos(shear)
+
+    matrices = np.matmul(rotation, shearing) * zoom[:, np.newaxis, :]
+
+    # transform around the center: source = M (p - c) + c + shift
+    center = np.array([(height - 1) / 2., (width - 1) / 2.])
+    offsets = center - np.matmul(matrices, center) + shift
+    return matrices, offsets
+
+
+class Augmenter(object):
+    """
+    Random affine transformation, crop with padding and horizontal flip of a batch, applied
+    in that order. An Augmenter is picklable, so it can run in worker processes, see
+    input_pipeline.Prefetcher.
+    """
+
+    def __init__(self, padding=0, horizontal_flip=False, rotation_range=0., shift_range=0., shear_range=0.,
+                 zoom_range=0.):
+        """
+        Args:
+          padding: padding of random_crop, 0 for no cropping.
+          horizontal_flip: flag for random_flip.
+          rotation_range, shift_range, shear_range, zoom_range: see random_affine_maps, all 0
+                                                                for no affine transformation.
+        """
+        self.padding = padding
+        self.horizontal_flip = horizontal_flip
+        self.affine_ranges = dict(rotation_range=rotation_range, shift_range=shift_range, shear_range=shear_range,
+                                  zoom_range=zoom_range)
+
+    def __call__(self, images, rng):
+        """
+        :param images: float array [batch_size, height, width, channels]
+        :param rng: np.random.RandomState
+        :return: new float32 array of augmented images
+        """
+        images = np.array(images, dtype=np.float32)
+        batch_size, height, width, _ = images.shape
+
+        if any(self.affine_ranges.values()):
+            matrices, offsets = random_affine_maps(batch_size, height, width, rng, **self.affine_ranges)
+            images = affine_transform(images, matrices, offsets)
+        if self.padding > 0:
+            images = random_crop(images, self.padding, rng)
+        if self.horizontal_flip:
+            images = random_flip(images, rng)
+        return images
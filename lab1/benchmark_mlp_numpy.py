@@ -0,0 +1,286 @@
+"""
+This module implements benchmarks of the NumPy MLP and its input pipeline on random CIFAR10-shaped data.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from mlp_numpy import MLP
+
+# Default constants
+DNN_HIDDEN_UNITS_DEFAULT = '100'
+BATCH_SIZE_DEFAULT = 200
+STEPS_DEFAULT = 50
+INPUT_DIM = 3 * 32 * 32
+N_CLASSES = 10
+
+# Entry points of the NumPy pipeline, and modules none of them may import at startup
+STARTUP_MODULES = ['train_mlp_numpy', 'train_mlp_ensemble_numpy', 'serve_mlp_numpy', 'quantize_mlp_numpy']
+HEAVY_MODULES = ['tensorflow', 'matplotlib', 'scipy', 'keras', 'torch']
+STARTUP_RUNS = 5
+
+FLAGS = None
+
+
+def _random_batch(batch_size, dtype=np.float32):
+    X = np.random.normal(size=(batch_size, INPUT_DIM)).astype(dtype)
+    y = np.random.randint(0, N_CLASSES, size=batch_size)
+    return X, y
+
+
+def _time_steps(step_fn, steps):
+    """
+    Runs step_fn once to warm up, then returns the mean wall-clock time of `steps` calls.
+    """
+    step_fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step_fn()
+    return (time.perf_counter() - start) / steps
+
+
+def benchmark_data_parallel(dnn_hidden_units):
+    """
+    Training throughput of DataParallelTrainer with 1 to max_workers processes,
+    against the single-process MLP.train_batch.
+    """
+    from data_parallel_numpy import DataParallelTrainer
+
+    X, y = _random_batch(FLAGS.batch_size)
+    flags = {'learning_rate': 1e-3}
+    mlp_kwargs = dict(n_hidden=dnn_hidden_units, n_classes=N_CLASSES, input_dim=INPUT_DIM, dtype=np.float32)
+
+    net = MLP(workspace=True, **mlp_kwargs)
+    baseline = _time_steps(lambda: net.train_batch(X, y, flags), FLAGS.steps)
+    print('{:>10} {:>12} {:>14} {:>8}'.format('workers', 'ms/step', 'images/sec', 'speedup'))
+    print('{:>10} {:>12.2f} {:>14.0f} {:>8.2f}'.format('in-process', 1e3 * baseline,
+                                                         FLAGS.batch_size / baseline, 1.))
+
+    for n_workers in range(1, FLAGS.max_workers + 1):
+        with DataParallelTrainer(n_workers, FLAGS.batch_size, workspace=True, **mlp_kwargs) as trainer:
+            elapsed = _time_steps(lambda: trainer.train_batch(X, y, flags), FLAGS.steps)
+        print('{:>10} {:>12.2f} {:>14.0f} {:>8.2f}'.format(n_workers, 1e3 * elapsed,
+                                                             FLAGS.batch_size / elapsed, baseline / elapsed))
+
+
+def benchmark_pruning(dnn_hidden_units):
+    """
+    Forward pass time of the first layer (hidden x 3072) as a dense GEMM and as a CSR
+    product after magnitude pruning to decreasing densities, and the crossover density
+    below which the sparse product wins.
+    """
+    from pruning_numpy import magnitude_prune, update_sparse_execution
+
+    densities = [1.0, 0.5, 0.3, 0.2, 0.1, 0.05, 0.02, 0.01]
+    print('{:>8} {:>8} {:>12} {:>12} {:>8}'.format('batch', 'density', 'dense ms', 'sparse ms', 'speedup'))
+
+    for batch_size in sorted({1, 32, FLAGS.batch_size, 1000}):
+        X, _ = _random_batch(batch_size)
+        Z = X.T
+        crossover = None
+
+        for density in densities:
+            net = MLP(n_hidden=dnn_hidden_units, n_classes=N_CLASSES, input_dim=INPUT_DIM, weight_scale=1.,
+                      dtype=np.float32)
+            magnitude_prune(net, 1. - density, scope='layer', layers=[0])
+            layer = net.layers[0]
+
+            dense = _time_steps(lambda: layer.predict(Z), FLAGS.steps)
+            update_sparse_execution(net, threshold=1.1)
+            sparse = _time_steps(lambda: layer.predict(Z), FLAGS.steps)
+
+            if sparse < dense and crossover is None:
+                crossover = density
+            print('{:>8} {:>8.2f} {:>12.3f} {:>12.3f} {:>8.2f}'.format(batch_size, density, 1e3 * dense,
+                                                                      1e3 * sparse, dense / sparse))
+        print('==> batch {}: sparse is faster from density {}'.format(batch_size, crossover))
+
+
+def benchmark_layout(dnn_hidden_units):
+    """
+    Training step and inference time of the dimension-first and the batch-major layout
+    (see MLP) across batch sizes, both in float32 workspace mode.
+    """
+    from mlp_numpy import LAYOUTS
+
+    flags = {'learning_rate': 1e-3}
+    print('{:>8} {:>12} {:>12} {:>12}'.format('batch', 'layout', 'train ms', 'predict ms'))
+
+    for batch_size in sorted({1, 32, FLAGS.batch_size, 1000}):
+        X, y = _random_batch(batch_size)
+        times = {}
+        for layout in LAYOUTS:
+            net = MLP(n_hidden=dnn_hidden_units, n_classes=N_CLASSES, input_dim=INPUT_DIM, dtype=np.float32,
+                      workspace=True, layout=layout)
+            train = _time_steps(lambda: net.train_batch(X, y, flags), FLAGS.steps)
+            predict = _time_steps(lambda: net.predict(X, batch_size=batch_size), FLAGS.steps)
+            times[layout] = train
+            print('{:>8} {:>12} {:>12.3f} {:>12.3f}'.format(batch_size, layout, 1e3 * train, 1e3 * predict))
+        print('==> batch {}: batch_major train speedup {:.2f}'.format(batch_size,
+                                                                    times['dim_first'] / times['batch_major']))
+
+
+def benchmark_quantization(dnn_hidden_units):
+    """
+    Weight footprint and inference throughput of the int8 QuantizedMLP against the float32
+    MLP it was quantized from, and the difference of their logits.
+    """
+    from quantization_numpy import QuantizedMLP
+
+    net = MLP(n_hidden=dnn_hidden_units, n_classes=N_CLASSES, input_dim=INPUT_DIM, weight_scale=1e-2,
+              dtype=np.float32)
+    qnet = QuantizedMLP.from_mlp(net, [_random_batch(FLAGS.batch_size)[0] for _ in range(4)])
+
+    float_bytes = sum(layer.W.nbytes + layer.b.nbytes for layer in net.layers)
+    print('==> weight footprint: float32 {:.2f} MB, int8 {:.2f} MB ({:.2f}x smaller)'.format(
+        float_bytes / 2 ** 20, qnet.nbytes() / 2 ** 20, float_bytes / qnet.nbytes()))
+
+    print('{:>8} {:>14} {:>14} {:>8} {:>12} {:>10}'.format('batch', 'float32 img/s', 'int8 img/s', 'speedup',
+                                                            'max |delta|', 'agreement'))
+    for batch_size in sorted({1, 32, FLAGS.batch_size, 1000}):
+        X, _ = _random_batch(batch_size)
+        float_time = _time_steps(lambda: net.predict(X, batch_size=batch_size), FLAGS.steps)
+        int8_time = _time_steps(lambda: qnet.predict(X, batch_size=batch_size), FLAGS.steps)
+
+        float_logits, int8_logits = net.predict(X, batch_size=batch_size), qnet.predict(X, batch_size=batch_size)
+        agreement = np.mean(np.argmax(float_logits, axis=1) == np.argmax(int8_logits, axis=1))
+        print('{:>8} {:>14.0f} {:>14.0f} {:>8.2f} {:>12.4f} {:>10.3f}'.format(
+            batch_size, batch_size / float_time, batch_size / int8_time, float_time / int8_time,
+            np.max(np.abs(float_logits - int8_logits)), agreement))
+
+
+def benchmark_augmentation(dnn_hidden_units):
+    """
+    Images/sec of the vectorized Augmenter in-process and through a Prefetcher with 1 to
+    max_workers worker processes, against Keras' ImageDataGenerator with the affine
+    parameters of train_convnet_tf.py if it is installed.
+    """
+    from augmentation_numpy import Augmenter
+    from cifar10_utils import DataSet
+    from input_pipeline import Prefetcher
+
+    affine = dict(rotation_range=10, shift_range=0.10, shear_range=0.1, zoom_range=0.1)
+    images = np.random.randint(0, 256, size=(10 * FLAGS.batch_size, 32, 32, 3)).astype(np.uint8)
+    labels = np.random.randint(0, N_CLASSES, size=images.shape[0])
+    batch = images[:FLAGS.batch_size].astype(np.float32)
+    print('{:>30} {:>12}'.format('pipeline', 'images/sec'))
+
+    def report(name, seconds_per_batch):
+        print('{:>30} {:>12.0f}'.format(name, FLAGS.batch_size / seconds_per_batch))
+
+    for name, augmenter in [('affine', Augmenter(**affine)),
+                            ('affine+crop+flip', Augmenter(padding=4, horizontal_flip=True, **affine)),
+                            ('crop+flip', Augmenter(padding=4, horizontal_flip=True))]:
+        rng = np.random.RandomState(0)
+        report('numpy ' + name, _time_steps(lambda: augmenter(batch, rng), FLAGS.steps))
+
+    augmenter = Augmenter(padding=4, horizontal_flip=True, **affine)
+    for n_workers in range(1, FLAGS.max_workers + 1):
+        dataset = DataSet(images, labels)
+        with Prefetcher(dataset, FLAGS.batch_size, transform=augmenter, n_workers=n_workers) as prefetcher:
+            elapsed = _time_steps(prefetcher.next_batch, FLAGS.steps)
+        report('prefetch, {} workers'.format(n_workers), elapsed)
+
+    try:
+        from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    except ImportError:
+        print('==> ImageDataGenerator not installed, skipped')
+        return
+    generator = ImageDataGenerator(width_shift_range=affine['shift_range'], height_shift_range=affine['shift_range'],
+                                   rotation_range=affine['rotation_range'], shear_range=affine['shear_range'],
+                                   zoom_range=affine['zoom_range'], fill_mode='nearest',
+                                   data_format='channels_last').flow(x=batch, y=labels[:FLAGS.batch_size],
+                                                                     batch_size=FLAGS.batch_size)
+    report('ImageDataGenerator affine', _time_steps(generator.next, FLAGS.steps))
+
+
+def benchmark_startup(dnn_hidden_units):
+    """
+    Wall-clock time of a fresh interpreter importing each NumPy entry point, best of
+    STARTUP_RUNS. Exits with an error if any of them imports one of HEAVY_MODULES.
+    """
+    script = ('import json, sys, time; start = time.perf_counter(); import {}; '
+              'print(time.perf_counter() - start); print(json.dumps(sorted(sys.modules)))')
+    here = os.path.dirname(os.path.abspath(__file__))
+    print('{:>30} {:>12} {:>12}'.format('module', 'startup ms', 'import ms'))
+
+    offenders = {}
+    for module in STARTUP_MODULES:
+        startup_times, import_times = [], []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            output = subprocess.check_output([sys.executable, '-c', script.format(module)], cwd=here)
+            startup_times.append(time.perf_counter() - start)
+            import_time, modules = output.decode().splitlines()
+            import_times.append(float(import_time))
+
+        heavy = sorted({name.split('.')[0] for name in json.loads(modules)} & set(HEAVY_MODULES))
+        if heavy:
+            offenders[module] = heavy
+        print('{:>30} {:>12.0f} {:>12.0f}'.format(module, 1e3 * min(startup_times), 1e3 * min(import_times)))
+
+    if offenders:
+        sys.exit('==> heavy imports at startup: ' + ', '.join(
+            '{} imports {}'.format(module, ', '.join(heavy)) for module, heavy in sorted(offenders.items())))
+    print('==> no heavy imports at startup ({})'.format(', '.join(HEAVY_MODULES)))
+
+
+BENCHMARKS = {'augmentation': benchmark_augmentation,
+              'data_parallel': benchmark_data_parallel,
+              'layout': benchmark_layout,
+              'pruning': benchmark_pruning,
+              'quantization': benchmark_quantization,
+              'startup': benchmark_startup}
+
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+
+def main():
+    """
+    Main function
+    """
+    print_flags()
+    np.random.seed(42)
+
+    if FLAGS.dnn_hidden_units:
+        dnn_hidden_units = [int(units) for units in FLAGS.dnn_hidden_units.split(',')]
+    else:
+        dnn_hidden_units = []
+
+    for name in FLAGS.benchmark:
+        print('\n==> {}'.format(name))
+        BENCHMARKS[name](dnn_hidden_units)
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, nargs='+', choices=sorted(BENCHMARKS.keys()),
+                        help='Benchmarks to run')
+    parser.add_argument('--dnn_hidden_units', type=str, default=DNN_HIDDEN_UNITS_DEFAULT,
+                        help='Comma separated list of number of units in each hidden layer')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
+                        help='Batch size')
+    parser.add_argument('--steps', type=int, default=STEPS_DEFAULT,
+                        help='Number of timed steps per configuration')
+    parser.add_argument('--max_workers', type=int, default=mp.cpu_count(),
+                        help='Largest number of worker processes for data_parallel')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
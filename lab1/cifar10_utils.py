@@ -6,39 +6,76 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import hashlib
+import json
 import numpy as np
 import os
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from tensorflow.contrib.learn.python.learn.datasets import base
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where concurrent cache builds are not serialized
+    fcntl = None
 
 # Default paths for downloading CIFAR10 data
 CIFAR10_FOLDER = 'cifar10/cifar-10-batches-py'
+CIFAR10_BATCH_SIZE = 10000
 
+# Preprocessed arrays are cached in this subfolder of the data directory. Bump the version
+# whenever the preprocessing changes, a cache of another version is then rebuilt in place.
+CACHE_VERSION = 3
+CACHE_FOLDER = 'preprocessed'
+CACHE_ARRAYS = ['train_images', 'train_labels', 'test_images', 'test_labels']
 
-def load_cifar10_batch(batch_filename):
+# Normalization statistics of the train images, see ImageStats
+IMAGE_STATS_FILENAME = 'image_stats.npz'
+STATS_CHUNK_SIZE = 1000
+NORMALIZATIONS = ['mean', 'pixel', 'channel']
+# Suffix of the input normalization saved next to a trained model, see DataSet.save_normalization
+NORMALIZATION_SUFFIX = '_normalization.npz'
+
+# Same fields as tensorflow.contrib.learn's Datasets, without importing TensorFlow
+Datasets = collections.namedtuple('Datasets', ['train', 'validation', 'test'])
+
+
+def load_cifar10_batch(batch_filename, out=None):
     """
     Loads single batch of CIFAR10 data.
     Args:
       batch_filename: Filename of batch to get data from.
+      out: Optional (X, Y) arrays of the shapes below, the batch is decoded into them.
     Returns:
-      X: CIFAR10 batch data in numpy array with shape (10000, 32, 32, 3).
-      Y: CIFAR10 batch labels in numpy array with shape (10000, ).
+      X: CIFAR10 batch data in uint8 numpy array with shape (10000, 32, 32, 3).
+      Y: CIFAR10 batch labels in int64 numpy array with shape (10000, ).
     """
     with open(batch_filename, 'rb') as f:
         batch = pickle.load(f, encoding='latin1')
-        X = batch['data']
-        Y = batch['labels']
-        X = X.reshape(10000, 3, 32, 32).transpose(0, 2, 3, 1).astype(np.float32)
-        Y = np.array(Y)
-        return X, Y
+    X = batch['data'].reshape(CIFAR10_BATCH_SIZE, 3, 32, 32).transpose(0, 2, 3, 1)
+    if out is None:
+        return np.ascontiguousarray(X), np.array(batch['labels'], dtype=np.int64)
 
+    X_out, Y_out = out
+    np.copyto(X_out, X)
+    Y_out[:] = batch['labels']
+    return X_out, Y_out
 
-def load_cifar10(cifar10_folder):
+
+def load_cifar10(cifar10_folder, n_workers=None, verbose=False):
     """
-    Loads CIFAR10 train and test splits.
+    Loads CIFAR10 train and test splits. The six batch files are decoded straight into
+    preallocated arrays, in parallel by n_workers threads: reading the files and copying the
+    pixels into place release the GIL. Threads, unlike forked processes, are safe in a process
+    that already runs TensorFlow or BLAS threads.
     Args:
       cifar10_folder: Folder which contains downloaded CIFAR10 data.
+      n_workers: Number of threads, defaults to the number of cores (at most 6). With 1, the
+                 batches are decoded serially.
+      verbose: Flag for printing the load throughput.
     Returns:
       X_train: CIFAR10 train data in numpy array with shape (50000, 32, 32, 3).
       Y_train: CIFAR10 train labels in numpy array with shape (50000, ).
@@ -46,17 +83,36 @@ def load_cifar10(cifar10_folder):
       Y_test: CIFAR10 test labels in numpy array with shape (10000, ).
 
     """
-    Xs = []
-    Ys = []
-    for b in range(1, 6):
-        batch_filename = os.path.join(cifar10_folder, 'data_batch_' + str(b))
-        X, Y = load_cifar10_batch(batch_filename)
-        Xs.append(X)
-        Ys.append(Y)
-    X_train = np.concatenate(Xs)
-    Y_train = np.concatenate(Ys)
-    X_test, Y_test = load_cifar10_batch(os.path.join(cifar10_folder, 'test_batch'))
-    return X_train, Y_train, X_test, Y_test
+    filenames = [os.path.join(cifar10_folder, 'data_batch_' + str(b)) for b in range(1, 6)]
+    filenames.append(os.path.join(cifar10_folder, 'test_batch'))
+    if n_workers is None:
+        n_workers = min(len(filenames), os.cpu_count() or 1)
+
+    start = time.perf_counter()
+    n_images = len(filenames) * CIFAR10_BATCH_SIZE
+    X = np.empty((n_images, 32, 32, 3), dtype=np.uint8)
+    Y = np.empty(n_images, dtype=np.int64)
+
+    def load_batch(k):
+        batch = slice(k * CIFAR10_BATCH_SIZE, (k + 1) * CIFAR10_BATCH_SIZE)
+        load_cifar10_batch(filenames[k], out=(X[batch], Y[batch]))
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(n_workers) as pool:
+            # list() re-raises the exception of a failed batch
+            list(pool.map(load_batch, range(len(filenames))))
+    else:
+        for k in range(len(filenames)):
+            load_batch(k)
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print('Loaded {} CIFAR10 images in {:.2f} s ({:.0f} images/sec, {:.1f} MB/s, {} thread{})'.format(
+            n_images, elapsed, n_images / elapsed, X.nbytes / 2 ** 20 / elapsed, n_workers,
+            's' if n_workers > 1 else ''))
+
+    n_train = n_images - CIFAR10_BATCH_SIZE
+    return X[:n_train], Y[:n_train], X[n_train:], Y[n_train:]
 
 
 def get_cifar10_raw_data(data_dir):
@@ -77,32 +133,242 @@ def get_cifar10_raw_data(data_dir):
     return X_train, Y_train, X_test, Y_test
 
 
-def preprocess_cifar10_data(X_train_raw, Y_train_raw, X_test_raw, Y_test_raw):
+class ImageStats(object):
     """
-    Preprocesses CIFAR10 data by substracting mean from all images.
+    Streaming per-pixel mean and variance of images, updated one chunk at a time with Welford's
+    algorithm in the pairwise form of Chan et al.: the float64 statistics of a chunk are merged
+    into the running ones, so only one chunk is ever converted to float. Per-channel statistics
+    are derived from the per-pixel ones, every pixel having the same count.
+    """
+
+    def __init__(self, shape, count=0, mean=None, m2=None):
+        """
+        Args:
+          shape: Shape of one image, e.g. (32, 32, 3).
+          count, mean, m2: Running count, mean and sum of squared deviations, for load.
+        """
+        self.count = count
+        self.mean = np.zeros(shape, dtype=np.float64) if mean is None else mean
+        self.m2 = np.zeros(shape, dtype=np.float64) if m2 is None else m2
+
+    def update(self, images):
+        """
+        Adds a chunk of images [n, ...] of any dtype, e.g. uint8 or memory-mapped.
+        """
+        # a copy even for float64 chunks, the deviations are computed in place
+        chunk = np.array(images, dtype=np.float64)
+        chunk_mean = chunk.mean(axis=0)
+        chunk -= chunk_mean
+        self.merge(ImageStats(chunk_mean.shape, chunk.shape[0], chunk_mean, np.einsum('i...,i...->...', chunk, chunk)))
+
+    def merge(self, other):
+        """
+        Adds the images counted by other, e.g. the stats of another shard.
+        """
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+
+    def get_mean(self, per_channel=False):
+        """
+        float32 mean image, or mean per channel (last axis) if per_channel.
+        """
+        mean = self.mean.reshape(-1, self.mean.shape[-1]).mean(axis=0) if per_channel else self.mean
+        return mean.astype(np.float32)
+
+    def get_std(self, per_channel=False):
+        """
+        float32 standard deviation per pixel, or per channel (last axis) if per_channel.
+        """
+        variance = self.m2 / max(1, self.count)
+        if per_channel:
+            # total variance of a channel: mean pixel variance plus variance of the pixel means
+            means = self.mean.reshape(-1, self.mean.shape[-1])
+            variance = variance.reshape(means.shape).mean(axis=0) + means.var(axis=0)
+        return np.sqrt(variance).astype(np.float32)
+
+    def normalization(self, mode):
+        """
+        Mean and standard deviation images that DataSet applies to every batch.
+        Args:
+          mode: One of NORMALIZATIONS: 'mean' only substracts the mean image, 'pixel' also
+                divides by the standard deviation of every pixel, 'channel' substracts the mean
+                and divides by the standard deviation of every channel.
+        Returns:
+          mean_image, std_image (None for 'mean')
+        """
+        if mode == 'mean':
+            return self.get_mean(), None
+        if mode == 'pixel':
+            return self.get_mean(), self.get_std()
+        if mode == 'channel':
+            return self.get_mean(per_channel=True), self.get_std(per_channel=True)
+        raise ValueError('Unknown normalization {}, expected one of {}.'.format(mode, NORMALIZATIONS))
+
+    def save(self, file):
+        np.savez(file, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, file):
+        arrays = np.load(file)
+        return cls(arrays['mean'].shape, int(arrays['count']), arrays['mean'], arrays['m2'])
+
+
+def compute_image_stats(images, chunk_size=STATS_CHUNK_SIZE):
+    """
+    Computes the ImageStats of images in one pass of chunk_size images at a time.
     Args:
-      X_train_raw: CIFAR10 raw train data in numpy array.
-      Y_train_raw: CIFAR10 raw train labels in numpy array.
-      X_test_raw: CIFAR10 raw test data in numpy array.
-      Y_test_raw: CIFAR10 raw test labels in numpy array.
-      num_val: Number of validation samples.
+      images: Array of images [n, ...], e.g. memory-mapped uint8 CIFAR10 train data.
     Returns:
-      X_train: CIFAR10 train data in numpy array.
-      Y_train: CIFAR10 train labels in numpy array.
-      X_test: CIFAR10 test data in numpy array.
-      Y_test: CIFAR10 test labels in numpy array.
+      ImageStats
     """
-    X_train = X_train_raw.copy()
-    Y_train = Y_train_raw.copy()
-    X_test = X_test_raw.copy()
-    Y_test = Y_test_raw.copy()
+    stats = ImageStats(images.shape[1:])
+    for start in range(0, images.shape[0], chunk_size):
+        stats.update(images[start:start + chunk_size])
+    return stats
 
-    # Substract the mean
-    mean_image = np.mean(X_train, axis=0)
-    X_train -= mean_image
-    X_test -= mean_image
 
-    return X_train, Y_train, X_test, Y_test
+def source_hash(cifar10_folder):
+    """
+    Fingerprint of the CIFAR10 batch files: SHA1 of their names, sizes and modification times,
+    so that validating a cache costs a few stat calls instead of reading all batches.
+    Args:
+      cifar10_folder: Folder which contains downloaded CIFAR10 data.
+    Returns:
+      Hex digest, or None if the batch files are missing.
+    """
+    filenames = ['data_batch_' + str(b) for b in range(1, 6)] + ['test_batch']
+    digest = hashlib.sha1()
+    for filename in filenames:
+        path = os.path.join(cifar10_folder, filename)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        digest.update('{}:{}:{}\n'.format(filename, stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _exclusive_lock(filename):
+    """
+    Holds an exclusive lock on filename, waiting for other processes to release it.
+    """
+    with open(filename, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_cache(cifar10_folder, cache_folder=None):
+    """
+    Loads CIFAR10 once and saves the uint8 images and int labels as .npy files and the ImageStats
+    of the train images, with a meta.json holding the cache version and the source hash. meta.json is written last, so an interrupted build is never loaded.
+    Arrays of another cache version in the folder are removed.
+
+    Builds are serialized by a lock file in the cache folder: a process that waited for another
+    one's build returns without rebuilding if that build is valid.
+    Args:
+      cifar10_folder: Folder which contains downloaded CIFAR10 data.
+      cache_folder: Cache folder, defaults to CACHE_FOLDER inside cifar10_folder.
+    Returns:
+      The cache folder.
+    """
+    cache_folder = cache_folder or os.path.join(cifar10_folder, CACHE_FOLDER)
+    meta_filename = os.path.join(cache_folder, 'meta.json')
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+
+    with _exclusive_lock(os.path.join(cache_folder, 'build.lock')):
+        if load_cache(cifar10_folder, cache_folder) is not None:
+            return cache_folder
+        if os.path.exists(meta_filename):
+            os.remove(meta_filename)
+
+        outputs = [name + '.npy' for name in CACHE_ARRAYS] + [IMAGE_STATS_FILENAME]
+        for filename in os.listdir(cache_folder):
+            if filename not in outputs and filename.endswith(('.npy', '.npz')):
+                os.remove(os.path.join(cache_folder, filename))
+
+        X_train, Y_train, X_test, Y_test = get_cifar10_raw_data(cifar10_folder)
+
+        def save(filename, save_fn):
+            # written under a name of this process and renamed, so a reader never sees a partial file
+            tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                save_fn(f)
+            os.replace(tmp_filename, filename)
+
+        arrays = {'train_images': X_train, 'train_labels': Y_train, 'test_images': X_test, 'test_labels': Y_test}
+        for name in CACHE_ARRAYS:
+            save(os.path.join(cache_folder, name + '.npy'), lambda f: np.save(f, arrays[name]))
+        save(os.path.join(cache_folder, IMAGE_STATS_FILENAME), compute_image_stats(X_train).save)
+
+        with open(meta_filename, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'source_hash': source_hash(cifar10_folder)}, f)
+
+    return cache_folder
+
+
+def load_cache(cifar10_folder, cache_folder=None, mmap_mode='r'):
+    """
+    Loads the arrays saved by build_cache, memory-mapped read-only by default, so only the
+    pages that are used are read from disk.
+    Args:
+      cifar10_folder: Folder which contains downloaded CIFAR10 data.
+      cache_folder: Cache folder, defaults to CACHE_FOLDER inside cifar10_folder.
+      mmap_mode: Passed to np.load.
+    Returns:
+      Dict of CACHE_ARRAYS name -> array and 'image_stats' -> ImageStats, or None if there is no complete cache of the current
+      version for the current source files (a cache without source files is trusted).
+    """
+    cache_folder = cache_folder or os.path.join(cifar10_folder, CACHE_FOLDER)
+    meta_filename = os.path.join(cache_folder, 'meta.json')
+    if not os.path.exists(meta_filename):
+        return None
+
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    current_hash = source_hash(cifar10_folder)
+    if meta.get('version') != CACHE_VERSION or current_hash not in [None, meta.get('source_hash')]:
+        return None
+
+    arrays = {name: np.load(os.path.join(cache_folder, name + '.npy'), mmap_mode=mmap_mode)
+              for name in CACHE_ARRAYS}
+    arrays['image_stats'] = ImageStats.load(os.path.join(cache_folder, IMAGE_STATS_FILENAME))
+    return arrays
+
+
+def get_cifar10_data(data_dir, use_cache=True):
+    """
+    Gets raw CIFAR10 data and the ImageStats of the train images, from the cache if it is valid, building it otherwise.
+    Args:
+      data_dir: Data directory.
+      use_cache: If False, the raw data is loaded in memory and the cache is not used.
+    Returns:
+      X_train, Y_train, X_test, Y_test, see get_cifar10_raw_data, and image_stats.
+    """
+    if use_cache:
+        arrays = load_cache(data_dir)
+        if arrays is None:
+            try:
+                build_cache(data_dir)
+                arrays = load_cache(data_dir)
+            except OSError as e:
+                print('WARNING: could not write the CIFAR10 cache ({}), loading in memory'.format(e))
+
+        if arrays is not None:
+            return tuple(arrays[name] for name in CACHE_ARRAYS) + (arrays['image_stats'],)
+
+    X_train, Y_train, X_test, Y_test = get_cifar10_raw_data(data_dir)
+    return X_train, Y_train, X_test, Y_test, compute_image_stats(X_train)
 
 
 def dense_to_one_hot(labels_dense, num_classes):
@@ -125,14 +391,26 @@ def dense_to_one_hot(labels_dense, num_classes):
 class DataSet(object):
     """
     Utility class to handle dataset structure.
+    Images and labels are stored as given, e.g. uint8 pixels and int class labels, possibly
+    memory-mapped. Normalization and one-hot encoding are only applied to the batches returned.
+    Epochs are shuffled through a permutation of indices, the stored arrays are never reordered.
     """
 
-    def __init__(self, images, labels):
+    def __init__(self, images, labels, mean_image=None, std_image=None, scale=1., num_classes=None, seed=None):
         """
         Builds dataset with images and labels.
         Args:
           images: Images data.
           labels: Labels data
+          mean_image: Image substracted from every returned image, None for none. May also be
+                      one value per channel, see ImageStats.normalization.
+          std_image: Image (or values per channel) the returned images are divided by after the
+                     mean substraction, None for none.
+          scale: Factor applied to the returned images after the normalization.
+          num_classes: If given, labels are returned one-hot encoded with this many classes.
+          seed: If given, epoch e is shuffled with the seed (seed, e), so the order of every epoch
+                is reproducible, e.g. after set_state. Otherwise the first epoch is in stored
+                order and later ones are shuffled with the global numpy random state.
         """
         assert images.shape[0] == labels.shape[0], (
             "images.shape: {0}, labels.shape: {1}".format(str(images.shape), str(labels.shape)))
@@ -140,15 +418,32 @@ class DataSet(object):
         self._num_examples = images.shape[0]
         self._images = images
         self._labels = labels
+        self._mean_image = mean_image
+        self._inv_std_image = None if std_image is None else inverse_std(std_image)
+        self._scale = scale
+        self._num_classes = num_classes
+        self._seed = seed
         self._epochs_completed = 0
         self._index_in_epoch = 0
+        self._perm = self._epoch_permutation(0)
 
     @property
     def images(self):
-        return self._images
+        """
+        Normalized images, computed on access. See NormalizedImages.
+        """
+        return NormalizedImages(self)
 
     @property
     def labels(self):
+        return self.encode_labels(self._labels)
+
+    @property
+    def raw_images(self):
+        return self._images
+
+    @property
+    def raw_labels(self):
         return self._labels
 
     @property
@@ -159,31 +454,195 @@ class DataSet(object):
     def epochs_completed(self):
         return self._epochs_completed
 
-    def next_batch(self, batch_size):
+    def normalize(self, images, out=None):
+        """
+        Converts stored images to float32 and applies mean substraction, division by the standard
+        deviation and scaling.
+        Args:
+          images: Images in the stored format.
+          out: Optional float32 array of the same shape to write the result into.
+        Returns:
+          float32 numpy array, a new array unless out is given.
+        """
+        return normalize_images(images, self._mean_image, self._inv_std_image, self._scale, out=out)
+
+    def save_normalization(self, file):
+        """
+        Saves the normalization of normalize, for inputs that do not come from the dataset, e.g.
+        the requests of serve_mlp_numpy.py. See load_normalization.
+        """
+        arrays = {'image_shape': np.array(self._images.shape[1:]), 'scale': self._scale}
+        if self._mean_image is not None:
+            arrays['mean_image'] = self._mean_image
+        if self._inv_std_image is not None:
+            arrays['inv_std_image'] = self._inv_std_image
+        np.savez(file, **arrays)
+
+    def encode_labels(self, labels, out=None):
+        """
+        One-hot encodes stored labels if the dataset has num_classes.
+        Args:
+          labels: Labels in the stored format.
+          out: Optional array of the encoded shape to write the result into.
+        """
+        labels = np.asarray(labels)
+        if self._num_classes is not None:
+            if out is None:
+                return dense_to_one_hot(labels, self._num_classes)
+            out.fill(0)
+            out[np.arange(labels.shape[0]), labels] = 1
+            return out
+        if out is None:
+            return labels
+        np.copyto(out, labels)
+        return out
+
+    def batch_shapes(self, batch_size):
+        """
+        Shapes of the image and label arrays returned by next_batch.
+        """
+        labels_shape = self._labels.shape[1:] if self._num_classes is None else (self._num_classes,)
+        return (batch_size,) + self._images.shape[1:], (batch_size,) + labels_shape
+
+    def next_batch(self, batch_size, allow_smaller_final_batch=False, out=None):
         """
         Return the next `batch_size` examples from this data set.
         Args:
           batch_size: Batch size.
+          allow_smaller_final_batch: Flag for returning the remaining examples of an epoch as a
+                                     smaller batch, instead of skipping them.
+          out: Optional (images, labels) arrays of batch_shapes(batch_size) to write the batch into.
+               A smaller final batch is written into their first rows.
         """
-        start = self._index_in_epoch
-        self._index_in_epoch += batch_size
-        if self._index_in_epoch > self._num_examples:
+        remaining = self._num_examples - self._index_in_epoch
+        if remaining == 0 or (remaining < batch_size and not allow_smaller_final_batch):
+            assert batch_size <= self._num_examples
             self._epochs_completed += 1
+            self._index_in_epoch = 0
+            self._perm = self._epoch_permutation(self._epochs_completed)
 
-            perm = np.arange(self._num_examples)
-            np.random.shuffle(perm)
-            self._images = self._images[perm]
-            self._labels = self._labels[perm]
+        start = self._index_in_epoch
+        end = min(start + batch_size, self._num_examples)
+        self._index_in_epoch = end
+
+        # gather the batch, only the batch is copied
+        indices = slice(start, end) if self._perm is None else self._perm[start:end]
+        if out is None:
+            return self.normalize(self._images[indices]), self.encode_labels(self._labels[indices])
+        images_out, labels_out = out
+        n = end - start
+        return (self.normalize(self._images[indices], out=images_out[:n]),
+                self.encode_labels(self._labels[indices], out=labels_out[:n]))
+
+    def get_state(self):
+        """
+        Position in the data, to resume a run with set_state. Only reproduces the order of
+        later epochs if the dataset has a seed.
+        """
+        return {'epochs_completed': self._epochs_completed, 'index_in_epoch': self._index_in_epoch}
 
-            start = 0
-            self._index_in_epoch = batch_size
-            assert batch_size <= self._num_examples
+    def set_state(self, state):
+        """
+        Continues from a position returned by get_state.
+        """
+        self._epochs_completed = state['epochs_completed']
+        self._index_in_epoch = state['index_in_epoch']
+        self._perm = self._epoch_permutation(self._epochs_completed)
+
+    def _epoch_permutation(self, epoch):
+        """
+        Order of the examples in an epoch, None for the stored order.
+        """
+        if self._seed is not None:
+            return np.random.RandomState([self._seed, epoch]).permutation(self._num_examples)
+        if epoch == 0:
+            return None
+        return np.random.permutation(self._num_examples)
+
+
+def inverse_std(std_image):
+    """
+    float32 1 / std_image, with constant pixels left unscaled instead of divided by 0.
+    """
+    std_image = np.asarray(std_image, dtype=np.float32)
+    inv_std_image = np.ones_like(std_image)
+    np.divide(1., std_image, out=inv_std_image, where=std_image > 0)
+    return inv_std_image
+
+
+def normalize_images(images, mean_image=None, inv_std_image=None, scale=1., out=None):
+    """
+    Converts images to float32 and applies mean substraction, multiplication by the inverse
+    standard deviation and scaling, see DataSet.normalize.
+    """
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+    if mean_image is not None:
+        np.subtract(images, mean_image, out=out)
+    else:
+        np.copyto(out, images)
+    if inv_std_image is not None:
+        out *= inv_std_image
+    if scale != 1.:
+        out *= scale
+    return out
+
+
+def load_normalization(file):
+    """
+    Loads a normalization saved by DataSet.save_normalization.
+    Args:
+      file: Filename or file object.
+    Returns:
+      image_shape, the shape of a single image, and a function normalize(images, out=None)
+      of images [n] + image_shape in the stored format, like DataSet.normalize.
+    """
+    arrays = np.load(file)
+    image_shape = tuple(int(d) for d in arrays['image_shape'])
+    mean_image = arrays['mean_image'] if 'mean_image' in arrays else None
+    inv_std_image = arrays['inv_std_image'] if 'inv_std_image' in arrays else None
+    scale = float(arrays['scale'])
 
-        end = self._index_in_epoch
-        return self._images[start:end], self._labels[start:end]
+    def normalize(images, out=None):
+        return normalize_images(images, mean_image, inv_std_image, scale, out=out)
 
+    return image_shape, normalize
 
-def read_data_sets(data_dir, one_hot=True, validation_size=0):
+
+class NormalizedImages(object):
+    """
+    Read-only view of the images of a DataSet that normalizes on access: indexing returns
+    normalized float32 images, so evaluation loops that slice batches never hold more than
+    one normalized batch. np.asarray(view) normalizes the whole set.
+    """
+
+    def __init__(self, dataset):
+        self._dataset = dataset
+
+    @property
+    def shape(self):
+        return self._dataset.raw_images.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self._dataset.normalize(self._dataset.raw_images[index])
+
+    def __array__(self, dtype=None, copy=None):
+        images = self[:]
+        return images if dtype is None else images.astype(dtype, copy=False)
+
+
+def read_data_sets(data_dir, one_hot=True, validation_size=0, use_cache=True, normalization='mean'):
     """
     Returns the dataset readed from data_dir.
     Uses or not uses one-hot encoding for the labels.
@@ -192,20 +651,24 @@ def read_data_sets(data_dir, one_hot=True, validation_size=0):
       data_dir: Data directory.
       one_hot: Flag for one hot encoding.
       validation_size: Size of validation set
+      use_cache: Flag for loading the memory-mapped preprocessed cache, see build_cache.
+      normalization: One of NORMALIZATIONS, see ImageStats.normalization.
     Returns:
       Train, Validation, Test Datasets
     """
-    # Extract CIFAR10 data
-    train_images_raw, train_labels_raw, test_images_raw, test_labels_raw = \
-        get_cifar10_raw_data(data_dir)
-    train_images, train_labels, test_images, test_labels = \
-        preprocess_cifar10_data(train_images_raw, train_labels_raw, test_images_raw, test_labels_raw)
+    # A folder converted by sharded_dataset.py is streamed from disk instead
+    import sharded_dataset
+    if sharded_dataset.is_sharded(os.path.join(data_dir, 'train')):
+        return sharded_dataset.read_sharded_data_sets(data_dir, one_hot=one_hot, validation_size=validation_size,
+                                                      normalization=normalization)
+
+    # Extract CIFAR10 data, it is normalized per batch by DataSet
+    train_images, train_labels, test_images, test_labels, image_stats = \
+        get_cifar10_data(data_dir, use_cache=use_cache)
+    mean_image, std_image = image_stats.normalization(normalization)
 
     # Apply one-hot encoding if specified
-    if one_hot:
-        num_classes = len(np.unique(train_labels))
-        train_labels = dense_to_one_hot(train_labels, num_classes)
-        test_labels = dense_to_one_hot(test_labels, num_classes)
+    num_classes = len(np.unique(train_labels)) if one_hot else None
 
     # Subsample the validation set from the train set
     if not 0 <= validation_size <= len(train_images):
@@ -218,21 +681,24 @@ def read_data_sets(data_dir, one_hot=True, validation_size=0):
     train_labels = train_labels[validation_size:]
 
     # Create datasets
-    train = DataSet(train_images, train_labels)
-    validation = DataSet(validation_images, validation_labels)
-    test = DataSet(test_images, test_labels)
+    dataset_kwargs = dict(mean_image=mean_image, std_image=std_image, num_classes=num_classes)
+    train = DataSet(train_images, train_labels, **dataset_kwargs)
+    validation = DataSet(validation_images, validation_labels, **dataset_kwargs)
+    test = DataSet(test_images, test_labels, **dataset_kwargs)
 
-    return base.Datasets(train=train, validation=validation, test=test)
+    return Datasets(train=train, validation=validation, test=test)
 
 
-def get_cifar10(data_dir=CIFAR10_FOLDER, one_hot=True, validation_size=0):
+def get_cifar10(data_dir=CIFAR10_FOLDER, one_hot=True, validation_size=0, use_cache=True, normalization='mean'):
     """
     Prepares CIFAR10 dataset.
     Args:
       data_dir: Data directory.
       one_hot: Flag for one hot encoding.
       validation_size: Size of validation set
+      use_cache: Flag for loading the memory-mapped preprocessed cache, see build_cache.
+      normalization: One of NORMALIZATIONS, see ImageStats.normalization.
     Returns:
       Train, Validation, Test Datasets
     """
-    return read_data_sets(data_dir, one_hot, validation_size)
+    return read_data_sets(data_dir, one_hot, validation_size, use_cache, normalization)
@@ -0,0 +1,210 @@
+"""
+This module implements multi-process data-parallel training of the NumPy MLP.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mlp_numpy import MLP
+from training_stats import StatsCollector
+
+# BLAS threads per worker, the workers themselves provide the parallelism
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+@contextlib.contextmanager
+def single_blas_thread():
+    """
+    Processes spawned in this context start with a single BLAS thread.
+    """
+    saved_env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: '1' for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker(index, n_workers, config, buffers, conn):
+    """
+    Worker loop: computes the gradient of its shard of the batch into its own gradient
+    slot, then sums its segment of all slots into the shared gradient buffer.
+    The weights are read directly from shared memory, so updates by the master are
+    visible without any copy.
+    """
+    handles, arrays = [], {}
+    for key, (name, shape, dtype) in buffers.items():
+        shm, arrays[key] = _attach(name, shape, dtype)
+        handles.append(shm)
+
+    net = MLP(params=arrays['params'], grads=arrays['slots'][index],
+              stats=StatsCollector(enabled=False), **config)
+
+    # segment of the parameter vector this worker reduces
+    n_params = arrays['params'].shape[0]
+    bounds = np.linspace(0, n_params, n_workers + 1).astype(int)
+    segment = slice(bounds[index], bounds[index + 1])
+
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == 'grad':
+                _, start, stop, batch_size = command
+                if stop > start:
+                    result = net.accumulate_gradients(arrays['inputs'][start:stop], arrays['labels'][start:stop],
+                                                      batch_size, accumulate=False)
+                else:
+                    net.parameters.grads[...] = 0.
+                    result = 0., 0
+                conn.send(result)
+            elif command[0] == 'reduce':
+                np.sum(arrays['slots'][:, segment], axis=0, out=arrays['grads'][segment])
+                conn.send(None)
+            else:
+                break
+    finally:
+        del net, arrays
+        for shm in handles:
+            shm.close()
+
+
+class DataParallelTrainer(object):
+    """
+    Trains an MLP with n_workers processes. Every step, each worker computes the gradient
+    of an equal shard of the batch, the gradients are all-reduced in shared memory (each
+    worker sums one segment of the parameter vector over all workers) and the master
+    applies the update to the shared weights, which the workers read in place.
+
+    The model is available as self.net, e.g. for evaluation and saving. Micro-batching is not
+    supported: every worker already processes only its shard of the batch.
+    """
+
+    def __init__(self, n_workers, batch_size, **mlp_kwargs):
+        """
+        Args:
+          n_workers: number of worker processes.
+          batch_size: maximum number of datapoints per step.
+          mlp_kwargs: MLP constructor arguments (n_hidden, n_classes, dtype, ...).
+                      The model is initialized in this process, so seeding works as usual.
+        """
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+
+        init = MLP(**mlp_kwargs)
+        dtype = init.dtype
+        n_params = init.parameters.params.shape[0]
+
+        shapes = {'params': ((n_params,), dtype),
+                  'grads': ((n_params,), dtype),
+                  'slots': ((n_workers, n_params), dtype),
+                  'inputs': ((batch_size, init.input_dim), dtype),
+                  'labels': ((batch_size,), np.int64)}
+
+        self._shm = {}
+        self._arrays = {}
+        buffers = {}
+        for key, (shape, buffer_dtype) in shapes.items():
+            nbytes = max(1, int(np.prod(shape)) * np.dtype(buffer_dtype).itemsize)
+            self._shm[key] = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._arrays[key] = np.ndarray(shape, dtype=buffer_dtype, buffer=self._shm[key].buf)
+            buffers[key] = (self._shm[key].name, shape, np.dtype(buffer_dtype).str)
+
+        self._arrays['params'][...] = init.parameters.params
+        self._arrays['grads'][...] = 0.
+        del init
+
+        self.net = MLP(params=self._arrays['params'], grads=self._arrays['grads'], **mlp_kwargs)
+
+        # workers are spawned with a single BLAS thread each
+        config = {key: value for key, value in mlp_kwargs.items() if key not in ['stats', 'params', 'grads']}
+        ctx = mp.get_context('spawn')
+        self._conns, self._workers = [], []
+        with single_blas_thread():
+            for i in range(n_workers):
+                parent_conn, child_conn = ctx.Pipe()
+                worker = ctx.Process(target=_worker, args=(i, n_workers, config, buffers, child_conn))
+                worker.daemon = True
+                worker.start()
+                self._conns.append(parent_conn)
+                self._workers.append(worker)
+
+    def train_batch(self, x, labels, flags):
+        """
+        Performs one data-parallel training step, equivalent to MLP.train_batch.
+
+        Args:
+          x: float array of size [batch_size, ...], flattened per datapoint.
+          labels: one-hot 2D array or 1D array of class indices.
+          flags: contains necessary parameters for optimization, see MLP.train_step,
+                 without micro_batch_size.
+        Returns:
+          loss: scalar float, full loss of the batch before the update
+          accuracy: scalar float, accuracy of the batch before the update
+        """
+        if flags.get('micro_batch_size'):
+            raise ValueError('DataParallelTrainer does not support micro_batch_size. Received: {}.'.format(
+                flags['micro_batch_size']))
+        batch_size = x.shape[0]
+        assert batch_size <= self.batch_size, 'batch of {} exceeds {}'.format(batch_size, self.batch_size)
+
+        # scatter: workers read their shard from shared memory, labels as class indices
+        self._arrays['inputs'][:batch_size] = np.reshape(x, (batch_size, -1))
+        self._arrays['labels'][:batch_size] = labels if labels.ndim == 1 else np.argmax(labels, axis=1)
+
+        bounds = np.linspace(0, batch_size, self.n_workers + 1).astype(int)
+        for conn, start, stop in zip(self._conns, bounds[:-1], bounds[1:]):
+            conn.send(('grad', start, stop, batch_size))
+        results = [conn.recv() for conn in self._conns]
+
+        # all-reduce: each worker sums its segment of the gradient slots
+        for conn in self._conns:
+            conn.send(('reduce',))
+        [conn.recv() for conn in self._conns]
+
+        nll = sum(result[0] for result in results)
+        correct_preds = sum(result[1] for result in results)
+        loss, accuracy = self.net._record_batch(nll, correct_preds, batch_size)
+
+        # the update writes the shared weights, i.e. broadcasts them
+        self.net.apply_gradients(flags)
+
+        return loss, accuracy
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory. self.net must not be used afterwards.
+        """
+        for conn in self._conns:
+            conn.send(('stop',))
+        for worker in self._workers:
+            worker.join()
+        self._conns, self._workers = [], []
+
+        self.net = None
+        self._arrays = {}
+        for shm in self._shm.values():
+            shm.close()
+            shm.unlink()
+        self._shm = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,271 @@
+"""
+This module implements training of many same-shaped NumPy MLPs in one batched pass.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from mlp_numpy import MLP
+from optimizers_numpy import SGD
+from training_stats import StatsCollector
+
+
+class MLPEnsemble(object):
+    """
+    M MLPs with the same architecture but their own hyperparameters, stacked along a
+    leading model axis: W_k has shape [M, D_k+1, D_k] and activations [M, D_k, batch_size]
+    (dimension-first, as in MLP). All models see the same batch. The first layer of all
+    models is a single [M * D_1, D_0] x [D_0, batch_size] GEMM, the others are batched
+    matmuls over the model axis. Loss, accuracy and stats are kept per model.
+    """
+
+    def __init__(self,
+                 n_hidden,
+                 n_classes,
+                 weight_decays=0.0,
+                 weight_scales=0.0001,
+                 learning_rates=2e-3,
+                 input_dim=3 * 32 * 32,
+                 dtype=np.float64,
+                 n_models=None):
+        """
+        Args:
+          n_hidden: list of ints, number of units in each hidden layer (same for all models).
+          n_classes: int, number of classes of the classification problem.
+          weight_decays: L2 regularization parameter per model, or one for all.
+          weight_scales: std of the normal weight initialization per model, or one for all.
+          learning_rates: learning rate per model, or one for all, used by the default SGD optimizer.
+          input_dim: int, input dimension.
+          dtype: floating point type of the parameters and all intermediate arrays.
+          n_models: number of models, only needed if all hyperparameters are scalars.
+        """
+        hyperparameters = [np.atleast_1d(np.asarray(h, dtype=np.float64))
+                           for h in (weight_decays, weight_scales, learning_rates)]
+        if n_models is None:
+            n_models = max(len(h) for h in hyperparameters)
+        self.weight_decays, self.weight_scales, self.learning_rates = [np.broadcast_to(h, (n_models,)).copy()
+                                                                       for h in hyperparameters]
+
+        self.n_models = n_models
+        self.n_hidden = n_hidden
+        self.n_classes = n_classes
+        self.input_dim = input_dim
+        self.dtype = np.dtype(dtype)
+
+        dims = [input_dim] + n_hidden + [n_classes]
+        scales = self.weight_scales.reshape(-1, 1, 1)
+        self.W = [(np.random.normal(size=(n_models, dims[i + 1], dims[i])) * scales).astype(self.dtype)
+                  for i in range(len(dims) - 1)]
+        self.b = [np.zeros((n_models, dims[i + 1], 1), dtype=self.dtype) for i in range(len(dims) - 1)]
+        self.dW = [np.empty_like(W) for W in self.W]
+        self.db = [np.empty_like(b) for b in self.b]
+
+        # broadcast against [M, D, D'] parameters
+        self._decays = self.weight_decays.reshape(-1, 1, 1).astype(self.dtype)
+        self._default_optimizer = SGD(learning_rate=self.learning_rates.reshape(-1, 1, 1).astype(self.dtype))
+
+        # caches of the last forward pass
+        self.X = None
+        self.preactivation_cache = []
+        self.activation_cache = []
+
+        self.stats = [StatsCollector() for _ in range(n_models)]
+
+    def inference(self, x, cache=True):
+        """
+        Computes the logits of all models.
+
+        Args:
+          x: 2D float array of size [batch_size, input_dimensions]
+          cache: keep the activations for train_step
+        Returns:
+          logits: 3D float array of size [M, self.n_classes, batch_size] (dimension-first)
+        """
+        X = np.asarray(x, dtype=self.dtype).reshape(x.shape[0], -1)
+        M, batch_size = self.n_models, X.shape[0]
+
+        preactivations, activations = [], []
+        Z = None
+        for k, (W, b) in enumerate(zip(self.W, self.b)):
+            if k == 0:
+                # shared input: one GEMM for the first layer of all models
+                S = np.dot(W.reshape(-1, W.shape[2]), X.T).reshape(M, W.shape[1], batch_size)
+            else:
+                S = np.matmul(W, Z)
+            S += b
+
+            if k < len(self.W) - 1:
+                Z = np.maximum(S, 0)
+            else:
+                Z = S
+
+            preactivations.append(S)
+            activations.append(Z)
+
+        if cache:
+            self.X = X
+            self.preactivation_cache = preactivations
+            self.activation_cache = activations
+
+        return Z
+
+    def loss(self, logits, labels):
+        """
+        Computes the loss of every model and caches the output deltas for train_step.
+
+        Args:
+          logits: [M, self.n_classes, batch_size] array returned by inference.
+          labels: one-hot 2D array or 1D array of class indices.
+        Returns:
+          losses: 1D array [M], full loss = cross_entropy + reg_loss per model
+        """
+        labels = self._class_indices(labels)
+        batch_size = logits.shape[2]
+
+        nll, self.delta_out = self._softmax_cross_entropy(logits, labels)
+        self.delta_out *= 1. / batch_size
+
+        nl_prior = (1. / batch_size) * self._weight_complexity_costs()
+        nl_likelihood = (1. / batch_size) * nll
+        for m, stats in enumerate(self.stats):
+            stats.record('nl_likelihood', nl_likelihood[m])
+            stats.record('nl_prior', nl_prior[m])
+
+        return nl_likelihood + self.weight_decays * nl_prior
+
+    def accuracy(self, logits, labels):
+        """
+        Args:
+          logits: [M, self.n_classes, batch_size] array returned by inference.
+          labels: one-hot 2D array or 1D array of class indices.
+        Returns:
+          accuracies: 1D array [M]
+        """
+        accuracies = self._count_correct(logits, self._class_indices(labels)) / logits.shape[2]
+        for m, stats in enumerate(self.stats):
+            stats.record('accuracy', accuracies[m])
+        return accuracies
+
+    def train_step(self, flags=None):
+        """
+        Backpropagates the deltas cached by loss and updates every model with its own
+        learning rate and weight decay.
+
+        Args:
+          flags: optional dict; flags['optimizer'] replaces the default per-model SGD. Its
+                 learning rate should be an array of shape [M, 1, 1] to keep rates per model.
+        """
+        delta = self.delta_out
+        M, batch_size = self.n_models, delta.shape[2]
+
+        for k in range(len(self.W) - 1, -1, -1):
+            if k == 0:
+                np.dot(delta.reshape(-1, batch_size), self.X,
+                       out=self.dW[0].reshape(-1, self.dW[0].shape[2]))
+            else:
+                np.matmul(delta, self.activation_cache[k - 1].transpose(0, 2, 1), out=self.dW[k])
+            np.sum(delta, axis=2, keepdims=True, out=self.db[k])
+
+            if k > 0:
+                # delta_{k-1} = [W_{k}^T delta_{k}] * relu'(S_{k-1})
+                delta = np.matmul(self.W[k].transpose(0, 2, 1), delta)
+                delta *= self.preactivation_cache[k - 1] > 0
+
+        optimizer = (flags or {}).get('optimizer') or self._default_optimizer
+        params = [param for W, b in zip(self.W, self.b) for param in (W, b)]
+        grads = [grad for dW, db in zip(self.dW, self.db) for grad in (dW, db)]
+        optimizer.apply(params, grads, [self._decays, 0.] * len(self.W))
+
+        self.delta_out = None
+        for stats in self.stats:
+            stats.step += 1
+
+    def train_batch(self, x, labels, flags=None):
+        """
+        Performs inference, loss and one training step of every model on a batch.
+
+        Returns:
+          losses: 1D array [M] of the full losses before the update
+          accuracies: 1D array [M] of the accuracies before the update
+        """
+        logits = self.inference(x)
+        accuracies = self.accuracy(logits, labels)
+        losses = self.loss(logits, labels)
+        self.train_step(flags)
+        return losses, accuracies
+
+    def evaluate(self, x, labels, batch_size=1000, stats_prefix='test_'):
+        """
+        Computes the loss and accuracy of every model on a dataset of arbitrary size,
+        batch_size datapoints at a time, without keeping backprop caches.
+
+        Returns:
+          losses: 1D array [M]
+          accuracies: 1D array [M]
+        """
+        labels = self._class_indices(labels)
+        n_datapoints = x.shape[0]
+        nll = np.zeros(self.n_models)
+        correct_preds = np.zeros(self.n_models, dtype=np.int64)
+
+        for start in range(0, n_datapoints, batch_size):
+            logits = self.inference(x[start:start + batch_size], cache=False)
+            y = labels[start:start + batch_size]
+            correct_preds += self._count_correct(logits, y)
+            nll += self._softmax_cross_entropy(logits, y)[0]
+
+        nl_prior = (1. / n_datapoints) * self._weight_complexity_costs()
+        nl_likelihood = nll / n_datapoints
+        losses = nl_likelihood + self.weight_decays * nl_prior
+        accuracies = correct_preds / n_datapoints
+
+        if stats_prefix is not None:
+            for m, stats in enumerate(self.stats):
+                stats.record(stats_prefix + 'nl_likelihood', nl_likelihood[m])
+                stats.record(stats_prefix + 'nl_prior', nl_prior[m])
+                stats.record(stats_prefix + 'accuracy', accuracies[m])
+
+        return losses, accuracies
+
+    def model(self, m):
+        """
+        Returns model m as a standalone MLP, e.g. to save the best one of a sweep.
+        """
+        params = np.concatenate([W[m].ravel() for W in self.W] + [b[m].ravel() for b in self.b])
+        return MLP(n_hidden=self.n_hidden, n_classes=self.n_classes, weight_decay=self.weight_decays[m],
+                   weight_scale=self.weight_scales[m], input_dim=self.input_dim, dtype=self.dtype,
+                   params=params)
+
+    def _softmax_cross_entropy(self, logits, labels):
+        """
+        Cross-entropy per model for integer labels and its gradient w.r.t. the logits,
+        computed as in MLP._sparse_softmax_cross_entropy along the class axis.
+
+        :return: nll summed over the batch [M], gradient [M, n_classes, batch_size] (not divided by batch_size)
+        """
+        cols = np.arange(logits.shape[2])
+        max_logit = np.max(logits, axis=1, keepdims=True)
+        true_logit = logits[:, labels, cols]
+
+        e = np.exp(logits - max_logit)
+        normalizer = e.sum(axis=1, keepdims=True)
+
+        nll = (np.log(normalizer[:, 0]) + max_logit[:, 0] - true_logit).sum(axis=1)
+
+        e /= normalizer
+        e[:, labels, cols] -= 1.
+        return nll, e
+
+    def _count_correct(self, logits, labels):
+        return np.count_nonzero(np.argmax(logits, axis=1) == labels, axis=1)
+
+    def _weight_complexity_costs(self):
+        return sum(0.5 * np.einsum('mij,mij->m', W, W) for W in self.W)
+
+    def _class_indices(self, labels):
+        return labels if labels.ndim == 1 else np.argmax(labels, axis=1)
+
+    def __repr__(self):
+        return '|\tEnsemble of {} MLPs\n|\t'.format(self.n_models) + repr(self.model(0)).replace('\n', '\n|\t')
@@ -0,0 +1,226 @@
+"""
+This module implements background prefetching, and optionally multi-process transformation, of training
+batches from a cifar10_utils.DataSet.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Default constants
+PREFETCH_CAPACITY_DEFAULT = 4
+
+
+class Prefetcher(object):
+    """
+    Prepares batches of a DataSet on a background thread while the model trains on the
+    previous ones, and can be used in place of the DataSet by the trainers: next_batch
+    returns the next ready batch.
+
+    With reuse_buffers, batches are written into a fixed pool of capacity + 2 preallocated
+    arrays instead of new ones. A returned batch is then only valid until the next call of
+    next_batch, which hands its buffers back to the producer.
+
+    A transform, e.g. an augmentation_numpy.Augmenter, is applied to the images of every batch
+    with its own random state, on the producer thread or in a pool of n_workers processes.
+    Transformed batches are new arrays, buffers are only reused for the untransformed batches.
+
+    The time the consumer spends waiting for a batch is accumulated in blocked_time and,
+    given a StatsCollector, recorded per batch as 'input_blocked_time'.
+    """
+
+    def __init__(self, dataset, batch_size, capacity=PREFETCH_CAPACITY_DEFAULT, reuse_buffers=False,
+                 allow_smaller_final_batch=False, stats=None, transform=None, n_workers=0, seed=None):
+        """
+        Starts the producer thread.
+
+        Args:
+          dataset: DataSet, or any object with next_batch(batch_size, allow_smaller_final_batch, out)
+                   and batch_shapes(batch_size).
+          batch_size: Batch size.
+          capacity: Maximum number of ready batches waiting in the queue.
+          reuse_buffers: Flag for filling a fixed pool of preallocated arrays, see above.
+          allow_smaller_final_batch: Passed to dataset.next_batch.
+          stats: Optional StatsCollector for the blocked time of every batch.
+          transform: Optional picklable callable transform(images, rng) -> images.
+          n_workers: Number of worker processes for the transform, 0 runs it on the producer thread.
+          seed: Seed of the per-batch random states of the transform.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.allow_smaller_final_batch = allow_smaller_final_batch
+        self.stats = stats
+        self.transform = transform
+
+        self.blocked_time = 0.
+        self.n_batches = 0
+
+        self._ready = queue.Queue(maxsize=capacity)
+        self._stop = threading.Event()
+        self._held = None
+        # exception of the producer, which stops producing when it fails
+        self._error = None
+
+        self._seeds = np.random.RandomState(seed)
+        self._pool = None
+        if transform is not None and n_workers > 0:
+            # spawned workers do not inherit the producer thread or a TensorFlow session
+            self._pool = mp.get_context('spawn').Pool(n_workers)
+            self._in_flight = 2 * n_workers
+        reuse_buffers = reuse_buffers and transform is None
+
+        if reuse_buffers:
+            images, labels = dataset.next_batch(batch_size, allow_smaller_final_batch=allow_smaller_final_batch)
+            image_shape, label_shape = dataset.batch_shapes(batch_size)
+            self._free = queue.Queue()
+            for _ in range(capacity + 2):
+                self._free.put((np.empty(image_shape, dtype=images.dtype), np.empty(label_shape, dtype=labels.dtype)))
+            self._ready.put((images, labels, None))
+        else:
+            self._free = None
+
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def next_batch(self, batch_size=None):
+        """
+        Returns the next prepared batch. Raises the producer's exception if it failed, on this
+        and every later call.
+
+        Args:
+          batch_size: Ignored unless given, then it has to match the prefetcher's batch size.
+        """
+        assert batch_size is None or batch_size == self.batch_size, \
+            'Prefetcher prepares batches of {}, requested {}'.format(self.batch_size, batch_size)
+
+        if self._error is not None and self._ready.empty():
+            raise self._error
+
+        # the previous batch is no longer used by the consumer
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+
+        start = time.perf_counter()
+        item = self._ready.get()
+        blocked = time.perf_counter() - start
+
+        self.blocked_time += blocked
+        self.n_batches += 1
+        if self.stats is not None:
+            self.stats.record('input_blocked_time', blocked)
+
+        if isinstance(item, Exception):
+            raise item
+        images, labels, self._held = item
+        return images, labels
+
+    def close(self):
+        """
+        Stops the producer thread and drops the prepared batches, after waiting for the
+        transforms in flight in the worker pool. Raises the producer's exception if it failed.
+        """
+        self._stop.set()
+        while self._thread.is_alive():
+            # unblock a producer waiting for room in the queue
+            try:
+                self._ready.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(timeout=0.01)
+        if self._pool is not None:
+            # the workers finish the batches in flight: terminating a worker while it sends a result
+            # leaves the pool's result queue locked, and terminate() then hangs
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._error is not None:
+            raise self._error
+
+    def summary(self):
+        """
+        One-line report of the time spent waiting for input.
+        """
+        return 'Time blocked on input: {:.3f} s over {} batches ({:.3f} ms/batch)'.format(
+            self.blocked_time, self.n_batches, 1e3 * self.blocked_time / max(1, self.n_batches))
+
+    def __getattr__(self, name):
+        # everything else, e.g. images, labels, num_examples, comes from the wrapped DataSet
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            self.close()
+        except Exception:
+            # an exception leaving the block, e.g. the producer's one from next_batch, takes precedence
+            if exc_type is None:
+                raise
+
+    def _produce(self):
+        # batches sent to the workers, in order
+        pending = collections.deque()
+        try:
+            while not self._stop.is_set():
+                buffers = None if self._free is None else self._get_free_buffers()
+                if self._stop.is_set():
+                    return
+                images, labels = self.dataset.next_batch(self.batch_size,
+                                                         allow_smaller_final_batch=self.allow_smaller_final_batch,
+                                                         out=buffers)
+
+                if self.transform is None:
+                    self._put((images, labels, buffers))
+                    continue
+
+                seed = self._seeds.randint(2 ** 31)
+                if self._pool is None:
+                    self._put((self.transform(images, np.random.RandomState(seed)), labels, None))
+                    continue
+
+                pending.append((self._pool.apply_async(_apply_transform, (self.transform, images, seed)), labels))
+                if len(pending) >= self._in_flight:
+                    result, labels = pending.popleft()
+                    self._put((self._get_result(result), labels, None))
+        except Exception as e:
+            self._error = e
+            self._put(e)
+
+    def _get_result(self, result):
+        while not self._stop.is_set():
+            try:
+                return result.get(timeout=0.1)
+            except mp.TimeoutError:
+                pass
+        return None
+
+    def _get_free_buffers(self):
+        while not self._stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def _apply_transform(transform, images, seed):
+    return transform(images, np.random.RandomState(seed))
@@ -4,13 +4,52 @@ This module implements a multi-layer perceptron in NumPy.
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import json
+import os
+import sys
 import numpy as np
-from matplotlib import pyplot as plt
-from collections import defaultdict
+from training_stats import StatsCollector
+from optimizers_numpy import SGD
 
 
 # import seaborn as sns
 
+# memory layout of activations and weights, see MLP
+LAYOUTS = ['dim_first', 'batch_major']
+
+# warn about NaNs in the logits and exploding gradients
+DEFAULT_STATS_THRESHOLDS = {'logits_nonfinite': 0, 'dW_*_norm': 100, 'db_*_norm': 100}
+
+
+def issparse(x):
+    """
+    scipy.sparse.issparse without importing scipy at startup: a sparse matrix can only exist
+    once scipy.sparse has been imported by whoever created it.
+    """
+    sparse = sys.modules.get('scipy.sparse')
+    return sparse is not None and sparse.issparse(x)
+
+
+def iterate_chunks(x, labels, chunk_size, epochs=1):
+    """
+    Yields (x, labels) chunks of chunk_size datapoints for MLP.fit. With arrays loaded by
+    np.load(path, mmap_mode='r') only the current chunk is read from disk.
+
+    :param x: array [n_datapoints, ...], may be memory-mapped
+    :param labels: array [n_datapoints, ...], may be memory-mapped
+    :param chunk_size: number of datapoints per chunk
+    :param epochs: number of passes over the data
+    """
+    if issparse(x):
+        # COO and DIA matrices cannot be sliced by rows
+        x = x.tocsr()
+    for _ in range(epochs):
+        for start in range(0, x.shape[0], chunk_size):
+            x_chunk = x[start:start + chunk_size]
+            if not issparse(x_chunk):
+                x_chunk = np.asarray(x_chunk)
+            yield x_chunk, np.asarray(labels[start:start + chunk_size])
+
 
 class MLP(object):
     """
@@ -25,7 +64,13 @@ class MLP(object):
                  n_classes,
                  weight_decay=0.0,
                  weight_scale=0.0001,
-                 input_dim=3 * 32 * 32):
+                 input_dim=3 * 32 * 32,
+                 dtype=np.float64,
+                 workspace=False,
+                 stats=None,
+                 params=None,
+                 grads=None,
+                 layout='dim_first'):
         """
         Constructor for an MLP object. Default values should be used as hints for
         the usage of each parameter. Weights of the linear layers should be initialized
@@ -42,6 +87,18 @@ class MLP(object):
                           output dimensions of the MLP.
           weight_decay: L2 regularization parameter for the weights of linear layers.
           weight_scale: scale of normal distribution to initialize weights.
+          dtype: floating point type of the parameters and all intermediate arrays.
+          workspace: if True, per-layer buffers are allocated once per batch size and
+                     reused by every forward/backward pass (see Workspace).
+          stats: StatsCollector for losses and diagnostics. Defaults to one that records
+                 every step in a bounded in-memory buffer.
+          params: optional flat parameter array (see ParameterStore) to use instead of
+                  initializing new weights, e.g. a memory-mapped checkpoint.
+          grads: optional flat gradient array with the same layout, e.g. in shared memory.
+          layout: 'dim_first' keeps activations as [D_k, batch_size] and W as [D_k+1, D_k].
+                  'batch_major' keeps activations as [batch_size, D_k], like the inputs and
+                  logits, and W as [D_k, D_k+1], so no transposes are needed and every GEMM
+                  runs on C-contiguous operands. See `benchmark_mlp_numpy.py layout`.
 
         """
         self.n_hidden = n_hidden
@@ -49,41 +106,66 @@ class MLP(object):
         self.weight_decay = weight_decay
         self.weight_scale = weight_scale
         self.input_dim = input_dim
-
-        # infer shapes of each layer: dimension-first notation W.shape=(D_k+1, D_k)
-        W_shapes = [self.input_dim] + n_hidden + [self.n_classes]
-        W_shapes = [(W_shapes[i + 1], W_shapes[i]) for i in range(len(W_shapes) - 1)]
-        bias_shapes = [(shape[0], 1) for shape in W_shapes]
-
-        # initialize weights
-        weights = [
-            self._get_init_weight(shape, self.weight_scale) for shape in W_shapes
-        ]
-
-        # initialize biases
-        biases = [self._get_init_bias(dim) for dim in bias_shapes]
-
-        def relu(x):
-            return x * (x > 0)
-
-        def linear(x):
+        self.dtype = np.dtype(dtype)
+        self.workspace = workspace
+        if layout not in LAYOUTS:
+            raise ValueError('Layout should be one of {}. Received: {}.'.format(LAYOUTS, layout))
+        self.layout = layout
+        self.batch_major = layout == 'batch_major'
+
+        # infer shapes of each layer: dimension-first notation W.shape=(D_k+1, D_k),
+        # transposed in batch-major layout
+        dims = [self.input_dim] + n_hidden + [self.n_classes]
+        if self.batch_major:
+            W_shapes = [(dims[i], dims[i + 1]) for i in range(len(dims) - 1)]
+            bias_shapes = [(1, d) for d in dims[1:]]
+        else:
+            W_shapes = [(dims[i + 1], dims[i]) for i in range(len(dims) - 1)]
+            bias_shapes = [(d, 1) for d in dims[1:]]
+
+        # all parameters and gradients live in one contiguous buffer each
+        self.parameters = ParameterStore(W_shapes, bias_shapes, self.dtype, params=params, grads=grads)
+
+        if params is None:
+            # initialize weights
+            # drawn in dimension-first shape, so both layouts start from the same weights
+            for W in self.parameters.W:
+                W_init = self._get_init_weight(W.T.shape if self.batch_major else W.shape, self.weight_scale)
+                W[...] = W_init.T if self.batch_major else W_init
+
+            # initialize biases
+            for b, shape in zip(self.parameters.b, bias_shapes):
+                b[...] = self._get_init_bias(shape)
+
+        def relu(x, out=None):
+            return np.maximum(x, 0, out=out)
+
+        def linear(x, out=None):
             return x
 
         # relu activations for all hidden layers, linear for final layer
         activations = [relu for _ in n_hidden] + [linear]
 
-        # layer wrapper objects
+        # layer wrapper objects, holding views into the parameter store
         self.layers = [
-            Layer(W=W, b=b, activation=a, k=i, parent=self)
+            Layer(W=W, b=b, activation=a, k=i, parent=self, batch_major=self.batch_major)
             for i, (W, b, a) in enumerate(
-                list(zip(weights, biases, activations)))
+                list(zip(self.parameters.W, self.parameters.b, activations)))
         ]
+        for layer, dW, db in zip(self.layers, self.parameters.dW, self.parameters.db):
+            layer.dW, layer.db = dW, db
+        self._workspaces = {}
+        self._default_optimizer = None
+
+        # training settings of the last partial_fit call, reused by the next one
+        self._fit_flags = None
+        self._fit_batch_size = None
 
         # For caching and debugging
         self.activation_cache = []
         self.preactivation_cache = []
         self.delta_out = None
-        self.debug_stats = defaultdict(list)
+        self.stats = stats if stats is not None else StatsCollector(thresholds=DEFAULT_STATS_THRESHOLDS)
         self.training_mode = True
 
     def inference(self, x):
@@ -98,7 +180,7 @@ class MLP(object):
         It can be useful to save some intermediate results for easier computation of
         gradients for backpropagation during training.
         Args:
-          x: 2D float array of size [batch_size, input_dimensions]
+          x: 2D float array of size [batch_size, input_dimensions], or a scipy.sparse matrix.
 
         Returns:
           logits: 2D float array of size [batch_size, self.n_classes]. Returns
@@ -114,24 +196,27 @@ class MLP(object):
         self.activation_cache.clear()
         self.preactivation_cache.clear()
 
-        # dim-first convention: z = WX+b
-        Z = x.T
+        # dim-first convention: z = WX+b, batch-major: z = XW+b
+        Z = self._as_input(x)
+        ws = self._get_workspace(Z.shape[0]) if self.workspace else None
+        Z = self._batch_major(Z)
         self.activation_cache += [Z]
 
         # feed-forward and caching
-        for layer in self.layers:
-            Z, S = layer.forward(Z)
+        for k, layer in enumerate(self.layers):
+            if ws is None:
+                Z, S = layer.forward(Z)
+            else:
+                Z, S = layer.forward(Z, S_out=ws.S[k], Z_out=ws.Z[k])
 
             self.activation_cache += [Z]
             self.preactivation_cache += [S]
 
-        logits = Z.T  # to match label size for computing accuracy/loss
-
-        if not np.isfinite(logits).all():
-            print('WARNING: NaN encountered in logits')
+        logits = self._batch_major(Z)  # to match label size for computing accuracy/loss
 
         # Collect debug stats
-        self._dump_training_stats('logits_norm', np.linalg.norm(logits))
+        self._dump_training_stats('logits_nonfinite', lambda: logits.size - np.count_nonzero(np.isfinite(logits)))
+        self._dump_training_stats('logits_norm', lambda: np.linalg.norm(logits))
 
         ########################
         # END OF YOUR CODE    #
@@ -152,7 +237,8 @@ class MLP(object):
           logits: 2D float array of size [batch_size, self.n_classes].
                        The predictions returned through self.inference.
           labels: 2D int array of size [batch_size, self.n_classes]
-                       with one-hot encoding. Ground truth labels for each
+                       with one-hot encoding, or 1D int array of size [batch_size]
+                       with class indices. Ground truth labels for each
                        sample in the batch.
         Returns:
           loss: scalar float, full loss = cross_entropy + reg_loss
@@ -163,22 +249,14 @@ class MLP(object):
         #######################
 
         batch_size = logits.shape[0]
-        class_probs = self._softmax2D(logits)
-        self.logits = logits
-        self.class_probs = class_probs
 
         # individual losses
         nl_prior = (1. / batch_size) * self._weight_complexity_cost()
-        nl_likelihood = (1. / batch_size) * self._cross_entropy_loss(class_probs, labels)
+        nl_likelihood = (1. / batch_size) * self._data_loss(logits, labels)
 
         # full loss
         loss = nl_likelihood + self.weight_decay * nl_prior
 
-        # Caching
-        # delta_out = dL/dY_out * dY_out/dS_out
-        self.delta_out = (class_probs - labels).T
-        self.delta_out *= (1. / batch_size)
-
         # Debugging
         if not np.isfinite(loss).all():
             print('WARNING: NaN encountered in loss')
@@ -195,7 +273,8 @@ class MLP(object):
     def train_step(self, loss, flags):
         """
         Implements a training step using a parameters in flags.
-        Use mini-batch Stochastic Gradient Descent to update the parameters of the MLP.
+        The parameters of the MLP are updated by flags['optimizer'] if given (see optimizers_numpy),
+        otherwise by mini-batch Stochastic Gradient Descent with flags['learning_rate'].
 
         Args:
           loss: scalar float.
@@ -207,31 +286,227 @@ class MLP(object):
         # PUT YOUR CODE HERE  #
         #######################
 
+        self.compute_gradients()
+        self.apply_gradients(flags)
+
+        ########################
+        # END OF YOUR CODE    #
+        #######################
+
+        return
+
+    def compute_gradients(self, accumulate=False):
+        """
+        Backpropagates the delta_out cached by the last call to loss into the gradient
+        buffers (self.parameters.grads, or dW/db of each layer). Parameters are not updated.
+
+        Args:
+          accumulate: if True, the gradients are added to the current buffer contents
+                      instead of overwriting them.
+        """
         # delta_out computes in loss function
         deltas = [self.delta_out]
-        flags['weight_decay'] = self.weight_decay
+        ws = self._workspaces.get(self._batch_major(self.delta_out).shape[0]) if self.workspace else None
 
         # Compute deltas
         # loop backward through layers K --> 1 (not input layer 0)
         for k in list(range(len(self.layers)))[:0:-1]:
             # for lower layers
             # delta_{k-1} = [W_{k}.dot(delta_{k})] * dZ/dS_k
-            delta_k = (self.layers[k].W.T.dot(deltas[-1])) * self.layers[k - 1].activation_grad()
+            if ws is None:
+                delta_k = self.layers[k].backward_delta(deltas[0]) * self.layers[k - 1].activation_grad()
+            else:
+                delta_k = self.layers[k].backward_delta(deltas[0], out=ws.deltas[k - 1])
+                delta_k *= self.layers[k - 1].activation_grad(out=ws.masks[k - 1])
             deltas = [delta_k] + deltas
 
-            self._dump_training_stats('delta_{}_norm'.format(k), np.linalg.norm(delta_k))
+            self._dump_training_stats('delta_{}_norm'.format(k), lambda: np.linalg.norm(delta_k))
 
-        # Apply updates
-        [self.layers[k].backward(deltas[k], flags) for k in range(len(self.layers))]
+        # Compute gradients
+        [self.layers[k].backward(deltas[k], accumulate=accumulate) for k in range(len(self.layers))]
 
         # clear
         self.delta_out = None
 
-        ########################
-        # END OF YOUR CODE    #
-        #######################
+    def apply_gradients(self, flags):
+        """
+        Updates the parameters with the current contents of the gradient buffers,
+        using flags['optimizer'] (see train_step) and optional global norm clipping.
 
-        return
+        Args:
+          flags: contains necessary parameters for optimization.
+        """
+        store = self.parameters
+
+        # pruned weights get no gradient (see pruning_numpy)
+        for layer in self.layers:
+            if layer.mask is not None:
+                layer.dW *= layer.mask
+
+        # Debugging, exploding gradients are reported by the collector's thresholds
+        for layer in self.layers:
+            self._dump_training_stats('dW_{}_norm'.format(layer.k), lambda: np.linalg.norm(layer.dW))
+            self._dump_training_stats('db_{}_norm'.format(layer.k), lambda: np.linalg.norm(layer.db))
+        self._dump_training_stats('grad_norm', store.grad_norm)
+
+        if flags.get('max_grad_norm'):
+            store.clip_gradients(flags['max_grad_norm'])
+
+        # Apply updates, one vectorized update for all weights and one for all biases
+        self._get_optimizer(flags).apply([store.weights, store.biases],
+                                         [store.weight_grads, store.bias_grads],
+                                         [self.weight_decay, 0.])
+
+        # momentum and Adam state from before pruning still moves the pruned weights, they are
+        # zeroed again after every update
+        for layer in self.layers:
+            if layer.mask is not None:
+                layer.W *= layer.mask
+            if layer.W_sparse is not None:
+                layer.refresh_sparse()
+
+        self.stats.step += 1
+
+    def train_batch(self, x, labels, flags):
+        """
+        Performs inference, loss and one training step on a batch. If flags['micro_batch_size']
+        is set, the batch is processed in micro-batches of that size whose gradients are
+        accumulated before a single update, so activation memory only depends on the
+        micro-batch size while the update equals the one of the full batch.
+
+        Args:
+          x: float array of size [batch_size, ...], flattened per datapoint, or a scipy.sparse matrix.
+          labels: one-hot 2D array or 1D array of class indices, see loss.
+          flags: contains necessary parameters for optimization, see train_step.
+        Returns:
+          loss: scalar float, full loss of the batch before the update
+          accuracy: scalar float, accuracy of the batch before the update
+        """
+        if issparse(x):
+            # COO and DIA matrices cannot be sliced by rows
+            x = x.tocsr()
+        batch_size = x.shape[0]
+        micro_batch_size = flags.get('micro_batch_size') or batch_size
+        nll = 0.
+        correct_preds = 0
+
+        for start in range(0, batch_size, micro_batch_size):
+            micro_nll, micro_correct_preds = self.accumulate_gradients(x[start:start + micro_batch_size],
+                                                                       labels[start:start + micro_batch_size],
+                                                                       batch_size, accumulate=start > 0)
+            nll += micro_nll
+            correct_preds += micro_correct_preds
+
+        loss, accuracy = self._record_batch(nll, correct_preds, batch_size)
+        self.apply_gradients(flags)
+
+        return loss, accuracy
+
+    def partial_fit(self, x, labels, flags=None, batch_size=None):
+        """
+        Trains on one chunk of data, e.g. read from a memory-mapped or sharded file, in a single
+        pass of mini-batches of batch_size datapoints. Only one mini-batch at a time is converted
+        to self.dtype. Parameters, step count and optimizer state live in the model, so consecutive
+        calls continue the same training run; flags and batch_size default to the ones of the
+        previous call.
+
+        Args:
+          x: float array of size [n, ...], flattened per datapoint. May be memory-mapped or scipy.sparse.
+          labels: one-hot 2D array or 1D array of class indices, see loss.
+          flags: contains necessary parameters for optimization, see train_batch. Required on the first call.
+          batch_size: number of datapoints per update, defaults to the whole chunk.
+        Returns:
+          loss: scalar float, mean loss over the chunk, each batch before its update
+          accuracy: scalar float, accuracy over the chunk, each batch before its update
+        """
+        if flags is not None:
+            self._fit_flags = flags
+        if batch_size is not None:
+            self._fit_batch_size = batch_size
+        if self._fit_flags is None:
+            raise ValueError('partial_fit needs training flags on its first call.')
+
+        if issparse(x):
+            x = x.tocsr()
+        n = x.shape[0]
+        batch_size = self._fit_batch_size or n
+        loss = 0.
+        accuracy = 0.
+
+        for start in range(0, n, batch_size):
+            x_batch = x[start:start + batch_size]
+            batch_loss, batch_accuracy = self.train_batch(x_batch, labels[start:start + batch_size],
+                                                          self._fit_flags)
+            loss += batch_loss * x_batch.shape[0] / n
+            accuracy += batch_accuracy * x_batch.shape[0] / n
+
+        return loss, accuracy
+
+    def fit(self, chunks, flags=None, batch_size=None, max_steps=None):
+        """
+        Trains on a stream of (x, labels) chunks of any size, e.g. from iterate_chunks over
+        memory-mapped .npy files, a shard reader or a socket, calling partial_fit on each.
+        Training continues from the current state of the model, so fit can be called again
+        with the rest of a stream.
+
+        Args:
+          chunks: iterable of (x, labels) pairs, see partial_fit.
+          flags: see partial_fit.
+          batch_size: see partial_fit.
+          max_steps: optional, stop once the model has made this many updates in total
+                     (self.stats.step). Checked after every chunk.
+        Returns:
+          loss: scalar float, see partial_fit, of the last chunk
+          accuracy: scalar float, see partial_fit, of the last chunk
+        """
+        loss, accuracy = np.nan, np.nan
+        for x, labels in chunks:
+            if max_steps is not None and self.stats.step >= max_steps:
+                break
+            loss, accuracy = self.partial_fit(x, labels, flags=flags, batch_size=batch_size)
+        return loss, accuracy
+
+    def accumulate_gradients(self, x, labels, batch_size, accumulate=True):
+        """
+        Runs inference, loss and backpropagation on a part of a batch. The gradients are
+        weighted by the part's share of the batch, so the sum over all parts equals the
+        gradient of the mean loss over the batch.
+
+        Args:
+          x: float array of size [n, ...], flattened per datapoint.
+          labels: one-hot 2D array or 1D array of class indices, see loss.
+          batch_size: size of the whole batch.
+          accumulate: add to the current gradients instead of overwriting them.
+        Returns:
+          nll: cross-entropy summed over the part
+          correct_preds: number of correct predictions in the part
+        """
+        n = x.shape[0]
+        logits = self.inference(x)
+        correct_preds = self._count_correct(logits, labels)
+        nll = self._data_loss(logits, labels)
+
+        # delta_out is the mean over the part, reweight it to the mean over the batch
+        self.delta_out *= n / batch_size
+        self.compute_gradients(accumulate=accumulate)
+
+        return nll, correct_preds
+
+    def _record_batch(self, nll, correct_preds, batch_size):
+        """
+        Turns the summed cross-entropy and correct count of a training batch into its loss
+        and accuracy, and records them.
+        """
+        nl_prior = (1. / batch_size) * self._weight_complexity_cost()
+        nl_likelihood = (1. / batch_size) * nll
+        loss = nl_likelihood + self.weight_decay * nl_prior
+        accuracy = correct_preds / batch_size
+
+        self._dump_training_stats('nl_likelihood', nl_likelihood)
+        self._dump_training_stats('nl_prior', nl_prior)
+        self._dump_training_stats('accuracy', accuracy)
+
+        return loss, accuracy
 
     def accuracy(self, logits, labels):
         """
@@ -242,7 +517,8 @@ class MLP(object):
           logits: 2D float array of size [batch_size, self.n_classes].
                        The predictions returned through self.inference.
           labels: 2D int array of size [batch_size, self.n_classes]
-                     with one-hot encoding. Ground truth labels for
+                     with one-hot encoding, or 1D int array of size [batch_size]
+                     with class indices. Ground truth labels for
                      each sample in the batch.
         Returns:
           accuracy: scalar float, the accuracy of predictions,
@@ -254,19 +530,7 @@ class MLP(object):
         #######################
 
         batch_size = logits.shape[0]
-        class_preds = np.zeros_like(logits)
-
-        # top predicted class per datapoint in minibatch
-        top_class = np.argmax(logits, axis=1)
-
-        # create one-hot matrix of predicted class
-        class_preds[np.arange(batch_size), top_class] = 1.
-
-        # correct predictions
-        correct_preds = class_preds * labels
-
-        # total number of correct preds: sum of values in matrix
-        accuracy = correct_preds.sum() / batch_size
+        accuracy = self._count_correct(logits, labels) / batch_size
 
         self._dump_training_stats('accuracy', accuracy)
 
@@ -276,28 +540,201 @@ class MLP(object):
 
         return accuracy
 
+    def predict(self, x, batch_size=1000):
+        """
+        Computes logits for a dataset of arbitrary size, batch_size datapoints at a time.
+        Unlike inference, no activations or other backprop caches are kept, so peak
+        memory only depends on batch_size.
+
+        Args:
+          x: float array of size [n_datapoints, ...], flattened per datapoint. May be memory-mapped or scipy.sparse.
+          batch_size: number of datapoints per forward pass.
+        Returns:
+          logits: 2D float array of size [n_datapoints, self.n_classes]
+        """
+        logits = np.empty((x.shape[0], self.n_classes), dtype=self.dtype)
+        for start, logits_chunk in self._stream_logits(x, batch_size):
+            logits[start:start + logits_chunk.shape[0]] = logits_chunk
+        return logits
+
+    def evaluate(self, x, labels, batch_size=1000, stats_prefix='test_'):
+        """
+        Computes the loss and accuracy on a dataset of arbitrary size, batch_size datapoints
+        at a time, accumulating both incrementally. No backprop caches are kept.
+
+        Args:
+          x: float array of size [n_datapoints, ...], flattened per datapoint. May be memory-mapped or scipy.sparse.
+          labels: one-hot 2D array or 1D array of class indices, see loss.
+          batch_size: number of datapoints per forward pass.
+          stats_prefix: prefix of the recorded accuracy/nl_likelihood/nl_prior stats, None to not record.
+        Returns:
+          loss: scalar float, full loss = cross_entropy + reg_loss
+          accuracy: scalar float
+        """
+        n_datapoints = x.shape[0]
+        nll = 0.
+        correct_preds = 0
+
+        for start, logits in self._stream_logits(x, batch_size):
+            y = labels[start:start + logits.shape[0]]
+            correct_preds += self._count_correct(logits, y)
+            if y.ndim == 1:
+                # logits are scratch here, the gradient may overwrite them
+                nll += self._sparse_softmax_cross_entropy(logits, y, out=logits)[0]
+            else:
+                nll += self._cross_entropy_loss(self._softmax2D(logits, out=logits), y)
+
+        nl_prior = (1. / n_datapoints) * self._weight_complexity_cost()
+        nl_likelihood = (1. / n_datapoints) * nll
+        loss = nl_likelihood + self.weight_decay * nl_prior
+        accuracy = correct_preds / n_datapoints
+
+        if stats_prefix is not None:
+            self.stats.record(stats_prefix + 'nl_likelihood', nl_likelihood)
+            self.stats.record(stats_prefix + 'nl_prior', nl_prior)
+            self.stats.record(stats_prefix + 'accuracy', accuracy)
+
+        return loss, accuracy
+
+    def _stream_logits(self, x, batch_size):
+        """
+        Yields (start index, logits) per chunk of x. The logits are a view into
+        buffers that are reused for the next chunk.
+        """
+        # one flat buffer per layer, reshaped to a contiguous [D_k, n] (or [n, D_k]) array for a chunk of n
+        buffers = [np.empty(layer.n_out * batch_size, dtype=self.dtype) for layer in self.layers]
+        if issparse(x):
+            x = x.tocsr()
+
+        for start in range(0, x.shape[0], batch_size):
+            Z = self._as_input(x[start:start + batch_size])
+            n = Z.shape[0]
+            Z = self._batch_major(Z)
+            shape = (n, -1) if self.batch_major else (-1, n)
+
+            for layer, buffer in zip(self.layers, buffers):
+                Z = layer.predict(Z, out=buffer[:layer.n_out * n].reshape(shape))
+
+            yield start, self._batch_major(Z)
+
+    def _count_correct(self, logits, labels):
+        """
+        Number of datapoints whose highest logit is the true class.
+        """
+        top_class = np.argmax(logits, axis=1)
+        if labels.ndim == 1:
+            return np.count_nonzero(top_class == labels)
+        return labels[np.arange(logits.shape[0]), top_class].sum()
+
+    def _get_optimizer(self, flags):
+        """
+        Returns flags['optimizer'], or a persistent SGD optimizer with flags['learning_rate'].
+        """
+        if flags.get('optimizer') is not None:
+            return flags['optimizer']
+
+        if self._default_optimizer is None:
+            self._default_optimizer = SGD(learning_rate=flags['learning_rate'])
+        self._default_optimizer.learning_rate = flags['learning_rate']
+        return self._default_optimizer
+
+    def get_config(self):
+        """
+        Constructor arguments of the architecture, without the parameters.
+        """
+        return {'n_hidden': self.n_hidden, 'n_classes': self.n_classes, 'weight_decay': self.weight_decay,
+                'weight_scale': self.weight_scale, 'input_dim': self.input_dim, 'dtype': self.dtype.name,
+                'layout': self.layout}
+
+    def save(self, path):
+        """
+        Saves the parameters to path.npy, a single flat array, and the architecture to path.json.
+        The pruning masks of pruned layers (see pruning_numpy) are saved to path_masks.npz.
+        """
+        with open(path + '.json', 'w') as f:
+            json.dump(self.get_config(), f)
+        np.save(path + '.npy', self.parameters.params)
+
+        masks = {'mask_{}'.format(k): layer.mask for k, layer in enumerate(self.layers) if layer.mask is not None}
+        if masks:
+            np.savez(path + '_masks.npz', **masks)
+        elif os.path.exists(path + '_masks.npz'):
+            os.remove(path + '_masks.npz')
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', **kwargs):
+        """
+        Loads a model saved with save. By default the parameters are memory-mapped read-only,
+        which is enough for inference; use mmap_mode='c' or None to continue training. Pruning
+        masks saved with the model are restored, so pruned weights stay pruned.
+
+        :param path: path given to save, without extension
+        :param mmap_mode: passed to np.load
+        :param kwargs: further constructor arguments, e.g. workspace or stats
+        """
+        with open(path + '.json') as f:
+            config = json.load(f)
+        params = np.load(path + '.npy', mmap_mode=mmap_mode)
+        net = cls(params=params, **dict(config, **kwargs))
+
+        if os.path.exists(path + '_masks.npz'):
+            masks = np.load(path + '_masks.npz')
+            for k, layer in enumerate(net.layers):
+                if 'mask_{}'.format(k) in masks:
+                    layer.mask = masks['mask_{}'.format(k)]
+        return net
+
     def _get_init_weight(self, shape, weight_scale):
-        return np.random.normal(scale=weight_scale, size=shape)
+        return np.random.normal(scale=weight_scale, size=shape).astype(self.dtype)
 
     def _get_init_bias(self, shape, epsilon=0.):
-        return np.zeros(shape=shape) + epsilon
+        return np.zeros(shape=shape, dtype=self.dtype) + epsilon
+
+    def _get_workspace(self, batch_size):
+        """
+        Returns the workspace for the given batch size, allocating it on first use.
+        Typically there are only two: one for the training batch size and one for evaluation.
+        """
+        if batch_size not in self._workspaces:
+            dims = [layer.n_out for layer in self.layers]
+            self._workspaces[batch_size] = Workspace(dims, batch_size, self.dtype, batch_major=self.batch_major)
+        return self._workspaces[batch_size]
 
-    def _softmax2D(self, logits):
+    def _as_input(self, x):
+        """
+        Converts a batch to a [batch_size, input_dim] array of self.dtype, or to a CSR matrix
+        of self.dtype if it is a scipy.sparse matrix. Sparse batches stay sparse, see Layer._linear.
+        """
+        if issparse(x):
+            return x.tocsr().astype(self.dtype, copy=False)
+        x = np.asarray(x, dtype=self.dtype)
+        return x.reshape(x.shape[0], -1)
+
+    def _batch_major(self, a):
+        """
+        Converts between batch-major arrays [batch_size, D] and the activation layout of the
+        network: a transposed view in dimension-first layout, a itself in batch-major layout.
+        """
+        return a if self.batch_major else a.T
+
+    def _softmax2D(self, logits, out=None):
         """
         Performs a softmax transformation over logits. Maximum normalization is used for numerical stability (equivalent to log-sum-exp)
 
-        :param logits: output of final (hidden) layer [n_classes, batch_size]
+        :param logits: output of final (hidden) layer [batch_size, n_classes]
+        :param out: optional array of the same shape as logits to write the probabilities into
 
-        :return: class probabilities [n_classes, batch_size]
+        :return: class probabilities [batch_size, n_classes]
         """
 
         # subtract maximum logit per mini-batch for numerical stability
         max_per_class = np.max(logits, axis=1, keepdims=True)
-        e = np.exp(logits - max_per_class)
+        e = np.subtract(logits, max_per_class, out=out)
+        np.exp(e, out=e)
 
         normalizer = e.sum(axis=1, keepdims=True)
-        probs = e / normalizer
-        return probs
+        e /= normalizer
+        return e
 
     def _weight_complexity_cost(self):
         """
@@ -307,7 +744,8 @@ class MLP(object):
 
         :return: scalar complexity cost
         """
-        return sum([layer.nlog_prior() for layer in self.layers])
+        weights = self.parameters.weights
+        return 0.5 * np.dot(weights, weights)
 
     def _cross_entropy_loss(self, pred_class_probs, labels):
         """
@@ -335,33 +773,107 @@ class MLP(object):
 
         return loss
 
+    def _data_loss(self, logits, labels):
+        """
+        Computes the cross-entropy summed over the batch and caches delta_out,
+        the gradient of its mean w.r.t. the logits.
+
+        :param logits: 2D float array of size [batch_size, self.n_classes]
+        :param labels: one-hot 2D array or 1D array of class indices
+        :return: cross-entropy loss summed over the batch, scalar float
+        """
+        batch_size = logits.shape[0]
+        ws = self._workspaces.get(batch_size) if self.workspace else None
+        self.logits = logits
+
+        if labels.ndim == 1:
+            # integer labels: softmax, loss and gradient in a single pass, no class_probs kept
+            nll, dL_dS = self._sparse_softmax_cross_entropy(logits, labels,
+                                                            out=None if ws is None else self._batch_major(ws.deltas[-1]))
+            self.class_probs = None
+        else:
+            class_probs = self._softmax2D(logits, out=None if ws is None else self._batch_major(ws.probs))
+            self.class_probs = class_probs
+            nll = self._cross_entropy_loss(class_probs, labels)
+            dL_dS = np.subtract(class_probs, labels, out=None if ws is None else self._batch_major(ws.deltas[-1]))
+
+        # Caching
+        # delta_out = dL/dY_out * dY_out/dS_out
+        self.delta_out = self._batch_major(dL_dS)
+        self.delta_out *= (1. / batch_size)
+
+        return nll
+
+    def _sparse_softmax_cross_entropy(self, logits, labels, out=None):
+        """
+        Fused softmax cross-entropy for integer class labels. The loss is computed from the
+        log-softmax of the true class only, log q(y_c) = s_c - max(s) - log sum_k exp(s_k - max(s)),
+        and the gradient softmax(s) - onehot(c) is written in place of the exponentials,
+        so no one-hot or batch_size x n_classes temporary is created besides the gradient itself.
+
+        :param logits: 2D float array of size [batch_size, self.n_classes]
+        :param labels: true class indices, 1D int array [batch_size]
+        :param out: optional array of the same shape as logits to write the gradient into
+
+        :return: cross-entropy loss summed over the batch, gradient w.r.t. the logits (not divided by batch_size)
+        """
+        rows = np.arange(logits.shape[0])
+        max_logit = np.max(logits, axis=1)
+        true_logit = logits[rows, labels]
+
+        e = np.subtract(logits, max_logit[:, np.newaxis], out=out)
+        np.exp(e, out=e)
+        normalizer = e.sum(axis=1)
+
+        loss = (np.log(normalizer) + max_logit - true_logit).sum()
+
+        e /= normalizer[:, np.newaxis]
+        e[rows, labels] -= 1.
+
+        return loss, e
+
     def _dump_training_stats(self, name, value):
+        """
+        Forwards a metric to the stats collector. Pass expensive values as callables,
+        they are only evaluated if the collector samples the metric.
+        """
         if self.training_mode:
-            self.debug_stats[name] += [value]
+            self.stats.record(name, value)
         elif name in ['accuracy', 'nl_likelihood', 'nl_prior']:
-            self.debug_stats['test_' + name] += [value]
+            self.stats.record('test_' + name, value)
 
     def __repr__(self):
         sep = '\n|' + '--' * 15 + '\n|\t'
 
-        defs = ['X : input_dim x batch_size'] + [str(layer) for layer in self.layers] + [
-            'Y : {} x batch_size'.format(self.n_classes)]
+        dims = ['input_dim', str(self.n_classes)]
+        if self.batch_major:
+            defs = ['X : batch_size x {}'.format(dims[0])] + [str(layer) for layer in self.layers] + [
+                'Y : batch_size x {}'.format(dims[1])]
+        else:
+            defs = ['X : {} x batch_size'.format(dims[0])] + [str(layer) for layer in self.layers] + [
+                'Y : {} x batch_size'.format(dims[1])]
 
         return sep.join(['|\tNetwork Overview'] + defs) + '\n' + '--' * 15
 
     def plot_stats(self):
         """
-        Generates plots
+        Generates plots from the stats collector. Samples are plotted against the training step.
         :return:
         """
+        # imported here, matplotlib takes longer to import than the whole NumPy pipeline
+        from matplotlib import pyplot as plt
+
         # sns.set_context("notebook", font_scale=2.5, rc={"lines.linewidth": 2.5})
         # sns.set_style("whitegrid")
 
+        def plot(name, label=None):
+            steps, values = self.stats.get(name)
+            plt.plot(steps, values, label=label or name)
+
         plt.figure(figsize=(10, 10))
         plt.title('Delta Norms')
         for i in range(len(self.layers)):
-            name = 'delta_{}_norm'.format(i)
-            plt.plot(self.debug_stats[name], label=name)
+            plot('delta_{}_norm'.format(i))
         plt.legend()
         plt.tight_layout()
         plt.savefig('./figs/mlp_delta_norms.pdf')
@@ -370,11 +882,8 @@ class MLP(object):
         plt.figure(figsize=(10, 10))
         plt.title('Grad Norms')
         for i in range(len(self.layers)):
-            name = 'dW_{}_norm'.format(i)
-            plt.plot(self.debug_stats[name], label=name)
-
-            name = 'db_{}_norm'.format(i)
-            plt.plot(self.debug_stats[name], label=name)
+            plot('dW_{}_norm'.format(i))
+            plot('db_{}_norm'.format(i))
         plt.legend()
 
         plt.tight_layout()
@@ -383,7 +892,7 @@ class MLP(object):
 
         plt.figure(figsize=(10, 10))
         plt.title('Logit norms')
-        plt.plot(self.debug_stats['logits_norm'], label='logits_norm')
+        plot('logits_norm')
         plt.legend()
         plt.tight_layout()
         plt.savefig('./figs/mlp_logit_norms.pdf')
@@ -391,11 +900,8 @@ class MLP(object):
 
         plt.figure(figsize=(10, 10))
         plt.title('Train and test negative log likelihood')
-        plt.plot(self.debug_stats['nl_likelihood'], label='Train NLL')
-        num_eps = len(self.debug_stats['nl_prior'])
-        num_reports = len(self.debug_stats['test_nl_prior'])
-        x_interp = np.arange(num_reports) * num_eps / num_reports
-        plt.plot(x_interp, self.debug_stats['test_nl_likelihood'], label='Test NLL')
+        plot('nl_likelihood', 'Train NLL')
+        plot('test_nl_likelihood', 'Test NLL')
         plt.legend()
         plt.tight_layout()
         plt.savefig('./figs/mlp_losses_nll.pdf')
@@ -403,11 +909,8 @@ class MLP(object):
 
         plt.figure(figsize=(10, 10))
         plt.title('Train and test negative log prior')
-        plt.plot(self.debug_stats['nl_prior'], label='Train NLP')
-        num_eps = len(self.debug_stats['nl_prior'])
-        num_reports = len(self.debug_stats['test_nl_prior'])
-        x_interp = np.arange(num_reports) * num_eps / num_reports
-        plt.plot(x_interp, self.debug_stats['test_nl_prior'], label='Test NLP')
+        plot('nl_prior', 'Train NLP')
+        plot('test_nl_prior', 'Test NLP')
         plt.legend()
         plt.tight_layout()
         plt.savefig('./figs/mlp_losses_nlp.pdf')
@@ -415,68 +918,220 @@ class MLP(object):
 
         plt.figure(figsize=(10, 10))
         plt.title('Train and test accuracy')
-        plt.plot(self.debug_stats['accuracy'], label='Train Accuracy')
-
-        num_eps = len(self.debug_stats['accuracy'])
-        num_reports = len(self.debug_stats['test_accuracy'])
-        x_interp = np.arange(num_reports) * num_eps / num_reports
-
-        plt.plot(x_interp, self.debug_stats['test_accuracy'], label='Test Accuracy')
+        plot('accuracy', 'Train Accuracy')
+        plot('test_accuracy', 'Test Accuracy')
         plt.legend()
         plt.tight_layout()
         plt.savefig('./figs/mlp_accuracy.pdf')
         plt.close()
 
 
+class ParameterStore(object):
+    """
+    All weights and biases of the network in one contiguous buffer, all weights first,
+    and a gradient buffer with the same layout. Layers only hold views into both, so
+    decay, updates, clipping and norms over all parameters are single vectorized ops.
+    """
+
+    def __init__(self, W_shapes, bias_shapes, dtype, params=None, grads=None):
+        """
+        :param W_shapes: shape of the weight matrix of each layer
+        :param bias_shapes: shape of the bias vector of each layer
+        :param dtype: floating point type of the buffers
+        :param params: optional existing flat parameter array with this layout
+        :param grads: optional existing flat gradient array with this layout
+        """
+        sizes = [int(np.prod(shape)) for shape in W_shapes + bias_shapes]
+        offsets = np.cumsum([0] + sizes)
+        self.n_weights = int(offsets[len(W_shapes)])
+
+        if params is None:
+            params = np.zeros(offsets[-1], dtype=dtype)
+        assert params.shape == (offsets[-1],) and params.dtype == dtype, \
+            'expected {} parameters of type {}, got {} {}'.format(offsets[-1], dtype, params.shape, params.dtype)
+
+        self.params = params
+        self.grads = np.zeros_like(params, subok=False) if grads is None else grads
+        assert self.grads.shape == params.shape and self.grads.dtype == params.dtype
+
+        def views(buffer, shapes, offsets):
+            return [buffer[o:o + int(np.prod(shape))].reshape(shape) for shape, o in zip(shapes, offsets)]
+
+        n_layers = len(W_shapes)
+        self.W = views(self.params, W_shapes, offsets[:n_layers])
+        self.b = views(self.params, bias_shapes, offsets[n_layers:])
+        self.dW = views(self.grads, W_shapes, offsets[:n_layers])
+        self.db = views(self.grads, bias_shapes, offsets[n_layers:])
+
+    @property
+    def weights(self):
+        return self.params[:self.n_weights]
+
+    @property
+    def biases(self):
+        return self.params[self.n_weights:]
+
+    @property
+    def weight_grads(self):
+        return self.grads[:self.n_weights]
+
+    @property
+    def bias_grads(self):
+        return self.grads[self.n_weights:]
+
+    def grad_norm(self):
+        return np.linalg.norm(self.grads)
+
+    def clip_gradients(self, max_norm):
+        """
+        Rescales all gradients together if their global L2 norm exceeds max_norm.
+
+        :return: the norm before clipping
+        """
+        norm = self.grad_norm()
+        if norm > max_norm:
+            self.grads *= max_norm / norm
+        return norm
+
+
+class Workspace(object):
+    """
+    Preallocated buffers for one batch size, in dimension-first layout [D_k, batch_size]
+    or in batch-major layout [batch_size, D_k]. Arrays returned by inference/loss in workspace mode are views into these buffers and
+    are overwritten by the next pass with the same batch size.
+    """
+
+    def __init__(self, layer_dims, batch_size, dtype, batch_major=False):
+        """
+        :param layer_dims: output dimension of each layer, the last one being n_classes
+        :param batch_size: number of datapoints per pass
+        :param dtype: floating point type of the buffers
+        :param batch_major: allocate [batch_size, D_k] instead of [D_k, batch_size] buffers
+        """
+        self.batch_size = batch_size
+
+        def shape(d):
+            return (batch_size, d) if batch_major else (d, batch_size)
+
+        # pre-activations, activations, relu masks and deltas per layer
+        self.S = [np.empty(shape(d), dtype=dtype) for d in layer_dims]
+        self.Z = [np.empty(shape(d), dtype=dtype) for d in layer_dims[:-1]] + [None]
+        self.masks = [np.empty(shape(d), dtype=bool) for d in layer_dims[:-1]]
+        self.deltas = [np.empty(shape(d), dtype=dtype) for d in layer_dims]
+
+        # softmax output
+        self.probs = np.empty(shape(layer_dims[-1]), dtype=dtype)
+
+
 class Layer(object):
     """
     A layer object that handles feed-forward and back propagation ops."""
 
-    def __init__(self, W, b, activation, k, parent):
+    def __init__(self, W, b, activation, k, parent, batch_major=False):
         self.W = W
         self.b = b
         self.activation_fn = activation
         self.k = k
 
+        # W is [n_out, n_in] in dimension-first layout, [n_in, n_out] in batch-major layout
+        self.batch_major = batch_major
+        self.n_in, self.n_out = W.shape if batch_major else W.shape[::-1]
+
+        # gradient buffers, views into the parent's ParameterStore
+        self.dW = None
+        self.db = None
+
+        # pruning mask and CSR copy of W for sparse execution, see pruning_numpy
+        self.mask = None
+        self.W_sparse = None
+        self._sparse_index = None
+
         self.S_k = None
         self.Z_k = None
         self.Z_in = None
         self.parent = parent
 
-    def forward(self, Z):
-        assert Z.shape[0] == self.W.shape[1]
+    def forward(self, Z, S_out=None, Z_out=None):
+        assert Z.shape[1 if self.batch_major else 0] == self.n_in
 
         self.Z_in = Z
-        self.S_k = np.dot(self.W, Z) + self.b
-        self.Z_k = self.activation_fn(self.S_k)
+        self.S_k = self._linear(Z, out=S_out)
+        self.S_k += self.b
+        self.Z_k = self.activation_fn(self.S_k, out=Z_out)
 
         return self.Z_k, self.S_k
 
-    def backward(self, delta, flags):
-        # compute gradients
-        dL_dW = (delta.dot(self.Z_in.T) + flags['weight_decay'] * self.W)
-        dL_db = delta.sum(axis=1, keepdims=True)
-
-        # Gradient clipping
-        # dL_dW = np.clip(dL_dW, -1., 1.)
-        # dL_db = np.clip(dL_db, -1., 1.)
+    def predict(self, Z, out=None):
+        """
+        Forward pass without caching, activations are computed in place on top of the pre-activations.
+        """
+        S = self._linear(Z, out=out)
+        S += self.b
+        return self.activation_fn(S, out=S)
 
-        # apply updates
-        self.W -= flags['learning_rate'] * dL_dW
-        self.b -= flags['learning_rate'] * dL_db
+    def _linear(self, Z, out=None):
+        """
+        W Z in dimension-first layout, Z W in batch-major layout, as a CSR product if the layer
+        runs sparse (out is then ignored).
 
-        # Debugging
-        dL_dW_norm = np.linalg.norm(dL_dW)
-        dL_db_norm = np.linalg.norm(dL_db)
-        self.parent._dump_training_stats('dW_{}_norm'.format(self.k), dL_dW_norm)
-        self.parent._dump_training_stats('db_{}_norm'.format(self.k), dL_db_norm)
+        Z may also be a sparse input batch (first layer only): a CSR matrix [batch_size, n_in] in
+        batch-major layout, its CSC transpose in dimension-first layout. The product is then
+        computed by scipy as sparse x dense without densifying Z, and out is ignored.
+        """
+        if issparse(Z):
+            W = self.W if self.W_sparse is None else self.W_sparse
+            # dimension-first: W Z = (Z^T W^T)^T with Z^T the CSR batch
+            S = Z.dot(W) if self.batch_major else Z.T.dot(W.T).T
+            return S.toarray() if issparse(S) else S
+        if self.W_sparse is not None:
+            # dense x CSR is computed by scipy as (CSR^T x dense^T)^T
+            return self.W_sparse.T.dot(Z.T).T if self.batch_major else self.W_sparse.dot(Z)
+        return np.dot(Z, self.W, out=out) if self.batch_major else np.dot(self.W, Z, out=out)
+
+    def refresh_sparse(self):
+        """
+        Copies the current values of the unpruned weights into the CSR matrix used by
+        forward. The sparsity pattern is fixed by the mask, so this is a single gather.
+        """
+        np.take(self.W.ravel(), self._sparse_index, out=self.W_sparse.data)
 
-        if dL_dW_norm > 100:
-            print('dW exploding at layer {}'.format(self.k))
-        if dL_db_norm > 100:
-            print('db exploding at layer {}'.format(self.k))
+    def backward(self, delta, accumulate=False):
+        """
+        Computes the gradients of the data loss w.r.t. W and b into self.dW and self.db,
+        or adds them to the current contents if accumulate is True.
+        Weight decay and the update itself are left to the optimizer.
+        """
+        # dimension-first: dW = delta Z_in^T, batch-major: dW = Z_in^T delta
+        batch_axis = 0 if self.batch_major else 1
+        if accumulate:
+            self.dW += self._weight_grad(delta)
+            self.db += np.sum(delta, axis=batch_axis, keepdims=True)
+        else:
+            self._weight_grad(delta, out=self.dW)
+            np.sum(delta, axis=batch_axis, keepdims=True, out=self.db)
+
+    def _weight_grad(self, delta, out=None):
+        if issparse(self.Z_in):
+            # sparse x dense products, dW only has nonzero entries for the features present in the batch
+            grad = self.Z_in.T.dot(delta) if self.batch_major else self.Z_in.dot(delta.T).T
+            if out is None:
+                return grad
+            out[...] = grad
+            return out
+        if self.batch_major:
+            return np.dot(self.Z_in.T, delta, out=out)
+        return np.dot(delta, self.Z_in.T, out=out)
+
+    def backward_delta(self, delta, out=None):
+        """
+        Propagates the delta of this layer to its input, before the activation gradient
+        of the layer below: W^T delta in dimension-first layout, delta W^T in batch-major layout.
+        """
+        if self.batch_major:
+            return np.dot(delta, self.W.T, out=out)
+        return np.dot(self.W.T, delta, out=out)
 
-    def activation_grad(self):
+    def activation_grad(self, out=None):
         """
         Computes the gradient of the relu activation
 
@@ -484,10 +1139,10 @@ class Layer(object):
                 1 if Xij > 0
                 0 else
 
-        :param X: a
-        :return:
+        :param out: optional boolean array to write the mask into
+        :return: boolean mask, multiplies like a 0/1 array
         """
-        return np.where(self.S_k > 0, 1, 0)
+        return np.greater(self.S_k, 0, out=out)
 
     def nlog_prior(self):
         """
@@ -498,6 +1153,7 @@ class Layer(object):
 
     # keras style printing
     def __repr__(self):
-        return "W_{} : {} x {}, f: {}\n|\tZ_{} : {} x batch_size".format(self.k, *self.W.shape,
-                                                                         self.activation_fn.__name__,
-                                                                         self.k, self.W.shape[0])
+        Z_shape = 'batch_size x {}' if self.batch_major else '{} x batch_size'
+        return ("W_{} : {} x {}, f: {}\n|\tZ_{} : " + Z_shape).format(self.k, *self.W.shape,
+                                                                   self.activation_fn.__name__,
+                                                                   self.k, self.n_out)
@@ -0,0 +1,152 @@
+"""
+This module implements first-order optimizers for the NumPy MLP.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class Optimizer(object):
+    """
+    Base class of the optimizers. Per-parameter state is allocated on the first call to
+    apply and every later update is done in place, using two scratch buffers shared by
+    all parameters. Gradients are never modified.
+    """
+
+    def __init__(self, learning_rate):
+        """
+        :param learning_rate: scalar, or an array broadcasting against the parameters,
+                              e.g. one learning rate per model of an MLPEnsemble
+        """
+        self.learning_rate = learning_rate
+        self.iterations = 0
+
+        self._state = None
+        self._scratch = None
+
+    def apply(self, params, grads, weight_decays=None):
+        """
+        Performs one update step of all parameters in place.
+
+        :param params: list of parameter arrays, in the same order on every call
+        :param grads: list of gradients of the data loss w.r.t. params
+        :param weight_decays: optional list of L2 strengths per parameter, added to the gradients as decay * param.
+                              Like the learning rate, each may be an array broadcasting against its parameter.
+        """
+        if weight_decays is None:
+            weight_decays = [0.] * len(params)
+
+        if self._state is None:
+            self._state = [self._init_state(param) for param in params]
+            size = max(param.size for param in params)
+            dtype = np.result_type(*params)
+            self._scratch = np.empty(size, dtype=dtype), np.empty(size, dtype=dtype)
+
+        self.iterations += 1
+
+        for param, grad, decay, state in zip(params, grads, weight_decays, self._state):
+            grad_buffer, tmp = [buffer[:param.size].reshape(param.shape) for buffer in self._scratch]
+
+            # gradient of the full loss, data + decay * 0.5 * ||param||^2
+            if np.any(decay):
+                grad = np.add(np.multiply(param, decay, out=grad_buffer), grad, out=grad_buffer)
+            self._update(param, grad, state, tmp)
+
+    def _init_state(self, param):
+        return ()
+
+    def _update(self, param, grad, state, tmp):
+        raise NotImplementedError
+
+
+class SGD(Optimizer):
+    """
+    Plain stochastic gradient descent: param -= lr * grad
+    """
+
+    def _update(self, param, grad, state, tmp):
+        np.multiply(grad, self.learning_rate, out=tmp)
+        param -= tmp
+
+
+class Momentum(Optimizer):
+    """
+    SGD with (heavy ball) momentum: v = mu * v + grad, param -= lr * v
+    """
+
+    def __init__(self, learning_rate, momentum=0.9):
+        super(Momentum, self).__init__(learning_rate)
+        self.momentum = momentum
+
+    def _init_state(self, param):
+        return np.zeros_like(param),
+
+    def _update(self, param, grad, state, tmp):
+        velocity, = state
+        velocity *= self.momentum
+        velocity += grad
+
+        np.multiply(velocity, self.learning_rate, out=tmp)
+        param -= tmp
+
+
+class Nesterov(Momentum):
+    """
+    SGD with Nesterov momentum: v = mu * v + grad, param -= lr * (grad + mu * v)
+    """
+
+    def _update(self, param, grad, state, tmp):
+        velocity, = state
+        velocity *= self.momentum
+        velocity += grad
+
+        np.multiply(grad, self.learning_rate, out=tmp)
+        param -= tmp
+        np.multiply(velocity, self.learning_rate * self.momentum, out=tmp)
+        param -= tmp
+
+
+class Adam(Optimizer):
+    """
+    Adam (Kingma & Ba, 2014) with bias correction folded into the step size.
+    """
+
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        super(Adam, self).__init__(learning_rate)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def _init_state(self, param):
+        return np.zeros_like(param), np.zeros_like(param)
+
+    def _update(self, param, grad, state, tmp):
+        m, v = state
+        t = self.iterations
+        step_size = self.learning_rate * np.sqrt(1. - self.beta2 ** t) / (1. - self.beta1 ** t)
+
+        # m = beta1 * m + (1 - beta1) * grad
+        m *= self.beta1
+        np.multiply(grad, 1. - self.beta1, out=tmp)
+        m += tmp
+
+        # v = beta2 * v + (1 - beta2) * grad^2
+        v *= self.beta2
+        np.square(grad, out=tmp)
+        tmp *= 1. - self.beta2
+        v += tmp
+
+        # param -= step_size * m / (sqrt(v) + eps)
+        np.sqrt(v, out=tmp)
+        tmp += self.epsilon
+        np.divide(m, tmp, out=tmp)
+        tmp *= step_size
+        param -= tmp
+
+
+OPTIMIZER_DICT = {'sgd': SGD,
+                  'momentum': Momentum,
+                  'nesterov': Nesterov,
+                  'adam': Adam}
@@ -0,0 +1,112 @@
+"""
+This module implements magnitude pruning of the NumPy MLP and sparse (CSR) execution of pruned layers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# Below this fraction of nonzero weights a layer runs its forward pass as a CSR product.
+# See `benchmark_mlp_numpy.py pruning` for the crossover on a given machine.
+SPARSE_DENSITY_THRESHOLD_DEFAULT = 0.05
+
+
+def magnitude_prune(net, sparsity, scope='global', layers=None):
+    """
+    Sets the smallest-magnitude weights to zero and keeps them there during further
+    training: each pruned layer gets a boolean mask that MLP.apply_gradients applies to
+    its weight gradients and, against optimizer state from before pruning, to its weights
+    after every update. Biases are not pruned. Pruning is cumulative, weights that are
+    already masked stay masked.
+
+    Args:
+      net: MLP
+      sparsity: target fraction of zero weights, in [0, 1)
+      scope: 'global' ranks all weights of the selected layers together, 'layer' prunes
+             every selected layer to the target sparsity on its own.
+      layers: optional list of layer indices to prune, defaults to all layers.
+    Returns:
+      list of the density (fraction of nonzero weights) of every layer
+    """
+    if not 0. <= sparsity < 1.:
+        raise ValueError('Sparsity should be in [0, 1). Received: {}.'.format(sparsity))
+    if scope not in ['global', 'layer']:
+        raise ValueError("Scope should be 'global' or 'layer'. Received: {}.".format(scope))
+
+    selected = [net.layers[k] for k in (range(len(net.layers)) if layers is None else layers)]
+
+    if scope == 'global':
+        magnitudes = np.concatenate([np.abs(layer.W).ravel() for layer in selected])
+        thresholds = [_magnitude_threshold(magnitudes, sparsity)] * len(selected)
+    else:
+        thresholds = [_magnitude_threshold(np.abs(layer.W).ravel(), sparsity) for layer in selected]
+
+    for layer, threshold in zip(selected, thresholds):
+        mask = np.abs(layer.W) > threshold
+        if layer.mask is not None:
+            mask &= layer.mask
+        layer.mask = mask
+        layer.W *= mask
+        if layer.W_sparse is not None:
+            _build_sparse(layer)
+
+    return densities(net)
+
+
+def densities(net):
+    """
+    Fraction of nonzero weights of every layer.
+    """
+    return [float(np.count_nonzero(layer.W)) / layer.W.size for layer in net.layers]
+
+
+def update_sparse_execution(net, threshold=SPARSE_DENSITY_THRESHOLD_DEFAULT):
+    """
+    Switches every layer whose density is below threshold to CSR execution of its forward
+    pass, and every other layer back to dense GEMMs. Only layers with a pruning mask, from
+    magnitude_prune or restored by MLP.load, can run sparse: weights that happen to be zero
+    are not pruned.
+
+    Returns:
+      list of bools, whether each layer runs sparse
+    """
+    sparse = []
+    for layer in net.layers:
+        density = 1. if layer.mask is None else np.count_nonzero(layer.mask) / layer.mask.size
+        if density < threshold:
+            _build_sparse(layer)
+        else:
+            layer.W_sparse = None
+            layer._sparse_index = None
+        sparse.append(layer.W_sparse is not None)
+    return sparse
+
+
+def _magnitude_threshold(magnitudes, sparsity):
+    """
+    Magnitude at or below which a `sparsity` fraction of the values lies.
+    """
+    k = int(sparsity * magnitudes.size)
+    if k == 0:
+        return -1.
+    return np.partition(magnitudes, k - 1)[k - 1]
+
+
+def _build_sparse(layer):
+    """
+    Builds the CSR matrix of a layer with the sparsity pattern of its mask (dense if it
+    has none). Its data array is in row-major order of the pattern, so Layer.refresh_sparse
+    can update it with a single gather.
+    """
+    import scipy.sparse
+
+    pattern = layer.mask if layer.mask is not None else np.ones(layer.W.shape, dtype=bool)
+    rows, cols = np.nonzero(pattern)
+    indptr = np.zeros(pattern.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=pattern.shape[0]), out=indptr[1:])
+
+    layer._sparse_index = np.ravel_multi_index((rows, cols), pattern.shape)
+    layer.W_sparse = scipy.sparse.csr_matrix((np.empty(len(cols), dtype=layer.W.dtype), cols, indptr),
+                                             shape=layer.W.shape)
+    layer.refresh_sparse()
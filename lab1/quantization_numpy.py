@@ -0,0 +1,183 @@
+"""
+This module implements int8 post-training quantization of the NumPy MLP.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# symmetric int8 range, -128 is not used so that negation is exact
+QUANT_MAX = 127
+
+# NumPy has no int8 BLAS, and its integer matmul does not use BLAS at all (about 50x slower
+# than float32 for the first CIFAR10 layer). The GEMM is therefore emulated with float32 BLAS
+# over blocks of the inner dimension small enough that every partial sum of int8 products is
+# an integer below 2**24, i.e. exact in float32, and the blocks are accumulated in int32. The
+# result is bit-identical to an int8 x int8 -> int32 GEMM, but not faster than the float32
+# model: the int8 weights are widened to float32 one block at a time on every call. The gain
+# is the 4x smaller footprint of the stored and resident weights, see
+# `benchmark_mlp_numpy.py quantization`.
+EXACT_BLOCK_SIZE = 2 ** 24 // (QUANT_MAX * QUANT_MAX)
+
+
+def int8_gemm(W_q, x_q):
+    """
+    int8 x int8 -> int32 matrix product, emulated with exact float32 BLAS blocks (see above).
+
+    :param W_q: 2D int8 array [M, K]
+    :param x_q: 2D int8 array [K, N], or float32 array of int8 values, which saves a conversion
+    :return: 2D int32 array [M, N]
+    """
+    x_q = x_q.astype(np.float32, copy=False)
+    acc = np.zeros((W_q.shape[0], x_q.shape[1]), dtype=np.int32)
+    for start in range(0, W_q.shape[1], EXACT_BLOCK_SIZE):
+        block = slice(start, start + EXACT_BLOCK_SIZE)
+        # matmul passes strided blocks of a transposed x_q to BLAS without copying them, unlike dot
+        partial = np.matmul(W_q[:, block].astype(np.float32), x_q[block])
+        np.add(acc, partial, out=acc, casting='unsafe')
+    return acc
+
+
+def quantize(x, scale, dtype=np.int8):
+    """
+    Symmetric linear quantization to int8: round(x / scale), clipped to [-127, 127].
+
+    :param dtype: int8, or float32 to keep the int8 values in float32 for int8_gemm
+    """
+    q = np.divide(x, scale, dtype=np.float32)
+    np.rint(q, out=q)
+    np.clip(q, -QUANT_MAX, QUANT_MAX, out=q)
+    return q.astype(dtype, copy=False)
+
+
+def calibrate(net, batches, percentile=100.):
+    """
+    Collects the range of the input of every layer of a float MLP.
+
+    Args:
+      net: MLP
+      batches: iterable of float arrays [batch_size, ...], e.g. a few CIFAR10 training batches.
+      percentile: percentile of |input| used as the range, 100 takes the maximum. Lower values
+                  clip rare outliers in favour of a finer resolution for the bulk.
+    Returns:
+      list of the input range of every layer
+    """
+    ranges = np.zeros(len(net.layers))
+    for x in batches:
+        Z = net._batch_major(np.asarray(x, dtype=net.dtype).reshape(x.shape[0], -1))
+        for k, layer in enumerate(net.layers):
+            ranges[k] = max(ranges[k], np.percentile(np.abs(Z), percentile))
+            Z = layer.predict(Z)
+    return list(ranges)
+
+
+class QuantizedMLP(object):
+    """
+    Inference-only int8 version of a trained MLP. Weights are stored as int8 with one
+    scale per output unit (row of W), a quarter of the float32 footprint. The input of every
+    layer is quantized with a per-layer scale calibrated on sample batches. Each layer runs
+    an int8 GEMM with int32 accumulation, followed by float32 rescaling, bias and activation.
+    The GEMM is an exact emulation on float32 BLAS (see int8_gemm), so inference is not faster
+    than with the float32 MLP.
+    """
+
+    def __init__(self, weights, weight_scales, biases, input_scales, n_classes):
+        """
+        Args:
+          weights: list of int8 arrays [D_k+1, D_k]
+          weight_scales: list of float32 arrays [D_k+1, 1]
+          biases: list of float32 arrays [D_k+1, 1]
+          input_scales: list of float scales of the input of every layer
+          n_classes: int, number of classes
+        """
+        self.weights = weights
+        self.weight_scales = weight_scales
+        self.biases = biases
+        self.input_scales = input_scales
+        self.n_classes = n_classes
+
+    @classmethod
+    def from_mlp(cls, net, calibration_batches, percentile=100.):
+        """
+        Quantizes a trained MLP.
+
+        Args:
+          net: MLP
+          calibration_batches: iterable of float input batches, see calibrate.
+          percentile: see calibrate.
+        """
+        ranges = calibrate(net, calibration_batches, percentile=percentile)
+
+        weights, weight_scales, biases = [], [], []
+        for layer in net.layers:
+            # quantized weights are always in dimension-first layout
+            W = layer.W.T if net.batch_major else layer.W
+            row_max = np.max(np.abs(W), axis=1, keepdims=True)
+            scale = (np.maximum(row_max, 1e-12) / QUANT_MAX).astype(np.float32)
+            weights.append(quantize(W, scale))
+            weight_scales.append(scale)
+            biases.append(np.asarray(layer.b, dtype=np.float32).reshape(-1, 1))
+
+        input_scales = [max(r, 1e-12) / QUANT_MAX for r in ranges]
+        return cls(weights, weight_scales, biases, input_scales, net.n_classes)
+
+    def predict(self, x, batch_size=1000):
+        """
+        Computes float32 logits [n_datapoints, n_classes], batch_size datapoints at a time.
+        """
+        logits = np.empty((x.shape[0], self.n_classes), dtype=np.float32)
+        for start in range(0, x.shape[0], batch_size):
+            chunk = np.asarray(x[start:start + batch_size])
+            logits[start:start + chunk.shape[0]] = self._forward(chunk.reshape(chunk.shape[0], -1).T).T
+        return logits
+
+    def accuracy(self, x, labels, batch_size=1000):
+        """
+        Accuracy on a dataset, labels one-hot or class indices.
+        """
+        labels = labels if labels.ndim == 1 else np.argmax(labels, axis=1)
+        return np.mean(np.argmax(self.predict(x, batch_size), axis=1) == labels)
+
+    def nbytes(self):
+        """
+        Memory footprint of the weights, scales and biases.
+        """
+        return sum(a.nbytes for a in self.weights + self.weight_scales + self.biases)
+
+    def save(self, path):
+        """
+        Saves the quantized model to path.npz.
+        """
+        arrays = {'input_scales': np.array(self.input_scales), 'n_classes': np.array(self.n_classes)}
+        for k in range(len(self.weights)):
+            arrays['W_{}'.format(k)] = self.weights[k]
+            arrays['W_scale_{}'.format(k)] = self.weight_scales[k]
+            arrays['b_{}'.format(k)] = self.biases[k]
+        np.savez(path + '.npz', **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path + '.npz')
+        n_layers = len(arrays['input_scales'])
+        return cls([arrays['W_{}'.format(k)] for k in range(n_layers)],
+                   [arrays['W_scale_{}'.format(k)] for k in range(n_layers)],
+                   [arrays['b_{}'.format(k)] for k in range(n_layers)],
+                   list(arrays['input_scales']), int(arrays['n_classes']))
+
+    def _forward(self, Z):
+        """
+        :param Z: float input in dimension-first layout [input_dim, batch_size]
+        :return: float32 logits [n_classes, batch_size]
+        """
+        n_layers = len(self.weights)
+        for k, (W_q, W_scale, b, input_scale) in enumerate(zip(self.weights, self.weight_scales,
+                                                               self.biases, self.input_scales)):
+            acc = int8_gemm(W_q, quantize(Z, input_scale, dtype=np.float32))
+
+            # dequantize: S = (s_W * s_Z) * acc + b
+            S = acc.astype(np.float32)
+            S *= W_scale * np.float32(input_scale)
+            S += b
+            Z = np.maximum(S, 0, out=S) if k < n_layers - 1 else S
+        return Z
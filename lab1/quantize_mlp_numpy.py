@@ -0,0 +1,104 @@
+"""
+This module implements int8 post-training quantization of a trained NumPy MLP on CIFAR10
+and reports its accuracy and speed against the float model.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import cifar10_utils
+from mlp_numpy import MLP
+from quantization_numpy import QuantizedMLP
+
+# Default constants
+MODEL_PATH_DEFAULT = './trained_models/mlp_numpy'
+CALIBRATION_BATCHES_DEFAULT = 10
+CALIBRATION_BATCH_SIZE_DEFAULT = 200
+CALIBRATION_PERCENTILE_DEFAULT = 100.
+EVAL_BATCH_SIZE_DEFAULT = 1000
+NORMALIZATION_DEFAULT = 'mean'
+
+# Directory in which cifar data is saved
+DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
+
+FLAGS = None
+
+
+def quantize():
+    """
+    Calibrates the activation ranges on a few training batches, quantizes the model,
+    compares test accuracy, weight footprint and inference time with the float model,
+    and saves the quantized model next to the float one.
+    """
+    np.random.seed(42)
+
+    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir, one_hot=False, normalization=FLAGS.normalization)
+    net = MLP.load(FLAGS.model_path)
+    print(net)
+
+    calibration_batches = [cifar10.train.next_batch(FLAGS.calibration_batch_size)[0]
+                           for _ in range(FLAGS.calibration_batches)]
+    qnet = QuantizedMLP.from_mlp(net, calibration_batches, percentile=FLAGS.calibration_percentile)
+
+    X_test, y_test = cifar10.test.images, cifar10.test.labels
+
+    start = time.perf_counter()
+    _, float_accuracy = net.evaluate(X_test, y_test, batch_size=FLAGS.eval_batch_size, stats_prefix=None)
+    float_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    int8_accuracy = qnet.accuracy(X_test, y_test, batch_size=FLAGS.eval_batch_size)
+    int8_time = time.perf_counter() - start
+
+    print('{:>6} {:>10} {:>12} {:>12}'.format('', 'accuracy', 'weights MB', 'images/sec'))
+    print('{:>6} {:>10.4f} {:>12.2f} {:>12.0f}'.format('float', float_accuracy, net.parameters.params.nbytes / 2 ** 20,
+                                                       len(X_test) / float_time))
+    print('{:>6} {:>10.4f} {:>12.2f} {:>12.0f}'.format('int8', int8_accuracy, qnet.nbytes() / 2 ** 20,
+                                                       len(X_test) / int8_time))
+    print('==> accuracy delta (int8 - float): {:+.4f}'.format(int8_accuracy - float_accuracy))
+
+    qnet.save(FLAGS.model_path + '_int8')
+
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+
+def main():
+    """
+    Main function
+    """
+    print_flags()
+    quantize()
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH_DEFAULT,
+                        help='Path of a model saved by train_mlp_numpy.py, without extension')
+    parser.add_argument('--calibration_batches', type=int, default=CALIBRATION_BATCHES_DEFAULT,
+                        help='Number of training batches used to calibrate the activation ranges')
+    parser.add_argument('--calibration_batch_size', type=int, default=CALIBRATION_BATCH_SIZE_DEFAULT,
+                        help='Size of the calibration batches')
+    parser.add_argument('--calibration_percentile', type=float, default=CALIBRATION_PERCENTILE_DEFAULT,
+                        help='Percentile of the absolute activations used as range, 100 takes the maximum')
+    parser.add_argument('--eval_batch_size', type=int, default=EVAL_BATCH_SIZE_DEFAULT,
+                        help='Number of test datapoints per forward pass')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
+                        help='Directory for storing input data')
+    parser.add_argument('--normalization', type=str, default=NORMALIZATION_DEFAULT,
+                        choices=cifar10_utils.NORMALIZATIONS,
+                        help='Input normalization [mean, pixel, channel], see cifar10_utils.ImageStats')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
@@ -0,0 +1,359 @@
+"""
+This module implements a local inference server for a trained NumPy MLP. Concurrent requests
+are coalesced into micro-batches, so every forward pass is a GEMM over many datapoints instead
+of one matrix-vector product per request.
+
+The protocol is one JSON object per line, over stdin/stdout or a local TCP socket:
+  request:  {"id": 7, "x": [input_dim floats], "k": 3}
+  response: {"id": 7, "probs": [n_classes floats], "top_k": [[class, prob], ...]}
+A request {"cmd": "stats"} returns the latency and throughput counters, see MicroBatcher.counters.
+
+x is a raw image, e.g. the 32x32x3 uint8 pixels of a CIFAR10 image flattened in height, width,
+channel order. The server applies the input normalization of training, saved next to the model
+by train_mlp_numpy.py (see cifar10_utils.DataSet.save_normalization). For models saved without
+it, x is passed to the model unchanged and must already be normalized like the training data.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+import cifar10_utils
+from mlp_numpy import MLP
+from training_stats import StatsCollector
+
+# Default constants
+MODEL_PATH_DEFAULT = './trained_models/mlp_numpy'
+MAX_BATCH_SIZE_DEFAULT = 64
+MAX_LATENCY_MS_DEFAULT = 5.
+TOP_K_DEFAULT = 3
+STATS_CAPACITY_DEFAULT = 100000
+HOST_DEFAULT = '127.0.0.1'
+
+FLAGS = None
+
+
+def _softmax(logits):
+    e = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class MicroBatcher(object):
+    """
+    Collects requests from any number of threads and runs them through the model in batches
+    on a single background thread. A batch is run as soon as it holds max_batch_size requests,
+    or when its oldest request has waited max_latency seconds.
+    """
+
+    def __init__(self, model, input_dim, max_batch_size=MAX_BATCH_SIZE_DEFAULT,
+                 max_latency=MAX_LATENCY_MS_DEFAULT / 1e3, stats_capacity=STATS_CAPACITY_DEFAULT, normalize=None):
+        """
+        Args:
+          model: MLP or QuantizedMLP, anything with predict(x, batch_size) -> logits.
+          input_dim: number of input features per request.
+          max_batch_size: largest number of requests per forward pass.
+          max_latency: longest time in seconds a request waits for the batch to fill up.
+          stats_capacity: number of latency samples kept for the percentiles.
+          normalize: optional function applied to every batch [batch_size, input_dim] of
+                     requests before the model, see load_normalization.
+        """
+        self.model = model
+        self.input_dim = input_dim
+        self.normalize = normalize
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        # per-request latency and per-batch size, the step is the batch index
+        self.stats = StatsCollector(capacity=stats_capacity)
+        self.n_requests = 0
+        self._start_time = None
+        self._last_time = None
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, x):
+        """
+        Queues one datapoint.
+
+        :param x: float array-like with input_dim values, flattened if needed
+        :return: Future of the class probabilities [n_classes]
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        if x.size != self.input_dim:
+            raise ValueError('Expected {} input values, received {}.'.format(self.input_dim, x.size))
+
+        future = Future()
+        self._queue.put((time.perf_counter(), x, future))
+        return future
+
+    def close(self):
+        """
+        Runs the requests still queued and stops the background thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def counters(self):
+        """
+        Returns the number of requests and batches, the mean batch size, the p50/p99 latency
+        in ms over the last stats_capacity requests, and the throughput in requests/sec
+        between the first arrival and the last response.
+        """
+        with self._lock:
+            _, latencies = self.stats.get('latency')
+            _, batch_sizes = self.stats.get('batch_size')
+            elapsed = (self._last_time - self._start_time) if self.n_requests else 0.
+            n_requests = self.n_requests
+
+        return {'requests': n_requests,
+                'batches': len(batch_sizes),
+                'mean_batch_size': float(np.mean(batch_sizes)) if len(batch_sizes) else 0.,
+                'p50_ms': float(1e3 * np.percentile(latencies, 50)) if len(latencies) else 0.,
+                'p99_ms': float(1e3 * np.percentile(latencies, 99)) if len(latencies) else 0.,
+                'throughput': n_requests / elapsed if elapsed > 0 else 0.}
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[0] + self.max_latency
+
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._process(batch)
+
+    def _process(self, batch):
+        arrivals, xs, futures = zip(*batch)
+        try:
+            x = np.stack(xs)
+            if self.normalize is not None:
+                x = self.normalize(x)
+            probs = _softmax(self.model.predict(x, batch_size=len(xs)))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        done = time.perf_counter()
+        with self._lock:
+            if self._start_time is None:
+                self._start_time = arrivals[0]
+            self._last_time = done
+            self.n_requests += len(batch)
+            for arrival in arrivals:
+                self.stats.record('latency', done - arrival)
+            self.stats.record('batch_size', len(batch))
+            self.stats.step += 1
+
+        for p, future in zip(probs, futures):
+            future.set_result(p)
+
+
+def _response(request_id, probs, k):
+    top_k = np.argsort(-probs)[:k]
+    return {'id': request_id, 'probs': probs.tolist(), 'top_k': [[int(c), float(probs[c])] for c in top_k]}
+
+
+def _handle_line(batcher, line, respond, top_k):
+    """
+    Parses one request line and calls respond(dict) once its answer is ready, without
+    blocking on the model, so pipelined requests of one client share batches.
+    """
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError('Expected a JSON object, received {}.'.format(type(request).__name__))
+        if request.get('cmd') == 'stats':
+            respond(batcher.counters())
+            return
+        request_id, k = request.get('id'), int(request.get('k', top_k))
+        future = batcher.submit(request['x'])
+    except (ValueError, KeyError, TypeError) as e:
+        respond({'error': str(e)})
+        return
+
+    def done(f):
+        if f.exception() is not None:
+            respond({'id': request_id, 'error': str(f.exception())})
+        else:
+            respond(_response(request_id, f.result(), k))
+
+    future.add_done_callback(done)
+
+
+def _line_writer(stream):
+    lock = threading.Lock()
+
+    def respond(message):
+        with lock:
+            stream.write(json.dumps(message) + '\n')
+            stream.flush()
+
+    return respond
+
+
+def serve_stdin(batcher, top_k=TOP_K_DEFAULT):
+    """
+    Answers requests read from stdin on stdout, until EOF.
+    """
+    respond = _line_writer(sys.stdout)
+    for line in sys.stdin:
+        if line.strip():
+            _handle_line(batcher, line, respond, top_k)
+
+
+class _SocketWriter(object):
+    """
+    Text interface over the binary write stream of a connection.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode())
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def serve_socket(batcher, host, port, top_k=TOP_K_DEFAULT):
+    """
+    Answers requests on a local TCP socket, one thread per connection, until interrupted.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            respond = _line_writer(_SocketWriter(self.wfile))
+            for line in self.rfile:
+                if line.strip():
+                    _handle_line(batcher, line.decode(), respond, top_k)
+
+    class Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    with Server((host, port), Handler) as server:
+        print('Serving on {}:{}'.format(*server.server_address), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def load_model(path, int8=False):
+    """
+    Loads a model saved by train_mlp_numpy.py (or its int8 version saved by quantize_mlp_numpy.py).
+
+    :return: model, input_dim
+    """
+    if int8:
+        from quantization_numpy import QuantizedMLP
+        model = QuantizedMLP.load(path + '_int8')
+        return model, model.weights[0].shape[1]
+    model = MLP.load(path)
+    return model, model.input_dim
+
+
+def load_normalization(path):
+    """
+    Loads the input normalization saved next to a model by train_mlp_numpy.py.
+
+    :return: function normalizing a batch of flattened raw images [batch_size, input_dim],
+             or None if the model was saved without normalization
+    """
+    filename = path + cifar10_utils.NORMALIZATION_SUFFIX
+    if not os.path.exists(filename):
+        return None
+    image_shape, normalize_images = cifar10_utils.load_normalization(filename)
+
+    def normalize(x):
+        return normalize_images(x.reshape((-1,) + image_shape)).reshape(x.shape[0], -1)
+
+    return normalize
+
+
+def serve():
+    """
+    Loads the model and serves requests until EOF on stdin or until interrupted, then
+    prints the latency and throughput counters.
+    """
+    model, input_dim = load_model(FLAGS.model_path, int8=FLAGS.int8)
+    normalize = load_normalization(FLAGS.model_path)
+    if normalize is None:
+        print('WARNING: no input normalization saved with {}, requests must be normalized like the '
+              'training data'.format(FLAGS.model_path), file=sys.stderr)
+    batcher = MicroBatcher(model, input_dim, max_batch_size=FLAGS.max_batch_size,
+                           max_latency=FLAGS.max_latency_ms / 1e3, normalize=normalize)
+
+    if FLAGS.port is None:
+        serve_stdin(batcher, top_k=FLAGS.top_k)
+    else:
+        serve_socket(batcher, FLAGS.host, FLAGS.port, top_k=FLAGS.top_k)
+
+    batcher.close()
+    print(json.dumps(batcher.counters()), file=sys.stderr)
+
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value), file=sys.stderr)
+
+
+def main():
+    """
+    Main function
+    """
+    print_flags()
+    serve()
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH_DEFAULT,
+                        help='Path of a model saved by train_mlp_numpy.py, without extension. Requests '
+                             'are raw images, normalized with the normalization saved next to the model')
+    parser.add_argument('--int8', action='store_true',
+                        help='Serve the quantized model saved by quantize_mlp_numpy.py')
+    parser.add_argument('--max_batch_size', type=int, default=MAX_BATCH_SIZE_DEFAULT,
+                        help='Largest number of requests per forward pass')
+    parser.add_argument('--max_latency_ms', type=float, default=MAX_LATENCY_MS_DEFAULT,
+                        help='Longest time a request waits for its batch to fill up')
+    parser.add_argument('--top_k', type=int, default=TOP_K_DEFAULT,
+                        help='Number of top classes returned when a request does not give k')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Serve on this local TCP port instead of stdin/stdout')
+    parser.add_argument('--host', type=str, default=HOST_DEFAULT,
+                        help='Address to bind with --port')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
@@ -0,0 +1,477 @@
+"""
+This module implements a sharded on-disk format for image datasets larger than memory, and
+a DataSet-compatible reader that streams it with a bounded shuffle buffer.
+
+A sharded dataset is a folder with:
+  shard_00000.npy, ...  fixed-size records (image, label), shard_size records per shard
+                        except the last one, as .npy files of a structured dtype.
+  image_stats.npz       cifar10_utils.ImageStats of all images, accumulated while writing.
+  index.json            format version, record layout and the number of records per shard.
+                        It is written last, so an interrupted conversion is never read.
+
+Convert the CIFAR10 pickles with
+  python sharded_dataset.py --data_dir ./cifar10/cifar-10-batches-py --output_dir ./cifar10/sharded
+and train on them by passing --data_dir ./cifar10/sharded to any lab1 trainer, see
+cifar10_utils.read_data_sets.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+import cifar10_utils
+from cifar10_utils import DataSet, Datasets, ImageStats
+
+# Bump the version whenever the layout of the records or of the index changes
+SHARD_FORMAT_VERSION = 2
+INDEX_FILENAME = 'index.json'
+SPLITS = ['train', 'test']
+
+# Default constants
+SHARD_SIZE_DEFAULT = 4096
+SHUFFLE_BUFFER_DEFAULT = 16384
+
+FLAGS = None
+
+
+def record_dtype(image_shape, image_dtype=np.uint8, label_dtype=np.int64):
+    """
+    Structured dtype of one record of a shard.
+    """
+    return np.dtype([('image', image_dtype, tuple(image_shape)), ('label', label_dtype)])
+
+
+def is_sharded(folder):
+    """
+    Whether folder holds a complete sharded dataset.
+    """
+    return os.path.exists(os.path.join(folder, INDEX_FILENAME))
+
+
+class ShardWriter(object):
+    """
+    Writes records to a sharded dataset folder, see the module docstring. Records are
+    collected in a buffer of one shard, so any number of images can be written with constant
+    memory. The ImageStats of the images are accumulated on the fly.
+    """
+
+    def __init__(self, folder, image_shape, image_dtype=np.uint8, label_dtype=np.int64,
+                 shard_size=SHARD_SIZE_DEFAULT):
+        """
+        Args:
+          folder: Output folder, created if needed. An existing index is removed first.
+          image_shape: Shape of one image, e.g. (32, 32, 3).
+          image_dtype: Stored dtype of the images.
+          label_dtype: Stored dtype of the class labels.
+          shard_size: Number of records per shard.
+        """
+        self.folder = folder
+        self.shard_size = shard_size
+        self.dtype = record_dtype(image_shape, image_dtype, label_dtype)
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        if is_sharded(folder):
+            os.remove(os.path.join(folder, INDEX_FILENAME))
+
+        self._buffer = np.empty(shard_size, dtype=self.dtype)
+        self._n_buffered = 0
+        self._shard_lengths = []
+        self.image_stats = ImageStats(image_shape)
+        self._max_label = -1
+
+    def write(self, images, labels):
+        """
+        Appends records. images and labels may be memory-mapped, they are read shard by shard.
+        """
+        assert images.shape[0] == labels.shape[0], (
+            "images.shape: {0}, labels.shape: {1}".format(str(images.shape), str(labels.shape)))
+
+        start = 0
+        while start < images.shape[0]:
+            n = min(self.shard_size - self._n_buffered, images.shape[0] - start)
+            records = self._buffer[self._n_buffered:self._n_buffered + n]
+            records['image'] = images[start:start + n]
+            records['label'] = labels[start:start + n]
+
+            self.image_stats.update(records['image'])
+            self._max_label = max(self._max_label, int(records['label'].max()))
+            self._n_buffered += n
+            start += n
+            if self._n_buffered == self.shard_size:
+                self._flush()
+
+    def close(self):
+        """
+        Writes the last, possibly smaller, shard, the image stats and the index.
+
+        Returns:
+          The index, see read_index.
+        """
+        if self._n_buffered > 0:
+            self._flush()
+
+        n_records = sum(self._shard_lengths)
+        self.image_stats.save(os.path.join(self.folder, cifar10_utils.IMAGE_STATS_FILENAME))
+
+        index = {'version': SHARD_FORMAT_VERSION,
+                 'n_records': n_records,
+                 'shard_size': self.shard_size,
+                 'shards': [{'filename': _shard_filename(k), 'n_records': n}
+                            for k, n in enumerate(self._shard_lengths)],
+                 'image_shape': list(self.dtype['image'].shape),
+                 'image_dtype': self.dtype['image'].base.str,
+                 'label_dtype': self.dtype['label'].str,
+                 'num_classes': self._max_label + 1}
+        with open(os.path.join(self.folder, INDEX_FILENAME), 'w') as f:
+            json.dump(index, f, indent=2)
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+    def _flush(self):
+        filename = os.path.join(self.folder, _shard_filename(len(self._shard_lengths)))
+        with open(filename + '.tmp', 'wb') as f:
+            np.save(f, self._buffer[:self._n_buffered])
+        os.replace(filename + '.tmp', filename)
+        self._shard_lengths.append(self._n_buffered)
+        self._n_buffered = 0
+
+
+def _shard_filename(k):
+    return 'shard_{:05d}.npy'.format(k)
+
+
+def write_shards(folder, images, labels, shard_size=SHARD_SIZE_DEFAULT):
+    """
+    Converts arrays, e.g. memory-mapped .npy files, to a sharded dataset.
+    """
+    labels = np.asarray(labels)
+    with ShardWriter(folder, images.shape[1:], image_dtype=images.dtype, label_dtype=labels.dtype,
+                     shard_size=shard_size) as writer:
+        writer.write(images, labels)
+
+
+def write_cifar10_shards(cifar10_folder, output_folder, shard_size=SHARD_SIZE_DEFAULT):
+    """
+    Converts the CIFAR10 pickle batches to a sharded dataset with a train and a test split,
+    one batch file in memory at a time.
+    """
+    for split, filenames in [('train', ['data_batch_' + str(b) for b in range(1, 6)]), ('test', ['test_batch'])]:
+        with ShardWriter(os.path.join(output_folder, split), (32, 32, 3), shard_size=shard_size) as writer:
+            for filename in filenames:
+                writer.write(*cifar10_utils.load_cifar10_batch(os.path.join(cifar10_folder, filename)))
+
+
+def read_index(folder):
+    """
+    Loads and checks the index of a sharded dataset.
+    """
+    with open(os.path.join(folder, INDEX_FILENAME)) as f:
+        index = json.load(f)
+    if index.get('version') != SHARD_FORMAT_VERSION:
+        raise ValueError('{} has sharded format version {}, expected {}.'.format(
+            folder, index.get('version'), SHARD_FORMAT_VERSION))
+    return index
+
+
+class ShardedArray(object):
+    """
+    Read-only concatenation of one field of the memory-mapped shards, indexable like an array
+    along the first axis without loading the other shards.
+    """
+
+    def __init__(self, shards, field):
+        self._shards = [shard[field] for shard in shards]
+        self._offsets = np.cumsum([0] + [len(shard) for shard in shards])
+
+    @property
+    def shape(self):
+        return (int(self._offsets[-1]),) + self._shards[0].shape[1:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self._shards[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                parts = [shard[max(start - offset, 0):max(stop - offset, 0)]
+                         for shard, offset in zip(self._shards, self._offsets)]
+                return np.concatenate([part for part in parts if len(part)] or [self._shards[0][:0]])
+            index = np.arange(start, stop, step)
+
+        index = np.asarray(index)
+        if index.ndim == 0:
+            k = np.searchsorted(self._offsets, index, side='right') - 1
+            return np.array(self._shards[k][index - self._offsets[k]])
+
+        out = np.empty(index.shape + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self._offsets, index, side='right') - 1
+        for k in np.unique(shard_ids):
+            selected = shard_ids == k
+            out[selected] = self._shards[k][index[selected] - self._offsets[k]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+class ShardedDataSet(DataSet):
+    """
+    DataSet over a sharded dataset folder. next_batch streams the shards sequentially, in a
+    new shard order every epoch, through a shuffle buffer of shuffle_buffer records: every
+    batch is a uniform sample of the buffer, and the sampled records are replaced by the
+    next ones in the stream. Only the buffer and the current shard pages are in memory.
+
+    The shuffle is therefore local: records from shards far apart in the epoch's shard
+    order never meet in a batch. Larger buffers and smaller shards shuffle better.
+
+    images and labels are read from the memory-mapped shards on access, like the cached
+    DataSet, and are meant for small splits such as the test set.
+    """
+
+    def __init__(self, folder, mean_image=None, std_image=None, scale=1., num_classes=None, seed=None,
+                 shuffle_buffer=SHUFFLE_BUFFER_DEFAULT):
+        """
+        Args:
+          folder: Sharded dataset folder.
+          mean_image, std_image, scale, num_classes: See DataSet.
+          seed: If given, the shard order and the shuffle buffer of epoch e are drawn with the
+                seed (seed, e). Otherwise the first epoch is read in stored order, without
+                shuffling, and later ones are shuffled with the global numpy random state.
+          shuffle_buffer: Number of records in the shuffle buffer, at least the batch size.
+        """
+        self.index = read_index(folder)
+        self._shard_data = [np.load(os.path.join(folder, shard['filename']), mmap_mode='r')
+                            for shard in self.index['shards']]
+
+        self._num_examples = self.index['n_records']
+        self._images = ShardedArray(self._shard_data, 'image')
+        self._labels = ShardedArray(self._shard_data, 'label')
+        self._mean_image = mean_image
+        self._inv_std_image = None if std_image is None else cifar10_utils.inverse_std(std_image)
+        self._scale = scale
+        self._num_classes = num_classes
+        self._seed = seed
+
+        self._buffer = np.empty(shuffle_buffer, dtype=self._shard_data[0].dtype)
+        self._epochs_completed = 0
+        self._start_epoch()
+
+    def next_batch(self, batch_size, allow_smaller_final_batch=False, out=None):
+        """
+        Returns the next `batch_size` examples, see DataSet.next_batch.
+        """
+        remaining = self._num_examples - self._index_in_epoch
+        if remaining == 0 or (remaining < batch_size and not allow_smaller_final_batch):
+            assert batch_size <= self._num_examples
+            self._epochs_completed += 1
+            self._start_epoch()
+
+        n = min(batch_size, self._num_examples - self._index_in_epoch)
+        records = self._take_batch(n)
+
+        if out is None:
+            return self.normalize(records['image']), self.encode_labels(records['label'])
+        images_out, labels_out = out
+        return (self.normalize(records['image'], out=images_out[:n]),
+                self.encode_labels(records['label'], out=labels_out[:n]))
+
+    def get_state(self):
+        """
+        Position in the data, see DataSet.get_state, with the sizes of the batches taken in the
+        current epoch as run-length [size, count] pairs: the records drawn from the shuffle
+        buffer depend on how the epoch was split into batches.
+        """
+        state = super(ShardedDataSet, self).get_state()
+        state['batch_sizes'] = [list(run) for run in self._batch_sizes]
+        return state
+
+    def set_state(self, state):
+        """
+        Continues from a position returned by get_state: the epoch is restarted and the batches
+        already taken are drawn again and dropped. With a seed, the rest of the epoch is then the
+        same as in the original run. A state without batch sizes, e.g. of a DataSet, skips the
+        records in buffer-sized batches, which resumes at the same position but with other records.
+        """
+        self._epochs_completed = state['epochs_completed']
+        self._start_epoch()
+        if 'batch_sizes' in state:
+            batch_sizes = [size for size, count in state['batch_sizes'] for _ in range(count)]
+        else:
+            n, buffer_size = state['index_in_epoch'], len(self._buffer)
+            batch_sizes = [buffer_size] * (n // buffer_size)
+            if n % buffer_size:
+                batch_sizes.append(n % buffer_size)
+
+        for size in batch_sizes:
+            self._take_batch(size)
+        assert self._index_in_epoch == state['index_in_epoch'], 'batch sizes do not add up to the position'
+
+    def _start_epoch(self):
+        """
+        Draws the shard order of the epoch and empties the shuffle buffer.
+        """
+        epoch = self._epochs_completed
+        n_shards = len(self._shard_data)
+        if self._seed is not None:
+            self._rng = np.random.RandomState([self._seed, epoch])
+        else:
+            self._rng = None if epoch == 0 else np.random
+
+        self._shard_order = list(range(n_shards)) if self._rng is None else list(self._rng.permutation(n_shards))
+        self._shard_position = 0
+        self._n_buffered = 0
+        self._index_in_epoch = 0
+        self._batch_sizes = []
+
+    def _take_batch(self, n):
+        """
+        Takes the n records of the next batch and counts them in the position and batch sizes of the epoch.
+        """
+        records = self._take(n)
+        self._index_in_epoch += n
+        if self._batch_sizes and self._batch_sizes[-1][0] == n:
+            self._batch_sizes[-1][1] += 1
+        else:
+            self._batch_sizes.append([n, 1])
+        return records
+
+    def _take(self, n):
+        """
+        Removes n records of the epoch from the shuffle buffer, refilled from the shards.
+        """
+        if self._rng is None:
+            # stored order, the records are read straight from the shards without buffering
+            records = np.empty(n, dtype=self._buffer.dtype)
+            self._read(records)
+            return records
+
+        if n > len(self._buffer):
+            buffer = np.empty(n, dtype=self._buffer.dtype)
+            buffer[:self._n_buffered] = self._buffer[:self._n_buffered]
+            self._buffer = buffer
+        self._fill()
+
+        picked = self._rng.choice(self._n_buffered, n, replace=False)
+        records = self._buffer[picked]
+
+        # move the records after the new end of the buffer into the holes before it
+        keep = self._n_buffered - n
+        is_picked = np.zeros(self._n_buffered, dtype=bool)
+        is_picked[picked] = True
+        holes = picked[picked < keep]
+        self._buffer[holes] = self._buffer[keep + np.flatnonzero(~is_picked[keep:])]
+
+        self._n_buffered -= n
+        return records
+
+    def _fill(self):
+        """
+        Reads the next records of the epoch's shard order until the buffer is full.
+        """
+        self._n_buffered += self._read(self._buffer[self._n_buffered:])
+
+    def _read(self, out):
+        """
+        Copies the next records of the epoch's shard order into out, returns their number.
+        """
+        n_read = 0
+        while n_read < len(out) and self._shard_order:
+            shard = self._shard_data[self._shard_order[0]]
+            n = min(len(out) - n_read, len(shard) - self._shard_position)
+            out[n_read:n_read + n] = shard[self._shard_position:self._shard_position + n]
+            n_read += n
+            self._shard_position += n
+            if self._shard_position == len(shard):
+                self._shard_order.pop(0)
+                self._shard_position = 0
+        return n_read
+
+
+def read_sharded_data_sets(data_dir, one_hot=True, validation_size=0, normalization='mean', seed=None,
+                           shuffle_buffer=SHUFFLE_BUFFER_DEFAULT):
+    """
+    Returns the train and test splits of a folder written by write_cifar10_shards (or with
+    train/ and test/ written by write_shards), normalized with the image stats of train, see
+    cifar10_utils.ImageStats.normalization. The validation set is empty, carving it out of a
+    streamed train split is not supported.
+    """
+    if validation_size != 0:
+        raise ValueError('Sharded datasets have no validation split. Received validation_size {}.'.format(
+            validation_size))
+
+    train_folder, test_folder = [os.path.join(data_dir, split) for split in SPLITS]
+    image_stats = ImageStats.load(os.path.join(train_folder, cifar10_utils.IMAGE_STATS_FILENAME))
+    mean_image, std_image = image_stats.normalization(normalization)
+    num_classes = read_index(train_folder)['num_classes'] if one_hot else None
+
+    dataset_kwargs = dict(mean_image=mean_image, std_image=std_image, num_classes=num_classes)
+    train = ShardedDataSet(train_folder, seed=seed, shuffle_buffer=shuffle_buffer, **dataset_kwargs)
+    test = ShardedDataSet(test_folder, seed=seed, shuffle_buffer=shuffle_buffer, **dataset_kwargs)
+    validation = DataSet(train.raw_images[:0], train.raw_labels[:0], **dataset_kwargs)
+    return Datasets(train=train, validation=validation, test=test)
+
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+
+def main():
+    """
+    Main function
+    """
+    print_flags()
+    if FLAGS.images is not None:
+        write_shards(FLAGS.output_dir, np.load(FLAGS.images, mmap_mode='r'), np.load(FLAGS.labels, mmap_mode='r'),
+                     shard_size=FLAGS.shard_size)
+        folders = [FLAGS.output_dir]
+    else:
+        write_cifar10_shards(FLAGS.data_dir, FLAGS.output_dir, shard_size=FLAGS.shard_size)
+        folders = [os.path.join(FLAGS.output_dir, split) for split in SPLITS]
+
+    for folder in folders:
+        index = read_index(folder)
+        print('{}: {} records in {} shards'.format(folder, index['n_records'], len(index['shards'])))
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=cifar10_utils.CIFAR10_FOLDER,
+                        help='Directory of the CIFAR10 pickle batches to convert')
+    parser.add_argument('--images', type=str, default=None,
+                        help='Convert this .npy array of images instead of CIFAR10, with --labels')
+    parser.add_argument('--labels', type=str, default=None,
+                        help='.npy array of the class labels of --images')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Output folder of the sharded dataset')
+    parser.add_argument('--shard_size', type=int, default=SHARD_SIZE_DEFAULT,
+                        help='Number of records per shard')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
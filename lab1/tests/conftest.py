@@ -0,0 +1,31 @@
+"""
+The lab1 modules import each other as top-level modules, so lab1 is put on the import path.
+"""
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# images per fake CIFAR10 batch file
+FAKE_BATCH_SIZE = 100
+
+
+@pytest.fixture
+def cifar10_folder(tmp_path, monkeypatch):
+    """
+    Folder with the six CIFAR10 pickle batches, filled with random images of FAKE_BATCH_SIZE each.
+    """
+    import cifar10_utils
+    monkeypatch.setattr(cifar10_utils, 'CIFAR10_BATCH_SIZE', FAKE_BATCH_SIZE)
+
+    rng = np.random.RandomState(0)
+    for filename in ['data_batch_' + str(b) for b in range(1, 6)] + ['test_batch']:
+        batch = {'data': rng.randint(256, size=(FAKE_BATCH_SIZE, 3 * 32 * 32)).astype(np.uint8),
+                 'labels': list(rng.randint(10, size=FAKE_BATCH_SIZE))}
+        with open(str(tmp_path / filename), 'wb') as f:
+            pickle.dump(batch, f)
+    return str(tmp_path)
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from async_eval import AsyncEvaluator, MLPSnapshotModel, evaluate_logits
+from mlp_numpy import MLP
+
+
+def make_test_set():
+    rng = np.random.RandomState(1)
+    return rng.normal(size=(50, 10)), rng.randint(3, size=50)
+
+
+def missing_test_set():
+    raise IOError('no test set')
+
+
+def test_snapshots_are_evaluated_like_the_trained_model():
+    np.random.seed(0)
+    net = MLP(n_hidden=[8], n_classes=3, input_dim=10, weight_scale=0.1)
+    images, labels = make_test_set()
+    rng = np.random.RandomState(2)
+
+    expected = []
+    with AsyncEvaluator(MLPSnapshotModel(net, batch_size=16), make_test_set, 3, batch_size=16,
+                        n_slots=3) as evaluator:
+        for step in range(3):
+            net.train_batch(rng.normal(size=(20, 10)), rng.randint(3, size=20), {'learning_rate': 0.5})
+            # the snapshot is a copy, the next updates do not change its results
+            assert evaluator.publish(step, net)
+            expected.append(evaluate_logits(net.predict, images, labels, 3, batch_size=16))
+        assert not evaluator.publish(3, net) and evaluator.n_skipped == 1
+        results = evaluator.poll(wait=True)
+
+    assert [result['step'] for result in results] == [0, 1, 2]
+    for result, wanted in zip(results, expected):
+        np.testing.assert_allclose(result['loss'], wanted['loss'])
+        assert result['accuracy'] == wanted['accuracy']
+        np.testing.assert_array_equal(result['confusion_matrix'], wanted['confusion_matrix'])
+        assert result['confusion_matrix'].sum() == 50
+
+
+def test_evaluator_errors_are_raised_by_poll():
+    net = MLP(n_hidden=[8], n_classes=3, input_dim=10)
+    with AsyncEvaluator(MLPSnapshotModel(net), missing_test_set, 3) as evaluator:
+        evaluator.publish(0, net)
+        with pytest.raises(IOError, match='no test set'):
+            evaluator.poll(wait=True)
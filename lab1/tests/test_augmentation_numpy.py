@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from augmentation_numpy import Augmenter, affine_transform, random_affine_maps, random_crop, random_flip
+
+
+def make_images(batch_size=6):
+    return np.random.RandomState(0).uniform(0, 255, size=(batch_size, 8, 8, 3)).astype(np.float32)
+
+
+def test_identity_and_integer_shift_maps():
+    images = make_images()
+    matrices, offsets = random_affine_maps(6, 8, 8, np.random.RandomState(1))
+    np.testing.assert_allclose(matrices, np.tile(np.eye(2), (6, 1, 1)))
+    np.testing.assert_allclose(affine_transform(images, matrices, offsets), images, atol=1e-4)
+
+    # sampling one column to the right, the last column is repeated at the border
+    shifted = affine_transform(images, matrices, offsets + [0., 1.])
+    np.testing.assert_allclose(shifted[:, :, :-1], images[:, :, 1:], atol=1e-4)
+    np.testing.assert_allclose(shifted[:, :, -1], images[:, :, -1], atol=1e-4)
+
+
+def test_crops_are_windows_of_the_padded_images():
+    images = make_images()
+    crops = random_crop(images, 2, np.random.RandomState(1))
+    padded = np.pad(images, ((0, 0), (2, 2), (2, 2), (0, 0)), mode='constant')
+
+    for crop, image in zip(crops, padded):
+        windows = [image[i:i + 8, j:j + 8] for i in range(5) for j in range(5)]
+        assert any(np.array_equal(crop, window) for window in windows)
+
+
+def test_flips_mirror_some_images():
+    images = make_images(20)
+    flipped = random_flip(images.copy(), np.random.RandomState(1))
+    mirrored = [np.array_equal(f, image[:, ::-1]) for f, image in zip(flipped, images)]
+    kept = [np.array_equal(f, image) for f, image in zip(flipped, images)]
+    assert all(m or k for m, k in zip(mirrored, kept)) and any(mirrored) and any(kept)
+
+
+def test_augmenter_is_reproducible():
+    augmenter = Augmenter(padding=2, horizontal_flip=True, rotation_range=15., shift_range=0.1,
+                          shear_range=0.2, zoom_range=0.1)
+    images = make_images()
+    augmented = augmenter(images, np.random.RandomState(3))
+
+    assert augmented.dtype == np.float32 and augmented.shape == images.shape
+    np.testing.assert_array_equal(augmenter(images, np.random.RandomState(3)), augmented)
+    assert not np.array_equal(augmenter(images, np.random.RandomState(4)), augmented)
+    np.testing.assert_array_equal(Augmenter()(images, np.random.RandomState(3)), images)
@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import cifar10_utils
+from cifar10_utils import DataSet, build_cache, get_cifar10_raw_data, load_cache
+
+
+def test_cache_round_trip(cifar10_folder):
+    raw = get_cifar10_raw_data(cifar10_folder)
+    assert load_cache(cifar10_folder) is None
+
+    cache_folder = build_cache(cifar10_folder)
+    arrays = load_cache(cifar10_folder)
+    for name, expected in zip(cifar10_utils.CACHE_ARRAYS, raw):
+        assert isinstance(arrays[name], np.memmap)
+        np.testing.assert_array_equal(arrays[name], expected)
+        assert arrays[name].dtype == expected.dtype
+    np.testing.assert_allclose(arrays['image_stats'].mean, raw[0].mean(axis=0))
+    assert not [f for f in os.listdir(cache_folder) if f.endswith('.tmp')]
+
+    # a valid cache is not rebuilt
+    mtime = os.stat(os.path.join(cache_folder, 'train_images.npy')).st_mtime_ns
+    build_cache(cifar10_folder)
+    assert os.stat(os.path.join(cache_folder, 'train_images.npy')).st_mtime_ns == mtime
+
+
+def test_cache_is_invalidated(cifar10_folder):
+    cache_folder = build_cache(cifar10_folder)
+    meta_filename = os.path.join(cache_folder, 'meta.json')
+
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    with open(meta_filename, 'w') as f:
+        json.dump(dict(meta, version=meta['version'] - 1), f)
+    assert load_cache(cifar10_folder) is None
+
+    build_cache(cifar10_folder)
+    assert load_cache(cifar10_folder) is not None
+    # a changed source batch invalidates the cache
+    os.utime(os.path.join(cifar10_folder, 'test_batch'), ns=(0, 0))
+    assert load_cache(cifar10_folder) is None
+
+    # an interrupted build, without meta.json, is never loaded
+    build_cache(cifar10_folder)
+    os.remove(meta_filename)
+    assert load_cache(cifar10_folder) is None
+
+
+def test_concurrent_builds_load_once(cifar10_folder, monkeypatch):
+    loads = []
+    load = cifar10_utils.get_cifar10_raw_data
+
+    def counting_load(data_dir):
+        loads.append(data_dir)
+        return load(data_dir)
+
+    monkeypatch.setattr(cifar10_utils, 'get_cifar10_raw_data', counting_load)
+    # every thread opens its own lock file description, so flock serializes them like processes
+    with ThreadPoolExecutor(4) as pool:
+        folders = list(pool.map(build_cache, [cifar10_folder] * 4))
+
+    assert len(loads) == 1 and len(set(folders)) == 1
+    assert load_cache(cifar10_folder) is not None
+
+
+def make_dataset(n=30, labels_as_ids=False, **kwargs):
+    rng = np.random.RandomState(0)
+    images = rng.randint(256, size=(n, 4, 4, 3)).astype(np.uint8)
+    # with labels_as_ids, every label is the index of its image, to follow the order of the batches
+    labels = np.arange(n) if labels_as_ids else np.arange(n) % 5
+    return DataSet(images, labels, **kwargs)
+
+
+def test_batches_are_normalized_from_uint8():
+    dataset = make_dataset(mean_image=np.full((4, 4, 3), 100., dtype=np.float32),
+                           std_image=np.full(3, 50., dtype=np.float32), scale=2., num_classes=5)
+    images, labels = dataset.next_batch(10)
+
+    assert dataset.raw_images.dtype == np.uint8 and images.dtype == np.float32
+    np.testing.assert_allclose(images, (dataset.raw_images[:10] - 100.) / 50. * 2., rtol=1e-6)
+    np.testing.assert_array_equal(labels, np.eye(5)[dataset.raw_labels[:10]])
+    np.testing.assert_allclose(np.asarray(dataset.images)[:10], images)
+
+    # batches written into given buffers equal the new arrays
+    reference = make_dataset(mean_image=np.full((4, 4, 3), 100., dtype=np.float32), num_classes=5)
+    buffers = tuple(np.empty(shape, dtype=np.float32) for shape in reference.batch_shapes(8))
+    expected = make_dataset(mean_image=np.full((4, 4, 3), 100., dtype=np.float32), num_classes=5)
+    for _ in range(3):
+        for actual, wanted in zip(reference.next_batch(8, out=buffers), expected.next_batch(8)):
+            np.testing.assert_array_equal(actual, wanted)
+
+
+def epoch_labels(dataset, batch_size, n_batches):
+    return np.concatenate([dataset.next_batch(batch_size)[1] for _ in range(n_batches)])
+
+
+def test_seeded_epochs_are_reproducible_permutations():
+    dataset = make_dataset(labels_as_ids=True, seed=3)
+    epochs = [epoch_labels(dataset, 10, 3) for _ in range(3)]
+
+    for order in epochs:
+        np.testing.assert_array_equal(np.sort(order), np.arange(30))
+    assert not np.array_equal(epochs[0], epochs[1])
+    np.testing.assert_array_equal(epoch_labels(make_dataset(labels_as_ids=True, seed=3), 10, 9),
+                                  np.concatenate(epochs))
+    assert dataset.epochs_completed == 2
+
+    # without a seed the first epoch is in stored order
+    np.testing.assert_array_equal(epoch_labels(make_dataset(labels_as_ids=True), 10, 3), np.arange(30))
+
+
+def test_set_state_resumes_the_order():
+    dataset = make_dataset(labels_as_ids=True, seed=3)
+    epoch_labels(dataset, 7, 6)
+    state = dataset.get_state()
+    expected = epoch_labels(dataset, 7, 10)
+
+    resumed = make_dataset(labels_as_ids=True, seed=3)
+    resumed.set_state(state)
+    np.testing.assert_array_equal(epoch_labels(resumed, 7, 10), expected)
+
+
+def test_threaded_load_equals_serial_load(cifar10_folder, capsys):
+    serial = cifar10_utils.load_cifar10(cifar10_folder, n_workers=1)
+    threaded = cifar10_utils.load_cifar10(cifar10_folder, n_workers=4)
+    assert capsys.readouterr().out == ''
+
+    for expected, actual in zip(serial, threaded):
+        np.testing.assert_array_equal(actual, expected)
+    X_train, Y_train, X_test, Y_test = serial
+    assert X_train.shape == (500, 32, 32, 3) and X_test.shape == (100, 32, 32, 3)
+    np.testing.assert_array_equal(X_test, cifar10_utils.load_cifar10_batch(
+        os.path.join(cifar10_folder, 'test_batch'))[0])
+
+    cifar10_utils.load_cifar10(cifar10_folder, n_workers=2, verbose=True)
+    assert 'CIFAR10 images' in capsys.readouterr().out
+
+
+def test_threaded_load_raises_for_missing_batches(cifar10_folder):
+    os.remove(os.path.join(cifar10_folder, 'data_batch_3'))
+    with pytest.raises(IOError):
+        cifar10_utils.load_cifar10(cifar10_folder, n_workers=4)
+
+
+def test_streaming_stats_match_two_pass_stats(tmp_path):
+    # a large offset makes the naive sum of squares lose precision
+    images = np.random.RandomState(0).normal(1e4, 3., size=(257, 4, 4, 3))
+    stats = cifar10_utils.compute_image_stats(images, chunk_size=50)
+
+    assert stats.count == 257
+    np.testing.assert_allclose(stats.mean, images.mean(axis=0))
+    np.testing.assert_allclose(stats.get_std(), images.std(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(stats.get_mean(per_channel=True), images.reshape(-1, 3).mean(axis=0))
+    np.testing.assert_allclose(stats.get_std(per_channel=True), images.reshape(-1, 3).std(axis=0), rtol=1e-6)
+
+    # merging the stats of shards equals the stats of all images
+    merged = cifar10_utils.ImageStats(images.shape[1:])
+    for shard in [images[:100], images[100:101], images[101:]]:
+        merged.merge(cifar10_utils.compute_image_stats(shard))
+    np.testing.assert_allclose(merged.mean, stats.mean)
+    np.testing.assert_allclose(merged.m2, stats.m2, rtol=1e-9)
+
+    stats.save(str(tmp_path / 'stats.npz'))
+    loaded = cifar10_utils.ImageStats.load(str(tmp_path / 'stats.npz'))
+    assert loaded.count == stats.count
+    np.testing.assert_array_equal(loaded.m2, stats.m2)
+
+
+@pytest.mark.parametrize('normalization', cifar10_utils.NORMALIZATIONS)
+def test_saved_normalization_matches_the_dataset(tmp_path, normalization):
+    images = np.random.RandomState(0).randint(256, size=(40, 4, 4, 3)).astype(np.uint8)
+    mean_image, std_image = cifar10_utils.compute_image_stats(images).normalization(normalization)
+    dataset = DataSet(images, np.zeros(40, dtype=np.int64), mean_image=mean_image, std_image=std_image)
+    normalized = np.asarray(dataset.images)
+
+    np.testing.assert_allclose(normalized.mean(axis=0 if normalization != 'channel' else (0, 1, 2)), 0.,
+                               atol=1e-4)
+    if normalization != 'mean':
+        np.testing.assert_allclose(normalized.std(axis=0 if normalization == 'pixel' else (0, 1, 2)), 1.,
+                                   rtol=1e-4)
+
+    dataset.save_normalization(str(tmp_path / 'normalization.npz'))
+    image_shape, normalize = cifar10_utils.load_normalization(str(tmp_path / 'normalization.npz'))
+    assert image_shape == (4, 4, 3)
+    np.testing.assert_array_equal(normalize(images), normalized)
@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from data_parallel_numpy import DataParallelTrainer
+from mlp_numpy import MLP
+
+MLP_KWARGS = dict(n_hidden=[8], n_classes=3, input_dim=10, weight_decay=0.01, weight_scale=0.1)
+
+
+def make_batches(n_batches, batch_size):
+    rng = np.random.RandomState(1)
+    return [(rng.normal(size=(batch_size, MLP_KWARGS['input_dim'])), rng.randint(3, size=batch_size))
+            for _ in range(n_batches)]
+
+
+def test_data_parallel_matches_single_process():
+    flags = {'learning_rate': 0.1}
+    # the last batch leaves one of the 3 workers without datapoints
+    batches = make_batches(3, 9) + make_batches(1, 2)
+
+    np.random.seed(0)
+    net = MLP(**MLP_KWARGS)
+    expected = [net.train_batch(x, labels, flags) for x, labels in batches]
+
+    np.random.seed(0)
+    with DataParallelTrainer(3, 9, **MLP_KWARGS) as trainer:
+        actual = [trainer.train_batch(x, labels, flags) for x, labels in batches]
+        params = trainer.net.parameters.params.copy()
+
+    np.testing.assert_allclose(actual, expected)
+    np.testing.assert_allclose(params, net.parameters.params, atol=1e-12)
+
+
+def test_data_parallel_rejects_micro_batches():
+    x, labels = make_batches(1, 4)[0]
+    with DataParallelTrainer(1, 4, **MLP_KWARGS) as trainer:
+        with pytest.raises(ValueError):
+            trainer.train_batch(x, labels, {'learning_rate': 0.1, 'micro_batch_size': 2})
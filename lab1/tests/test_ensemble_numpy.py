@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from ensemble_numpy import MLPEnsemble
+
+
+def test_ensemble_matches_standalone_models():
+    np.random.seed(0)
+    ensemble = MLPEnsemble(n_hidden=[8, 6], n_classes=3, input_dim=10, weight_decays=[0., 0.01, 0.1],
+                           weight_scales=[0.1, 0.2, 0.3], learning_rates=[0.1, 0.05, 0.01])
+    models = [ensemble.model(m) for m in range(ensemble.n_models)]
+
+    rng = np.random.RandomState(1)
+    for _ in range(4):
+        x, labels = rng.normal(size=(16, 10)), rng.randint(3, size=16)
+        losses, accuracies = ensemble.train_batch(x, labels)
+        for m, net in enumerate(models):
+            loss, accuracy = net.train_batch(x, labels, {'learning_rate': ensemble.learning_rates[m]})
+            np.testing.assert_allclose(losses[m], loss)
+            assert accuracies[m] == accuracy
+
+    x, labels = rng.normal(size=(25, 10)), rng.randint(3, size=25)
+    losses, accuracies = ensemble.evaluate(x, labels, batch_size=10)
+    for m, net in enumerate(models):
+        np.testing.assert_allclose(ensemble.model(m).parameters.params, net.parameters.params)
+        loss, accuracy = net.evaluate(x, labels, batch_size=10)
+        np.testing.assert_allclose(losses[m], loss)
+        assert accuracies[m] == accuracy
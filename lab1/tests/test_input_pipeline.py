@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from augmentation_numpy import Augmenter
+from cifar10_utils import DataSet
+from input_pipeline import Prefetcher
+
+
+def make_dataset(n=30):
+    rng = np.random.RandomState(0)
+    images = rng.randint(256, size=(n, 8, 8, 3)).astype(np.uint8)
+    return DataSet(images, np.arange(n), mean_image=np.float32(128.), num_classes=n, seed=1)
+
+
+class FailingDataSet(object):
+    """
+    DataSet that raises from next_batch after n_batches batches.
+    """
+
+    def __init__(self, n_batches):
+        self.dataset = make_dataset()
+        self.n_batches = n_batches
+
+    def batch_shapes(self, batch_size):
+        return self.dataset.batch_shapes(batch_size)
+
+    def next_batch(self, batch_size, allow_smaller_final_batch=False, out=None):
+        if self.n_batches == 0:
+            raise IOError('shard missing')
+        self.n_batches -= 1
+        return self.dataset.next_batch(batch_size, allow_smaller_final_batch, out)
+
+
+@pytest.mark.parametrize('reuse_buffers', [False, True])
+@pytest.mark.parametrize('allow_smaller_final_batch', [False, True])
+def test_prefetched_batches_equal_the_dataset(reuse_buffers, allow_smaller_final_batch):
+    expected = make_dataset()
+    with Prefetcher(make_dataset(), 7, capacity=2, reuse_buffers=reuse_buffers,
+                    allow_smaller_final_batch=allow_smaller_final_batch) as prefetcher:
+        for _ in range(12):
+            images, labels = prefetcher.next_batch()
+            wanted_images, wanted_labels = expected.next_batch(
+                7, allow_smaller_final_batch=allow_smaller_final_batch)
+            np.testing.assert_array_equal(images, wanted_images)
+            np.testing.assert_array_equal(labels, wanted_labels)
+        assert prefetcher.n_batches == 12
+
+
+def test_transform_in_workers_equals_transform_on_the_thread():
+    augmenter = Augmenter(padding=2, horizontal_flip=True)
+    batches = []
+    for n_workers in [0, 2]:
+        with Prefetcher(make_dataset(), 8, transform=augmenter, n_workers=n_workers, seed=4) as prefetcher:
+            batches.append([prefetcher.next_batch() for _ in range(5)])
+
+    for (images, labels), (worker_images, worker_labels) in zip(*batches):
+        np.testing.assert_array_equal(worker_images, images)
+        np.testing.assert_array_equal(worker_labels, labels)
+
+
+def test_producer_exception_is_raised_on_every_call():
+    prefetcher = Prefetcher(FailingDataSet(3), 5)
+    for _ in range(3):
+        prefetcher.next_batch()
+    for _ in range(3):
+        with pytest.raises(IOError, match='shard missing'):
+            prefetcher.next_batch()
+    with pytest.raises(IOError):
+        prefetcher.close()
+
+    # leaving the with block with the exception does not raise a second one from close
+    with pytest.raises(IOError):
+        with Prefetcher(FailingDataSet(0), 5) as prefetcher:
+            prefetcher.next_batch()
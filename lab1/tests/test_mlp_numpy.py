@@ -0,0 +1,226 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+import mlp_numpy
+from mlp_numpy import MLP
+from training_stats import StatsCollector
+
+INPUT_DIM = 12
+N_HIDDEN = [8, 6]
+N_CLASSES = 4
+
+
+def make_mlp(seed=0, **kwargs):
+    np.random.seed(seed)
+    kwargs.setdefault('weight_scale', 0.1)
+    return MLP(n_hidden=N_HIDDEN, n_classes=N_CLASSES, input_dim=INPUT_DIM,
+               stats=StatsCollector(enabled=False), **kwargs)
+
+
+def make_batch(batch_size, seed=1):
+    rng = np.random.RandomState(seed)
+    return rng.normal(size=(batch_size, INPUT_DIM)), rng.randint(N_CLASSES, size=batch_size)
+
+
+@pytest.mark.parametrize('layout', ['dim_first', 'batch_major'])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_workspace_matches_allocating_passes(layout, dtype):
+    allocating = make_mlp(layout=layout, dtype=dtype, weight_decay=0.01)
+    workspace = make_mlp(layout=layout, dtype=dtype, weight_decay=0.01, workspace=True)
+    flags = {'learning_rate': 0.1}
+
+    for step in range(5):
+        # alternate batch sizes, so several workspaces are reused
+        x, labels = make_batch(16 if step % 2 else 7, seed=step)
+        expected = allocating.train_batch(x, labels, flags)
+        actual = workspace.train_batch(x, labels, flags)
+        np.testing.assert_allclose(actual, expected, rtol=1e-6)
+
+    np.testing.assert_array_equal(workspace.parameters.params, allocating.parameters.params)
+    x, _ = make_batch(7, seed=10)
+    np.testing.assert_array_equal(workspace.inference(x), allocating.inference(x))
+
+
+@pytest.mark.parametrize('layout', ['dim_first', 'batch_major'])
+def test_parameters_are_views_of_one_flat_buffer(layout):
+    net = make_mlp(layout=layout)
+    store = net.parameters
+
+    assert store.params.size == sum(layer.W.size + layer.b.size for layer in net.layers)
+    for layer in net.layers:
+        assert np.shares_memory(layer.W, store.weights) and np.shares_memory(layer.b, store.biases)
+        assert np.shares_memory(layer.dW, store.weight_grads) and np.shares_memory(layer.db, store.bias_grads)
+
+    # a model built on an existing flat array uses it in place
+    params = store.params.copy()
+    copy = MLP(n_hidden=N_HIDDEN, n_classes=N_CLASSES, input_dim=INPUT_DIM, layout=layout, params=params)
+    assert copy.parameters.params is params
+    x, _ = make_batch(5)
+    np.testing.assert_array_equal(copy.inference(x), net.inference(x))
+
+    params *= 2.
+    np.testing.assert_array_equal(copy.layers[0].W, 2. * net.layers[0].W)
+
+
+def test_flat_update_matches_per_layer_sgd():
+    net = make_mlp(weight_decay=0.01)
+    before = [(layer.W.copy(), layer.b.copy()) for layer in net.layers]
+    x, labels = make_batch(8)
+    net.train_batch(x, labels, {'learning_rate': 0.1})
+
+    for layer, (W, b) in zip(net.layers, before):
+        np.testing.assert_allclose(layer.W, W - 0.1 * (layer.dW + 0.01 * W))
+        np.testing.assert_allclose(layer.b, b - 0.1 * layer.db)
+
+
+def test_clip_gradients_scales_the_global_norm():
+    net = make_mlp()
+    x, labels = make_batch(8)
+    net.accumulate_gradients(x, labels, 8, accumulate=False)
+    grads = net.parameters.grads.copy()
+    norm = np.linalg.norm(grads)
+
+    assert net.parameters.clip_gradients(norm / 2) == pytest.approx(norm)
+    np.testing.assert_allclose(net.parameters.grads, grads / 2)
+
+
+@pytest.mark.parametrize('micro_batch_size', [1, 4, 5, 12])
+def test_micro_batches_match_the_full_batch(micro_batch_size):
+    full = make_mlp(weight_decay=0.01)
+    micro = make_mlp(weight_decay=0.01)
+    x, labels = make_batch(12)
+
+    expected = full.train_batch(x, labels, {'learning_rate': 0.1})
+    actual = micro.train_batch(x, labels, {'learning_rate': 0.1, 'micro_batch_size': micro_batch_size})
+
+    np.testing.assert_allclose(actual, expected)
+    np.testing.assert_allclose(micro.parameters.grads, full.parameters.grads, atol=1e-12)
+    np.testing.assert_allclose(micro.parameters.params, full.parameters.params, atol=1e-12)
+
+
+def test_compute_gradients_does_not_update():
+    net = make_mlp()
+    params = net.parameters.params.copy()
+    x, labels = make_batch(8)
+    net.loss(net.inference(x), labels)
+    net.compute_gradients()
+
+    np.testing.assert_array_equal(net.parameters.params, params)
+    assert np.any(net.parameters.grads)
+
+
+def test_integer_labels_match_one_hot_labels():
+    net = make_mlp(weight_decay=0.01)
+    x, labels = make_batch(9)
+    one_hot = np.eye(N_CLASSES)[labels]
+    logits = net.inference(x)
+
+    # the one-hot loss adds 1e-6 to the true class probability, the fused integer path does not
+    np.testing.assert_allclose(net.loss(logits, labels), net.loss(logits, one_hot), rtol=1e-5)
+    delta = net.delta_out.copy()
+    net.loss(logits, one_hot)
+    np.testing.assert_allclose(net.delta_out, delta)
+    assert net.accuracy(logits, labels) == net.accuracy(logits, one_hot)
+
+    dense = make_mlp(weight_decay=0.01)
+    np.testing.assert_allclose(net.train_batch(x, labels, {'learning_rate': 0.1}),
+                               dense.train_batch(x, one_hot, {'learning_rate': 0.1}), rtol=1e-5)
+    np.testing.assert_allclose(net.parameters.params, dense.parameters.params)
+
+
+@pytest.mark.parametrize('layout', ['dim_first', 'batch_major'])
+def test_chunked_predict_and_evaluate_match_inference(layout):
+    net = make_mlp(layout=layout, weight_decay=0.01)
+    x, labels = make_batch(23)
+    logits = net.inference(x).copy()
+    loss, accuracy = net.loss(logits, labels), net.accuracy(logits, labels)
+    net.activation_cache.clear()
+
+    np.testing.assert_allclose(net.predict(x, batch_size=5), logits)
+    np.testing.assert_allclose(net.evaluate(x, labels, batch_size=5), (loss, accuracy))
+    np.testing.assert_allclose(net.evaluate(x, np.eye(N_CLASSES)[labels], batch_size=7), (loss, accuracy),
+                               rtol=1e-5)
+    # no backprop caches are kept
+    assert not net.activation_cache
+
+
+def test_batch_major_layout_matches_dim_first():
+    dim_first = make_mlp(weight_decay=0.01)
+    batch_major = make_mlp(weight_decay=0.01, layout='batch_major')
+    for layer, other in zip(dim_first.layers, batch_major.layers):
+        np.testing.assert_array_equal(other.W, layer.W.T)
+
+    for step in range(3):
+        x, labels = make_batch(10, seed=step)
+        np.testing.assert_allclose(batch_major.train_batch(x, labels, {'learning_rate': 0.1}),
+                                   dim_first.train_batch(x, labels, {'learning_rate': 0.1}))
+    for layer, other in zip(dim_first.layers, batch_major.layers):
+        np.testing.assert_allclose(other.W, layer.W.T)
+        np.testing.assert_allclose(other.b.ravel(), layer.b.ravel())
+    x, _ = make_batch(6, seed=10)
+    np.testing.assert_allclose(batch_major.inference(x), dim_first.inference(x))
+
+
+def test_layout_is_saved_with_the_model(tmp_path):
+    net = make_mlp(layout='batch_major')
+    path = str(tmp_path / 'model')
+    net.save(path)
+    loaded = MLP.load(path)
+
+    assert loaded.layout == 'batch_major'
+    x, _ = make_batch(4)
+    np.testing.assert_array_equal(loaded.predict(x), net.predict(x))
+    with pytest.raises(ValueError):
+        make_mlp(layout='column_major')
+
+
+def test_fit_on_memory_mapped_chunks_matches_train_batch(tmp_path):
+    x, labels = make_batch(40)
+    np.save(str(tmp_path / 'x.npy'), x)
+    np.save(str(tmp_path / 'labels.npy'), labels)
+    x_mmap = np.load(str(tmp_path / 'x.npy'), mmap_mode='r')
+    labels_mmap = np.load(str(tmp_path / 'labels.npy'), mmap_mode='r')
+
+    reference = make_mlp()
+    for epoch in range(2):
+        for start in range(0, 40, 8):
+            reference.train_batch(x[start:start + 8], labels[start:start + 8], {'learning_rate': 0.1})
+
+    # the last chunk of every epoch is smaller, the batches are the same as the reference ones
+    net = make_mlp()
+    chunks = list(mlp_numpy.iterate_chunks(x_mmap, labels_mmap, 16, epochs=2))
+    net.fit(chunks[:1], flags={'learning_rate': 0.1}, batch_size=8)
+    net.fit(chunks[1:])
+    assert net.stats.step == reference.stats.step == 10
+    np.testing.assert_allclose(net.parameters.params, reference.parameters.params)
+
+    # fit stops at the first chunk boundary after max_steps updates
+    net.fit(chunks, max_steps=12)
+    assert net.stats.step == 12
+    with pytest.raises(ValueError):
+        make_mlp().partial_fit(x, labels)
+
+
+@pytest.mark.parametrize('layout', ['dim_first', 'batch_major'])
+@pytest.mark.parametrize('workspace', [False, True])
+def test_sparse_inputs_match_dense_inputs(layout, workspace):
+    sparse = pytest.importorskip('scipy.sparse')
+    dense_net = make_mlp(layout=layout, workspace=workspace)
+    sparse_net = make_mlp(layout=layout, workspace=workspace)
+
+    for step in range(3):
+        x, labels = make_batch(10, seed=step)
+        x[np.abs(x) < 1.] = 0.
+        # COO cannot be sliced by rows and must be converted before micro-batching
+        x_sparse = sparse.coo_matrix(x) if step == 0 else sparse.csr_matrix(x)
+        flags = {'learning_rate': 0.1, 'micro_batch_size': 4 if step == 1 else None}
+        np.testing.assert_allclose(sparse_net.train_batch(x_sparse, labels, flags),
+                                   dense_net.train_batch(x, labels, flags))
+    np.testing.assert_allclose(sparse_net.parameters.params, dense_net.parameters.params)
+    np.testing.assert_allclose(sparse_net.predict(sparse.coo_matrix(x), batch_size=3), dense_net.predict(x))
+    np.testing.assert_allclose(sparse_net.evaluate(sparse.csr_matrix(x), labels, batch_size=3),
+                               dense_net.evaluate(x, labels, batch_size=3))
@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from optimizers_numpy import OPTIMIZER_DICT
+
+
+def reference_steps(name, params, grads, decays, learning_rate, n_steps):
+    """
+    Textbook updates, allocating new arrays every step.
+    """
+    params = [p.copy() for p in params]
+    first = [np.zeros_like(p) for p in params]
+    second = [np.zeros_like(p) for p in params]
+    for t in range(1, n_steps + 1):
+        for k, (grad, decay) in enumerate(zip(grads, decays)):
+            g = grad + decay * params[k]
+            if name == 'sgd':
+                params[k] = params[k] - learning_rate * g
+            elif name in ['momentum', 'nesterov']:
+                first[k] = 0.9 * first[k] + g
+                step = g + 0.9 * first[k] if name == 'nesterov' else first[k]
+                params[k] = params[k] - learning_rate * step
+            else:
+                first[k] = 0.9 * first[k] + 0.1 * g
+                second[k] = 0.999 * second[k] + 0.001 * g ** 2
+                m_hat, v_hat = first[k] / (1 - 0.9 ** t), second[k] / (1 - 0.999 ** t)
+                # bias correction folded into the step size moves epsilon to the uncorrected sqrt(v)
+                params[k] = params[k] - learning_rate * m_hat / (np.sqrt(v_hat) + 1e-8 / np.sqrt(1 - 0.999 ** t))
+    return params
+
+
+@pytest.mark.parametrize('name', sorted(OPTIMIZER_DICT))
+def test_in_place_updates_match_the_textbook(name):
+    rng = np.random.RandomState(0)
+    params = [rng.normal(size=(4, 3)), rng.normal(size=(5,))]
+    grads = [rng.normal(size=(4, 3)), rng.normal(size=(5,))]
+    grads_before = [g.copy() for g in grads]
+    expected = reference_steps(name, params, grads, [0.1, 0.], 0.01, 3)
+
+    optimizer = OPTIMIZER_DICT[name](learning_rate=0.01)
+    for _ in range(3):
+        optimizer.apply(params, grads, [0.1, 0.])
+
+    for param, wanted in zip(params, expected):
+        np.testing.assert_allclose(param, wanted)
+    for grad, before in zip(grads, grads_before):
+        np.testing.assert_array_equal(grad, before)
+    assert optimizer.iterations == 3
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from mlp_numpy import MLP
+from optimizers_numpy import Momentum
+from pruning_numpy import densities, magnitude_prune, update_sparse_execution
+
+MLP_KWARGS = dict(n_hidden=[20, 10], n_classes=4, input_dim=30, weight_scale=0.1)
+
+
+def make_pruned_pair(layout, sparsity=0.9):
+    np.random.seed(0)
+    dense = MLP(layout=layout, **MLP_KWARGS)
+    magnitude_prune(dense, sparsity)
+    sparse = MLP(layout=layout, params=dense.parameters.params.copy(), **MLP_KWARGS)
+    for layer, dense_layer in zip(sparse.layers, dense.layers):
+        layer.mask = dense_layer.mask
+    assert all(update_sparse_execution(sparse, threshold=1.))
+    assert not any(update_sparse_execution(dense, threshold=0.))
+    return dense, sparse
+
+
+def make_batch(batch_size, seed=1):
+    rng = np.random.RandomState(seed)
+    return rng.normal(size=(batch_size, MLP_KWARGS['input_dim'])), rng.randint(4, size=batch_size)
+
+
+@pytest.mark.parametrize('layout', ['dim_first', 'batch_major'])
+def test_csr_execution_matches_dense(layout):
+    dense, sparse = make_pruned_pair(layout)
+    x, labels = make_batch(16)
+    np.testing.assert_allclose(sparse.inference(x), dense.inference(x))
+    np.testing.assert_allclose(sparse.predict(x, batch_size=5), dense.predict(x, batch_size=5))
+
+    # the CSR copies follow the updates
+    flags = {'learning_rate': 0.1}
+    for step in range(3):
+        x, labels = make_batch(16, seed=step)
+        np.testing.assert_allclose(sparse.train_batch(x, labels, flags), dense.train_batch(x, labels, flags))
+    np.testing.assert_allclose(sparse.parameters.params, dense.parameters.params)
+    np.testing.assert_allclose(sparse.inference(x), dense.inference(x))
+
+
+def test_pruned_weights_stay_zero_under_momentum():
+    np.random.seed(0)
+    net = MLP(**MLP_KWARGS)
+    flags = {'optimizer': Momentum(learning_rate=0.1)}
+    # momentum from before pruning would move the pruned weights again
+    net.train_batch(*make_batch(16), flags=flags)
+    magnitude_prune(net, 0.8)
+    expected = densities(net)
+
+    for step in range(3):
+        net.train_batch(*make_batch(16, seed=step), flags=flags)
+    assert densities(net) == expected
+    for layer in net.layers:
+        assert not np.any(layer.W[~layer.mask])
+
+
+def test_masks_are_saved_and_loaded(tmp_path):
+    np.random.seed(0)
+    net = MLP(**MLP_KWARGS)
+    magnitude_prune(net, 0.9)
+    path = str(tmp_path / 'model')
+    net.save(path)
+
+    loaded = MLP.load(path, mmap_mode=None)
+    for layer, loaded_layer in zip(net.layers, loaded.layers):
+        np.testing.assert_array_equal(loaded_layer.mask, layer.mask)
+    assert all(update_sparse_execution(loaded, threshold=1.))
+
+    # weights that happen to be zero are not pruned
+    unpruned = MLP(**MLP_KWARGS)
+    unpruned.parameters.weights[:] = 0.
+    assert not any(update_sparse_execution(unpruned, threshold=1.))
+    unpruned.save(path)
+    assert all(layer.mask is None for layer in MLP.load(path).layers)
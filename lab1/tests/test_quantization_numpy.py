@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from mlp_numpy import MLP
+from quantization_numpy import EXACT_BLOCK_SIZE, QUANT_MAX, QuantizedMLP, int8_gemm
+
+
+def test_int8_gemm_is_exact():
+    rng = np.random.RandomState(0)
+    # several blocks of the inner dimension, and the extreme values in every product
+    K = 2 * EXACT_BLOCK_SIZE + 7
+    W_q = rng.randint(-QUANT_MAX, QUANT_MAX + 1, size=(5, K)).astype(np.int8)
+    x_q = rng.randint(-QUANT_MAX, QUANT_MAX + 1, size=(K, 3)).astype(np.int8)
+    W_q[0], x_q[:, 0] = QUANT_MAX, QUANT_MAX
+
+    expected = np.dot(W_q.astype(np.int64), x_q.astype(np.int64))
+    np.testing.assert_array_equal(int8_gemm(W_q, x_q), expected)
+    np.testing.assert_array_equal(int8_gemm(W_q, x_q.astype(np.float32)), expected)
+    np.testing.assert_array_equal(int8_gemm(W_q, np.asfortranarray(x_q)), expected)
+
+
+def test_quantized_logits_stay_close_to_float(tmp_path):
+    np.random.seed(0)
+    net = MLP(n_hidden=[64, 32], n_classes=10, input_dim=100, weight_scale=0.1, dtype=np.float32)
+    rng = np.random.RandomState(1)
+    calibration = [rng.normal(size=(50, 100)) for _ in range(2)]
+    quantized = QuantizedMLP.from_mlp(net, calibration)
+
+    x = rng.normal(size=(200, 100)).astype(np.float32)
+    expected = net.predict(x)
+    actual = quantized.predict(x, batch_size=64)
+    assert np.max(np.abs(actual - expected)) < 0.05 * np.max(np.abs(expected))
+    assert np.mean(np.argmax(actual, axis=1) == np.argmax(expected, axis=1)) > 0.95
+
+    float_nbytes = sum(layer.W.nbytes + layer.b.nbytes for layer in net.layers)
+    assert quantized.nbytes() < 0.3 * float_nbytes
+
+    path = str(tmp_path / 'quantized')
+    quantized.save(path)
+    np.testing.assert_array_equal(QuantizedMLP.load(path).predict(x), actual)
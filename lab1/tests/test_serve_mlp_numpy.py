@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+import pytest
+
+from mlp_numpy import MLP
+from serve_mlp_numpy import MicroBatcher, _handle_line, _softmax
+
+
+@pytest.fixture
+def batcher():
+    np.random.seed(0)
+    net = MLP(n_hidden=[8], n_classes=3, input_dim=5, weight_scale=0.1)
+    batcher = MicroBatcher(net, 5, max_batch_size=4, max_latency=0.05)
+    yield batcher
+    batcher.close()
+
+
+def test_micro_batches_match_the_model(batcher):
+    x = np.random.RandomState(1).normal(size=(10, 5))
+    futures = [batcher.submit(row) for row in x]
+    probs = np.stack([future.result(timeout=5) for future in futures])
+
+    np.testing.assert_allclose(probs, _softmax(batcher.model.predict(x)))
+    counters = batcher.counters()
+    assert counters['requests'] == 10 and counters['batches'] < 10
+
+
+@pytest.mark.parametrize('line', ['[1, 2]', '3', 'null', '"x"', 'not json', '{"x": [1, 2]}', '{"id": 1}'])
+def test_invalid_requests_get_an_error(batcher, line):
+    responses = []
+    _handle_line(batcher, line, responses.append, 3)
+    assert len(responses) == 1 and 'error' in responses[0]
+
+
+def test_request_gets_top_k(batcher):
+    responses = []
+    _handle_line(batcher, json.dumps({'id': 7, 'x': [0.5] * 5, 'k': 2}), responses.append, 3)
+    batcher.close()
+    assert responses[0]['id'] == 7 and len(responses[0]['top_k']) == 2
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import pytest
+
+import cifar10_utils
+from sharded_dataset import ShardedDataSet, read_sharded_data_sets, write_cifar10_shards, write_shards
+
+N_RECORDS = 30
+
+
+@pytest.fixture
+def shard_folder(tmp_path):
+    """
+    Sharded dataset of N_RECORDS records in shards of 7, every label being the index of its image.
+    """
+    images = np.random.RandomState(0).randint(256, size=(N_RECORDS, 4, 4, 3)).astype(np.uint8)
+    folder = str(tmp_path / 'shards')
+    write_shards(folder, images, np.arange(N_RECORDS), shard_size=7)
+    return folder, images
+
+
+def read_labels(dataset, batch_size, n_batches):
+    return np.concatenate([dataset.next_batch(batch_size)[1] for _ in range(n_batches)])
+
+
+def test_first_unseeded_epoch_is_in_stored_order(shard_folder):
+    folder, images = shard_folder
+    dataset = ShardedDataSet(folder, shuffle_buffer=8)
+    batches = [dataset.next_batch(4, allow_smaller_final_batch=True) for _ in range(8)]
+
+    np.testing.assert_array_equal(np.concatenate([labels for _, labels in batches]), np.arange(N_RECORDS))
+    np.testing.assert_array_equal(np.concatenate([batch for batch, _ in batches]), images)
+    assert dataset.epochs_completed == 0
+
+
+def test_seeded_epochs_are_reproducible_permutations(shard_folder):
+    folder, _ = shard_folder
+    dataset = ShardedDataSet(folder, seed=2, shuffle_buffer=8)
+    epochs = [read_labels(dataset, 5, 6) for _ in range(3)]
+
+    for order in epochs:
+        np.testing.assert_array_equal(np.sort(order), np.arange(N_RECORDS))
+        assert not np.array_equal(order, np.arange(N_RECORDS))
+    assert not np.array_equal(epochs[0], epochs[1])
+    np.testing.assert_array_equal(read_labels(ShardedDataSet(folder, seed=2, shuffle_buffer=8), 5, 18),
+                                  np.concatenate(epochs))
+
+
+def test_set_state_resumes_the_rest_of_the_epoch(shard_folder):
+    folder, _ = shard_folder
+    dataset = ShardedDataSet(folder, seed=2, shuffle_buffer=8)
+    read_labels(dataset, 4, 10)
+    state = dataset.get_state()
+    rest = read_labels(dataset, 2, (N_RECORDS - state['index_in_epoch']) // 2)
+
+    resumed = ShardedDataSet(folder, seed=2, shuffle_buffer=8)
+    resumed.set_state(state)
+    np.testing.assert_array_equal(read_labels(resumed, 2, len(rest) // 2), rest)
+
+    # a DataSet state without batch sizes resumes at the same position
+    resumed.set_state({'epochs_completed': 1, 'index_in_epoch': 12})
+    assert resumed.get_state() == {'epochs_completed': 1, 'index_in_epoch': 12, 'batch_sizes': [[8, 1], [4, 1]]}
+
+
+def test_sharded_arrays_index_like_the_source(shard_folder):
+    folder, images = shard_folder
+    dataset = ShardedDataSet(folder)
+
+    for index in [slice(None), slice(5, 23), slice(20, 3, -3), np.array([29, 0, 7, 14, 6]), 13]:
+        np.testing.assert_array_equal(dataset.raw_images[index], images[index])
+    np.testing.assert_array_equal(np.asarray(dataset.raw_labels), np.arange(N_RECORDS))
+
+
+def test_cifar10_shards_match_the_pickles(cifar10_folder):
+    output_folder = os.path.join(cifar10_folder, 'sharded')
+    write_cifar10_shards(cifar10_folder, output_folder, shard_size=128)
+    X_train, Y_train, X_test, Y_test = cifar10_utils.load_cifar10(cifar10_folder)
+
+    data = read_sharded_data_sets(output_folder, one_hot=False, normalization='pixel')
+    np.testing.assert_array_equal(data.train.raw_images[:], X_train)
+    np.testing.assert_array_equal(data.test.raw_labels[:], Y_test)
+    np.testing.assert_allclose(np.asarray(data.train.images).mean(axis=0), 0., atol=1e-4)
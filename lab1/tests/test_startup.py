@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmark_mlp_numpy import HEAVY_MODULES, STARTUP_MODULES
+
+LAB1_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('module', STARTUP_MODULES)
+def test_numpy_entry_points_skip_heavy_imports(module):
+    script = 'import json, sys; import {}; print(json.dumps(sorted(sys.modules)))'.format(module)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=LAB1_FOLDER)
+    modules = {name.split('.')[0] for name in json.loads(output.decode())}
+    assert not modules & set(HEAVY_MODULES)
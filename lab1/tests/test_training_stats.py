@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from training_stats import StatsCollector, load_stats
+
+
+def test_metrics_are_sampled_and_bounded():
+    stats = StatsCollector(intervals={'*_norm': 3}, capacity=4)
+    evaluated = []
+    for step in range(10):
+        stats.step = step
+        stats.record('loss', step)
+        stats.record('dW_norm', lambda: evaluated.append(step) or step)
+
+    steps, values = stats.get('loss')
+    np.testing.assert_array_equal(steps, [6, 7, 8, 9])
+    np.testing.assert_array_equal(values, [6, 7, 8, 9])
+    # callables are only evaluated when the metric is sampled
+    assert evaluated == [0, 3, 6, 9]
+    np.testing.assert_array_equal(stats.get('dW_norm')[0], [0, 3, 6, 9])
+
+
+def test_disabled_collector_skips_everything():
+    stats = StatsCollector(enabled=False)
+    assert stats.record('loss', lambda: 1 / 0) is None
+    assert stats.names() == []
+
+
+def test_sink_keeps_every_sample(tmp_path):
+    stats = StatsCollector(capacity=3, sink=str(tmp_path))
+    for step in range(10):
+        stats.record('loss', 2. * step, step=step)
+
+    steps, values = stats.get('loss')
+    np.testing.assert_array_equal(steps, np.arange(10))
+    np.testing.assert_array_equal(values, 2. * np.arange(10))
+    np.testing.assert_array_equal(load_stats(str(tmp_path))['loss'][1], values)
@@ -3,11 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
 import os
 
 import tensorflow as tf
 import numpy as np
 import cifar10_utils
+from input_pipeline import Prefetcher
+from augmentation_numpy import Augmenter
+from async_eval import AsyncEvaluator, TFSnapshotModel, cifar10_test_set, tf_snapshot_variables, tf_summary
 from convnet_tf import ConvNet
 from collections import defaultdict
 import pickle
@@ -19,6 +23,10 @@ EVAL_FREQ_DEFAULT = 1000
 CHECKPOINT_FREQ_DEFAULT = 5000
 PRINT_FREQ_DEFAULT = 10
 OPTIMIZER_DEFAULT = 'ADAM'
+PREFETCH_DEFAULT = 0
+NORMALIZATION_DEFAULT = 'mean'
+AUGMENTATION_WORKERS_DEFAULT = 2
+AUGMENTATION_PADDING_DEFAULT = 0
 
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
 LOG_DIR_DEFAULT = './logs/cifar10'
@@ -41,6 +49,33 @@ def _update_stats(stats, train_loss=None, train_accuracy=None, test_loss=None, t
     return stats
 
 
+def _record_eval_results(results, stats, log_writer):
+    """
+    Collects and prints the results of the asynchronous evaluation, the loss is the mean cross entropy
+    """
+    for result in results:
+        stats = _update_stats(stats, test_loss=result['loss'], test_accuracy=result['accuracy'],
+                              test_confusion_matrix=result['confusion_matrix'])
+        log_writer.add_summary(tf_summary(result), result['step'])
+        print('==> Ep.{}: test_nl_likelihood:{:.4f}, test_accuracy:{:.4f}'.format(
+            result['step'], result['loss'], result['accuracy']))
+        print('==> Confusion Matrix on test set \n {} \n'.format(result['confusion_matrix']))
+
+    return stats
+
+
+def _build_eval_model(flags):
+    """
+    Builds the inference graph of the ConvNet in the evaluator process of --async_eval,
+    see async_eval.TFSnapshotModel.
+    """
+    X = tf.placeholder(dtype=tf.float32, shape=[None, 32, 32, 3], name='inputs')
+    net = ConvNet(n_classes=10)
+    net.dropout_rate = flags.dropout_rate
+    net.batch_norm_bool = flags.batch_norm
+    return X, net.inference(X), {net.batch_norm: flags.batch_norm, net.training_mode: False}
+
+
 def _ensure_path_exists(path):
     if not tf.gfile.Exists(path):
         tf.gfile.MakeDirs(path)
@@ -90,7 +125,18 @@ def train():
     batch_size = FLAGS.batch_size
 
     # dataset
-    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir)
+    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir, normalization=FLAGS.normalization)
+
+    # Image augmentation, vectorized per batch in worker processes feeding the prefetch queue
+    augmenter = None
+    if FLAGS.data_augmentation:
+        augmenter = Augmenter(padding=FLAGS.augmentation_padding, horizontal_flip=FLAGS.augmentation_flip,
+                              rotation_range=10, shift_range=0.10, shear_range=0.1, zoom_range=0.1)
+
+    train_data = cifar10.train
+    if FLAGS.prefetch > 0 or augmenter is not None:
+        train_data = Prefetcher(cifar10.train, batch_size, capacity=max(FLAGS.prefetch, 1), reuse_buffers=True,
+                                transform=augmenter, n_workers=FLAGS.augmentation_workers)
 
     # Session
     tf.reset_default_graph()
@@ -142,30 +188,21 @@ def train():
         total_parameters += variable_parameters
     print('Total num of trainable params', total_parameters)
 
+    # test set evaluation of weight snapshots in a separate process, on the CPU
+    evaluator = None
+    if FLAGS.async_eval:
+        evaluator = AsyncEvaluator(TFSnapshotModel(tf_snapshot_variables(), _build_eval_model, (FLAGS,)),
+                                   functools.partial(cifar10_test_set, FLAGS.data_dir, FLAGS.normalization),
+                                   n_classes)
+
     # track losses
     stats = defaultdict(list)
 
-    # Image augmentation
-    if FLAGS.data_augmentation:
-        img_generator = tf.keras.preprocessing.image.ImageDataGenerator(
-            rotation_range=10,
-            width_shift_range=0.10,
-            height_shift_range=0.10,
-            shear_range=0.1,
-            zoom_range=0.1,
-            fill_mode='nearest',
-            data_format='channels_last')
-
-        cifar10_augmented = img_generator.flow(x=cifar10.train.images, y=cifar10.train.labels, batch_size=batch_size)
-
     # loop over steps
     for _step in range(FLAGS.max_steps):
 
         # get batch of data
-        if FLAGS.data_augmentation:
-            inputs, labels = cifar10_augmented.next()
-        else:
-            inputs, labels = cifar10.train.next_batch(batch_size)
+        inputs, labels = train_data.next_batch(batch_size)
 
         # feed to model
         train_feed = {X: inputs, y: labels, net.batch_norm: FLAGS.batch_norm, net.training_mode: True}
@@ -186,8 +223,12 @@ def train():
             print('\n\n==> WARNING: training loss is NaN\n\n')
             break
 
-        # eval on test set every 100 steps
-        if _step % FLAGS.eval_freq == 0:
+        # eval on test set every eval_freq steps
+        if evaluator is not None:
+            if _step % FLAGS.eval_freq == 0:
+                evaluator.publish(_step, session)
+            stats = _record_eval_results(evaluator.poll(), stats, test_log_writer)
+        elif _step % FLAGS.eval_freq == 0:
             X_test, y_test = cifar10.test.images, cifar10.test.labels
             test_feed = {X: X_test, y: y_test, net.batch_norm: FLAGS.batch_norm, net.training_mode: False}
             test_loss, test_accuracy, test_confusion_matrix, test_summary = session.run(
@@ -202,6 +243,14 @@ def train():
         if _step % FLAGS.checkpoint_freq == 0:
             saver.save(session, save_path=os.path.join(FLAGS.checkpoint_dir, 'model.ckpt'))
 
+    if evaluator is not None:
+        stats = _record_eval_results(evaluator.poll(wait=True), stats, test_log_writer)
+        evaluator.close()
+
+    if isinstance(train_data, Prefetcher):
+        train_data.close()
+        print(train_data.summary())
+
     # save model
     train_log_writer.close()
     test_log_writer.close()
@@ -265,8 +314,13 @@ if __name__ == '__main__':
                         help='Frequency of evaluation on the test set')
     parser.add_argument('--checkpoint_freq', type=int, default=CHECKPOINT_FREQ_DEFAULT,
                         help='Frequency with which the model state is saved.')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                        help='Number of training batches prepared ahead on a background thread, 0 to disable')
     parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
                         help='Directory for storing input data')
+    parser.add_argument('--normalization', type=str, default=NORMALIZATION_DEFAULT,
+                        choices=cifar10_utils.NORMALIZATIONS,
+                        help='Input normalization [mean, pixel, channel], see cifar10_utils.ImageStats')
     parser.add_argument('--log_dir', type=str, default=LOG_DIR_DEFAULT,
                         help='Summaries log directory')
     parser.add_argument('--checkpoint_dir', type=str, default=CHECKPOINT_DIR_DEFAULT,
@@ -279,10 +333,18 @@ if __name__ == '__main__':
                         help='gradient clipping to [-1.,1.]')
     parser.add_argument('--data_augmentation', action='store_true',
                         help='Performs data augmentation')
+    parser.add_argument('--augmentation_workers', type=int, default=AUGMENTATION_WORKERS_DEFAULT,
+                        help='Number of worker processes for data augmentation, 0 to augment on the prefetch thread')
+    parser.add_argument('--augmentation_padding', type=int, default=AUGMENTATION_PADDING_DEFAULT,
+                        help='Padding of the random crops of data augmentation, 0 to disable cropping')
+    parser.add_argument('--augmentation_flip', action='store_true',
+                        help='Randomly flip images horizontally during data augmentation')
     parser.add_argument('--batch_norm', action='store_true',
                         help='Performs batch normalization')
     parser.add_argument('--dropout_rate', type=float, default=0.0,
                         help='Dropout rate')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Evaluate weight snapshots on the test set in a separate process while training')
     FLAGS, unparsed = parser.parse_known_args()
 
     tf.app.run()
@@ -0,0 +1,172 @@
+"""
+This module implements hyperparameter sweeps of the NumPy MLP, training all configurations
+of a grid in one batched pass over the data.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import itertools
+import os
+
+import numpy as np
+
+import cifar10_utils
+from ensemble_numpy import MLPEnsemble
+from input_pipeline import Prefetcher
+from optimizers_numpy import OPTIMIZER_DICT
+
+# Default constants
+LEARNING_RATES_DEFAULT = '2e-3'
+WEIGHT_REGULARIZER_STRENGTHS_DEFAULT = '0.'
+WEIGHT_INITIALIZATION_SCALES_DEFAULT = '1e-4'
+BATCH_SIZE_DEFAULT = 200
+MAX_STEPS_DEFAULT = 1500
+EVAL_FREQ_DEFAULT = 50
+EVAL_BATCH_SIZE_DEFAULT = 1000
+DNN_HIDDEN_UNITS_DEFAULT = '100'
+OPTIMIZER_DEFAULT = 'sgd'
+PREFETCH_DEFAULT = 0
+NORMALIZATION_DEFAULT = 'mean'
+
+# Directory in which cifar data is saved
+DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
+SAVE_PATH_DEFAULT = './trained_models/'
+
+FLAGS = None
+
+
+def _parse_floats(string):
+    return [float(value) for value in string.split(',')]
+
+
+def train():
+    """
+    Trains one MLP per combination of learning rate, weight initialization scale and
+    weight regularization strength, and evaluates all of them on the test set every
+    eval_freq steps. The model with the best final test accuracy is saved.
+    """
+    np.random.seed(42)
+
+    if FLAGS.dnn_hidden_units:
+        dnn_hidden_units = [int(units) for units in FLAGS.dnn_hidden_units.split(',')]
+    else:
+        dnn_hidden_units = []
+
+    # dataset
+    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir, one_hot=False, normalization=FLAGS.normalization)
+
+    grid = list(itertools.product(_parse_floats(FLAGS.learning_rates),
+                                  _parse_floats(FLAGS.weight_init_scales),
+                                  _parse_floats(FLAGS.weight_reg_strengths)))
+    learning_rates, weight_scales, weight_decays = [np.array(values) for values in zip(*grid)]
+    batch_size = FLAGS.batch_size
+
+    ensemble = MLPEnsemble(n_hidden=dnn_hidden_units, n_classes=10, weight_decays=weight_decays,
+                           weight_scales=weight_scales, learning_rates=learning_rates,
+                           input_dim=3 * 32 * 32, dtype=np.float32)
+    print(ensemble)
+
+    optimizer = OPTIMIZER_DICT[FLAGS.optimizer](learning_rate=ensemble.learning_rates.reshape(-1, 1, 1))
+    train_flags = {'optimizer': optimizer}
+
+    def print_table(losses, accuracies):
+        print('\t\t{:>10} {:>12} {:>12} {:>10} {:>10}'.format('lr', 'init_scale', 'reg', 'loss', 'accuracy'))
+        for (lr, scale, reg), loss, accuracy in zip(grid, losses, accuracies):
+            print('\t\t{:>10.2e} {:>12.2e} {:>12.2e} {:>10.4f} {:>10.4f}'.format(lr, scale, reg, loss, accuracy))
+
+    train_data = cifar10.train
+    if FLAGS.prefetch > 0:
+        train_data = Prefetcher(cifar10.train, batch_size, capacity=FLAGS.prefetch, reuse_buffers=True)
+
+    for _step in range(FLAGS.max_steps):
+        X_train, y_train = train_data.next_batch(batch_size)
+        train_losses, train_accuracies = ensemble.train_batch(np.reshape(X_train, (batch_size, -1)), y_train,
+                                                              train_flags)
+
+        print('Ep.{}: best train_loss:{:.4f}, best train_accuracy:{:.4f}'.format(_step, train_losses.min(),
+                                                                                 train_accuracies.max()))
+
+        # the final weights are evaluated after the loop
+        if _step % FLAGS.eval_freq == 0 and _step < FLAGS.max_steps - 1:
+            test_losses, test_accuracies = ensemble.evaluate(cifar10.test.images, cifar10.test.labels,
+                                                             batch_size=FLAGS.eval_batch_size)
+            print_table(test_losses, test_accuracies)
+
+    if FLAGS.prefetch > 0:
+        train_data.close()
+        print(train_data.summary())
+
+    # save the best model on the test set, also if max_steps is 0
+    test_losses, test_accuracies = ensemble.evaluate(cifar10.test.images, cifar10.test.labels,
+                                                     batch_size=FLAGS.eval_batch_size)
+    print_table(test_losses, test_accuracies)
+    best = int(np.argmax(test_accuracies))
+    print('Best configuration: learning_rate={}, weight_init_scale={}, weight_reg_strength={}'.format(*grid[best]))
+    if not os.path.exists(FLAGS.save_path):
+        os.makedirs(FLAGS.save_path)
+    model_path = os.path.join(FLAGS.save_path, FLAGS.model_name)
+    ensemble.model(best).save(model_path)
+    cifar10.train.save_normalization(model_path + cifar10_utils.NORMALIZATION_SUFFIX)
+    print('Done training.')
+
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+
+def main():
+    """
+    Main function
+    """
+    # Print all Flags to confirm parameter settings
+    print_flags()
+
+    if not os.path.exists(FLAGS.data_dir):
+        os.makedirs(FLAGS.data_dir)
+
+    # Run the training operation
+    train()
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dnn_hidden_units', type=str, default=DNN_HIDDEN_UNITS_DEFAULT,
+                        help='Comma separated list of number of units in each hidden layer')
+    parser.add_argument('--learning_rates', type=str, default=LEARNING_RATES_DEFAULT,
+                        help='Comma separated list of learning rates')
+    parser.add_argument('--weight_init_scales', type=str, default=WEIGHT_INITIALIZATION_SCALES_DEFAULT,
+                        help='Comma separated list of weight initialization scales (std of a Gaussian).')
+    parser.add_argument('--weight_reg_strengths', type=str, default=WEIGHT_REGULARIZER_STRENGTHS_DEFAULT,
+                        help='Comma separated list of regularizer strengths for weights of fully-connected layers.')
+    parser.add_argument('--optimizer', type=str, default=OPTIMIZER_DEFAULT,
+                        choices=['sgd', 'momentum', 'nesterov', 'adam'],
+                        help='Optimizer to use [sgd, momentum, nesterov, adam].')
+    parser.add_argument('--max_steps', type=int, default=MAX_STEPS_DEFAULT,
+                        help='Number of steps to run trainer.')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
+                        help='Batch size to run trainer.')
+    parser.add_argument('--eval_freq', type=int, default=EVAL_FREQ_DEFAULT,
+                        help='Frequency of evaluation on the test set')
+    parser.add_argument('--eval_batch_size', type=int, default=EVAL_BATCH_SIZE_DEFAULT,
+                        help='Number of test datapoints per forward pass during evaluation.')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                        help='Number of training batches prepared ahead on a background thread, 0 to disable')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
+                        help='Directory for storing input data')
+    parser.add_argument('--normalization', type=str, default=NORMALIZATION_DEFAULT,
+                        choices=cifar10_utils.NORMALIZATIONS,
+                        help='Input normalization [mean, pixel, channel], see cifar10_utils.ImageStats')
+    parser.add_argument('--save_path', type=str, default=SAVE_PATH_DEFAULT,
+                        help='save path directory')
+    parser.add_argument('--model_name', type=str, default='mlp_numpy_sweep_best',
+                        help='model_name')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
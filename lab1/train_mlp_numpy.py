@@ -6,10 +6,17 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
 import numpy as np
 import os
 import cifar10_utils
-from mlp_numpy import MLP
+from mlp_numpy import MLP, DEFAULT_STATS_THRESHOLDS, LAYOUTS
+from training_stats import StatsCollector
+from optimizers_numpy import OPTIMIZER_DICT
+from data_parallel_numpy import DataParallelTrainer
+from input_pipeline import Prefetcher
+from async_eval import AsyncEvaluator, MLPSnapshotModel, cifar10_test_set
+from pruning_numpy import magnitude_prune, update_sparse_execution, SPARSE_DENSITY_THRESHOLD_DEFAULT
 
 # Default constants
 LEARNING_RATE_DEFAULT = 2e-3
@@ -18,9 +25,18 @@ WEIGHT_INITIALIZATION_SCALE_DEFAULT = 1e-4
 BATCH_SIZE_DEFAULT = 200
 MAX_STEPS_DEFAULT = 1500
 DNN_HIDDEN_UNITS_DEFAULT = '100'
+OPTIMIZER_DEFAULT = 'sgd'
+MOMENTUM_DEFAULT = 0.9
+EVAL_BATCH_SIZE_DEFAULT = 1000
+STATS_INTERVAL_DEFAULT = 1
+STATS_CAPACITY_DEFAULT = 10000
+LAYOUT_DEFAULT = 'dim_first'
+PREFETCH_DEFAULT = 0
+NORMALIZATION_DEFAULT = 'mean'
 
 # Directory in which cifar data is saved
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
+SAVE_PATH_DEFAULT = './trained_models/'
 
 FLAGS = None
 
@@ -46,7 +62,8 @@ def train():
     #######################
 
     # dataset
-    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir)
+    cifar10 = cifar10_utils.get_cifar10(data_dir=FLAGS.data_dir, one_hot=not FLAGS.sparse_labels,
+                                        normalization=FLAGS.normalization)
 
     learning_rate = FLAGS.learning_rate
     weight_init_scale = FLAGS.weight_init_scale
@@ -55,51 +72,111 @@ def train():
     n_classes = 10
     input_dim = 3 * 32 * 32
 
-    net = MLP(n_hidden=dnn_hidden_units, n_classes=n_classes, input_dim=input_dim, weight_decay=weight_reg_strength,
-              weight_scale=weight_init_scale)
+    dtype = np.float32 if FLAGS.workspace else np.float64
+
+    # diagnostics (norms, NaN checks) are sampled every stats_interval steps, 0 disables all stats
+    diagnostics = ['*_norm', 'logits_nonfinite']
+    stats = StatsCollector(enabled=FLAGS.stats_interval > 0,
+                           intervals={pattern: FLAGS.stats_interval for pattern in diagnostics},
+                           capacity=FLAGS.stats_capacity, sink=FLAGS.stats_dir,
+                           thresholds=DEFAULT_STATS_THRESHOLDS)
+
+    mlp_kwargs = dict(n_hidden=dnn_hidden_units, n_classes=n_classes, input_dim=input_dim,
+                      weight_decay=weight_reg_strength, weight_scale=weight_init_scale, dtype=dtype,
+                      workspace=FLAGS.workspace, stats=stats, layout=FLAGS.layout)
+
+    # both provide train_batch, the data-parallel trainer updates the weights of trainer.net
+    if FLAGS.n_workers > 0:
+        trainer = DataParallelTrainer(FLAGS.n_workers, batch_size, **mlp_kwargs)
+        net = trainer.net
+    else:
+        net = trainer = MLP(**mlp_kwargs)
     print(net)
 
+    if FLAGS.optimizer in ['momentum', 'nesterov']:
+        optimizer = OPTIMIZER_DICT[FLAGS.optimizer](learning_rate=learning_rate, momentum=FLAGS.momentum)
+    else:
+        optimizer = OPTIMIZER_DICT[FLAGS.optimizer](learning_rate=learning_rate)
+
+    train_flags = {'learning_rate': learning_rate, 'batch_size': batch_size, 'optimizer': optimizer,
+                   'max_grad_norm': FLAGS.max_grad_norm, 'micro_batch_size': FLAGS.micro_batch_size}
+
+    # batches are consumed before the next one is requested, so the prefetcher can reuse its buffers
+    train_data = cifar10.train
+    if FLAGS.prefetch > 0:
+        train_data = Prefetcher(cifar10.train, batch_size, capacity=FLAGS.prefetch, reuse_buffers=True, stats=stats)
+
+    # test set evaluation of weight snapshots in a separate process, results are recorded in the stats
+    evaluator = None
+    if FLAGS.async_eval:
+        evaluator = AsyncEvaluator(MLPSnapshotModel(net, batch_size=FLAGS.eval_batch_size),
+                                   functools.partial(cifar10_test_set, FLAGS.data_dir, FLAGS.normalization),
+                                   n_classes, batch_size=FLAGS.eval_batch_size, stats=stats)
+
     for _step in range(FLAGS.max_steps):
 
         net.training_mode = True
 
-        X_train, y_train = cifar10.train.next_batch(batch_size)
-        X_train = np.reshape(X_train, (batch_size, -1))
+        # one-shot magnitude pruning, the remaining steps fine-tune the unpruned weights
+        if FLAGS.prune_sparsity > 0 and _step == FLAGS.prune_step:
+            layer_densities = magnitude_prune(net, FLAGS.prune_sparsity, scope=FLAGS.prune_scope)
+            sparse_layers = update_sparse_execution(net, threshold=FLAGS.sparse_threshold)
+            print('==> Pruned to densities {}, sparse layers {}'.format(layer_densities, sparse_layers))
 
-        # Feed forward
-        logits_train = net.inference(X_train)
+        X_train, y_train = train_data.next_batch(batch_size)
+        X_train = np.reshape(X_train, (batch_size, -1))
 
-        # Obtain loss and accuracy
-        train_loss = net.loss(logits_train, y_train)
-        train_accuracy = net.accuracy(logits_train, y_train)
+        # Feed forward, loss and accuracy, then update (accumulated over micro-batches if set)
+        train_loss, train_accuracy = trainer.train_batch(X_train, y_train, train_flags)
 
         print('Ep.{}: train_loss:{:.4f}, train_accuracy:{:.4f}'.format(_step, train_loss, train_accuracy))
 
-        train_flags = {'learning_rate': learning_rate, 'batch_size': batch_size}
-        net.train_step(loss=train_loss, flags=train_flags)
-
-        if _step % 50 == 0:
-            net.training_mode = False
+        if evaluator is not None:
+            if _step % 50 == 0:
+                evaluator.publish(_step, net)
+            _print_eval_results(evaluator.poll())
+        elif _step % 50 == 0:
             X_test, y_test = cifar10.test.images, cifar10.test.labels
-            X_test = np.reshape(X_test, [X_test.shape[0], -1])
-
-            # Feed forward
-            logits_test = net.inference(X_test)
 
-            # Obtain loss and accuracy
-            test_loss = net.loss(logits_test, y_test)
-            test_accuracy = net.accuracy(logits_test, y_test)
+            # Chunked feed forward, no backprop caches
+            test_loss, test_accuracy = net.evaluate(X_test, y_test, batch_size=FLAGS.eval_batch_size)
 
             print('\t\ttest_loss:{:.4f}, test_accuracy:{:.4f}'.format(test_loss, test_accuracy))
 
+    if evaluator is not None:
+        _print_eval_results(evaluator.poll(wait=True))
+        print('==> {} snapshots evaluated, {} skipped while the evaluator was busy'.format(
+            evaluator.n_published, evaluator.n_skipped))
+        evaluator.close()
+
+    # save model: flat parameters (.npy), architecture (.json) and input normalization
+    if not os.path.exists(FLAGS.save_path):
+        os.makedirs(FLAGS.save_path)
+    model_path = os.path.join(FLAGS.save_path, FLAGS.model_name)
+    net.save(model_path)
+    cifar10.train.save_normalization(model_path + cifar10_utils.NORMALIZATION_SUFFIX)
+
     # Print stats
-    # net.plot_stats()
+    net.stats.flush()
+    if FLAGS.n_workers > 0:
+        trainer.close()
+    if FLAGS.prefetch > 0:
+        train_data.close()
+        print(train_data.summary())
+    if FLAGS.plot_stats:
+        net.plot_stats()
     print('Done training.')
     ########################
     # END OF YOUR CODE    #
     #######################
 
 
+def _print_eval_results(results):
+    for result in results:
+        print('\t\tstep {}: test_nl_likelihood:{:.4f}, test_accuracy:{:.4f} ({:.2f} s)'.format(
+            result['step'], result['loss'], result['accuracy'], result['eval_time']))
+
+
 def print_flags():
     """
     Prints all entries in FLAGS variable.
@@ -133,12 +210,62 @@ if __name__ == '__main__':
                         help='Number of steps to run trainer.')
     parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
                         help='Batch size to run trainer.')
+    parser.add_argument('--eval_batch_size', type=int, default=EVAL_BATCH_SIZE_DEFAULT,
+                        help='Number of test datapoints per forward pass during evaluation.')
+    parser.add_argument('--micro_batch_size', type=int, default=0,
+                        help='Accumulate gradients over micro-batches of this size, 0 uses the whole batch.')
+    parser.add_argument('--n_workers', type=int, default=0,
+                        help='Number of data-parallel worker processes, 0 trains in this process.')
     parser.add_argument('--weight_init_scale', type=float, default=WEIGHT_INITIALIZATION_SCALE_DEFAULT,
                         help='Weight initialization scale (e.g. std of a Gaussian).')
     parser.add_argument('--weight_reg_strength', type=float, default=WEIGHT_REGULARIZER_STRENGTH_DEFAULT,
                         help='Regularizer strength for weights of fully-connected layers.')
+    parser.add_argument('--optimizer', type=str, default=OPTIMIZER_DEFAULT,
+                        choices=['sgd', 'momentum', 'nesterov', 'adam'],
+                        help='Optimizer to use [sgd, momentum, nesterov, adam].')
+    parser.add_argument('--momentum', type=float, default=MOMENTUM_DEFAULT,
+                        help='Momentum of the momentum and nesterov optimizers.')
+    parser.add_argument('--max_grad_norm', type=float, default=0.,
+                        help='Clip the global gradient norm to this value, 0 disables clipping.')
+    parser.add_argument('--prune_sparsity', type=float, default=0.,
+                        help='Fraction of weights to prune by magnitude, 0 disables pruning.')
+    parser.add_argument('--prune_step', type=int, default=0,
+                        help='Step at which the weights are pruned.')
+    parser.add_argument('--prune_scope', type=str, default='global', choices=['global', 'layer'],
+                        help='Rank weights over all layers or prune each layer on its own.')
+    parser.add_argument('--sparse_threshold', type=float, default=SPARSE_DENSITY_THRESHOLD_DEFAULT,
+                        help='Layers below this density run their forward pass as a sparse product.')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                        help='Number of training batches prepared ahead on a background thread, 0 to disable')
     parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
                         help='Directory for storing input data')
+    parser.add_argument('--normalization', type=str, default=NORMALIZATION_DEFAULT,
+                        choices=cifar10_utils.NORMALIZATIONS,
+                        help='Input normalization [mean, pixel, channel], see cifar10_utils.ImageStats')
+
+    # Custom args
+    parser.add_argument('--workspace', action='store_true',
+                        help='Reuse preallocated float32 buffers across steps')
+    parser.add_argument('--layout', type=str, default=LAYOUT_DEFAULT, choices=LAYOUTS,
+                        help='Memory layout of activations and weights [dim_first, batch_major]')
+    parser.add_argument('--sparse_labels', action='store_true',
+                        help='Use integer class labels instead of one-hot vectors')
+    parser.add_argument('--stats_interval', type=int, default=STATS_INTERVAL_DEFAULT,
+                        help='Sample gradient/activation diagnostics every n steps, 0 disables stats')
+    parser.add_argument('--stats_capacity', type=int, default=STATS_CAPACITY_DEFAULT,
+                        help='Number of samples kept in memory per metric')
+    parser.add_argument('--stats_dir', type=str, default=None,
+                        help='Directory the stats are flushed to')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Evaluate weight snapshots on the test set in a separate process while training')
+    parser.add_argument('--plot_stats', action='store_true',
+                        help='Plot the stats to ./figs after training, imports matplotlib')
+    parser.add_argument('--save_path', type=str, default=SAVE_PATH_DEFAULT,
+                        help='save path directory')
+    parser.add_argument('--model_name', type=str, default='mlp_numpy',
+                        help='model_name')
     FLAGS, unparsed = parser.parse_known_args()
+    if FLAGS.n_workers > 0 and FLAGS.micro_batch_size:
+        parser.error('--micro_batch_size is not supported with data-parallel --n_workers')
 
     main()
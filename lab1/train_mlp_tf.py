@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
 import tensorflow as tf
 import numpy as np
 import os
@@ -13,6 +14,8 @@ import json
 
 from mlp_tf import MLP
 import cifar10_utils
+from input_pipeline import Prefetcher
+from async_eval import AsyncEvaluator, TFSnapshotModel, cifar10_test_set, tf_snapshot_variables, tf_summary
 from util import Args
 from collections import defaultdict
 import pickle
@@ -29,6 +32,8 @@ WEIGHT_INITIALIZATION_DEFAULT = 'normal'
 WEIGHT_REGULARIZER_DEFAULT = 'l2'
 ACTIVATION_DEFAULT = 'relu'
 OPTIMIZER_DEFAULT = 'sgd'
+PREFETCH_DEFAULT = 0
+NORMALIZATION_DEFAULT = 'mean'
 
 # Directory in which cifar data is saved
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
@@ -115,6 +120,38 @@ def _update_stats(stats, train_loss=None, train_accuracy=None, test_loss=None, t
     return stats
 
 
+def _record_eval_results(results, stats, log_writer=None):
+    """
+    Collects and prints the results of the asynchronous evaluation, the loss is the mean cross entropy
+    """
+    for result in results:
+        stats = _update_stats(stats, test_loss=result['loss'], test_accuracy=result['accuracy'],
+                              test_confusion_matrix=result['confusion_matrix'])
+        if log_writer is not None:
+            log_writer.add_summary(tf_summary(result), result['step'])
+        print('==> Ep.{}: test_nl_likelihood:{:+.4f}, test_accuracy:{:+.4f}'.format(
+            result['step'], result['loss'], result['accuracy']))
+        print('==> Confusion Matrix on test set \n {} \n'.format(result['confusion_matrix']))
+
+    return stats
+
+
+def _build_eval_model(flags):
+    """
+    Builds the inference graph of the MLP in the evaluator process of --async_eval,
+    see async_eval.TFSnapshotModel.
+    """
+    activation_fn, dropout_rate, weight_initializer, weight_regularizer, n_classes = _parse_flags(flags)[:5]
+    dnn_hidden_units = [int(units) for units in flags.dnn_hidden_units.split(',')] if flags.dnn_hidden_units else []
+
+    X = tf.placeholder(dtype=tf.float32, shape=[None, 3 * 32 * 32], name='inputs')
+    net = MLP(n_hidden=dnn_hidden_units, n_classes=n_classes, is_training=False,
+              activation_fn=activation_fn, dropout_rate=dropout_rate,
+              weight_initializer=weight_initializer,
+              weight_regularizer=weight_regularizer)
+    return X, net.inference(X), {net.training_mode: False}
+
+
 def _ensure_path_exists(path):
     if not tf.gfile.Exists(path):
         tf.gfile.MakeDirs(path)
@@ -149,7 +186,10 @@ def train():
         FLAGS)
 
     # dataset
-    cifar10 = cifar10_utils.get_cifar10(data_dir=data_dir)
+    cifar10 = cifar10_utils.get_cifar10(data_dir=data_dir, normalization=FLAGS.normalization)
+    train_data = cifar10.train
+    if FLAGS.prefetch > 0:
+        train_data = Prefetcher(cifar10.train, batch_size, capacity=FLAGS.prefetch, reuse_buffers=True)
 
     # Session
     tf.reset_default_graph()
@@ -194,6 +234,12 @@ def train():
     local_init_op = tf.local_variables_initializer()
     session.run(fetches=[init_op, local_init_op])
 
+    # test set evaluation of weight snapshots in a separate process, on the CPU
+    evaluator = None
+    if FLAGS.async_eval:
+        evaluator = AsyncEvaluator(TFSnapshotModel(tf_snapshot_variables(), _build_eval_model, (FLAGS,)),
+                                   functools.partial(cifar10_test_set, data_dir, FLAGS.normalization), n_classes)
+
     # track losses
     stats = defaultdict(list)
 
@@ -201,7 +247,7 @@ def train():
     for _step in range(FLAGS.max_steps):
 
         # get batch of data
-        X_train, y_train = cifar10.train.next_batch(batch_size)
+        X_train, y_train = train_data.next_batch(batch_size)
         X_train = np.reshape(X_train, (batch_size, -1))
         # feed to model
         train_feed = {X: X_train, y: y_train, net.training_mode: True}
@@ -225,7 +271,14 @@ def train():
             break
 
         # Test set evaluation
-        if (_step + 1) % 100 == 0:
+        if evaluator is not None:
+            if (_step + 1) % 100 == 0:
+                evaluator.publish(_step, session)
+            results = evaluator.poll()
+            stats = _record_eval_results(results, stats, test_log_writer if write_logs else None)
+            if results:
+                test_accuracy = results[-1]['accuracy']
+        elif (_step + 1) % 100 == 0:
             X_test, y_test = cifar10.test.images, cifar10.test.labels
             X_test = np.reshape(X_test, [X_test.shape[0], -1])
             test_feed = {X: X_test, y: y_test, net.training_mode: False}
@@ -257,6 +310,14 @@ def train():
                     '\n==> EARLY STOPPING with accuracy {} and moving-window mean accuracy {} \n'.format(test_accuracy,
                                                                                                          window_accuracy))
 
+    if evaluator is not None:
+        stats = _record_eval_results(evaluator.poll(wait=True), stats, test_log_writer if write_logs else None)
+        evaluator.close()
+
+    if FLAGS.prefetch > 0:
+        train_data.close()
+        print(train_data.summary())
+
     # save model
     if write_logs:
         train_log_writer.close()
@@ -334,8 +395,13 @@ if __name__ == '__main__':
     parser.add_argument('--optimizer', type=str, default=OPTIMIZER_DEFAULT,
                         choices=['sgd', 'adadelta', 'adagrad', 'adam', 'rmsprop'],
                         help='Optimizer to use [sgd, adadelta, adagrad, adam, rmsprop].')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                        help='Number of training batches prepared ahead on a background thread, 0 to disable')
     parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
                         help='Directory for storing input data')
+    parser.add_argument('--normalization', type=str, default=NORMALIZATION_DEFAULT,
+                        choices=cifar10_utils.NORMALIZATIONS,
+                        help='Input normalization [mean, pixel, channel], see cifar10_utils.ImageStats')
     parser.add_argument('--log_dir', type=str, default=LOG_DIR_DEFAULT,
                         help='Summaries log directory')
 
@@ -349,6 +415,8 @@ if __name__ == '__main__':
     parser.add_argument('--train_settings_path', type=str, default=None,
                         help='Path to a file with training settings that will override the CLI args.')
     parser.add_argument('--grid_search', action='store_true')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='Evaluate weight snapshots on the test set in a separate process while training')
 
     FLAGS, unparsed = parser.parse_known_args()
 
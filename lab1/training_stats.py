@@ -0,0 +1,180 @@
+"""
+This module implements a bounded, sampled collector for training statistics.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fnmatch
+import os
+
+import numpy as np
+
+
+class StatsCollector(object):
+    """
+    Collects scalar metrics into a fixed-size ring buffer per metric.
+
+    Each metric is sampled every `interval` calls, where intervals are looked up by
+    glob pattern (e.g. {'*_norm': 10}). Values can be passed as callables, which are
+    only evaluated when the metric is sampled, so expensive diagnostics cost nothing
+    on the skipped steps. When a sink directory is given, full buffers are appended
+    to `<sink>/<metric>.bin` as (step, value) float64 pairs before being overwritten.
+    """
+
+    def __init__(self,
+                 enabled=True,
+                 default_interval=1,
+                 intervals=None,
+                 capacity=10000,
+                 sink=None,
+                 thresholds=None):
+        """
+        Args:
+          enabled: if False, record() returns immediately and callables are never evaluated.
+          default_interval: sampling interval of metrics without a matching pattern.
+          intervals: dict of glob pattern -> sampling interval. The first matching pattern wins.
+          capacity: number of samples kept in memory per metric.
+          sink: optional directory the samples are flushed to.
+          thresholds: dict of glob pattern -> value above which a warning is printed.
+        """
+        self.enabled = enabled
+        self.default_interval = default_interval
+        self.intervals = intervals or {}
+        self.capacity = capacity
+        self.sink = sink
+        self.thresholds = thresholds or {}
+
+        # x-coordinate stored with each sample, advanced by the owner
+        self.step = 0
+
+        self._calls = {}
+        self._steps = {}
+        self._values = {}
+        self._count = {}
+        self._flushed = {}
+        self._interval_cache = {}
+
+        if self.sink is not None and not os.path.exists(self.sink):
+            os.makedirs(self.sink)
+
+    def record(self, name, value, step=None):
+        """
+        Records a sample of a metric if it is due.
+
+        :param name: metric name
+        :param value: scalar, or a callable returning a scalar
+        :param step: step of the sample, defaults to self.step. E.g. the step of the weights
+                     an asynchronous evaluation ran on.
+        :return: the recorded value, None if the metric was not sampled
+        """
+        if not self.enabled:
+            return None
+
+        calls = self._calls.get(name, 0)
+        self._calls[name] = calls + 1
+        if calls % self._interval(name):
+            return None
+
+        if callable(value):
+            value = value()
+        value = float(value)
+
+        if name not in self._values:
+            self._steps[name] = np.empty(self.capacity, dtype=np.int64)
+            self._values[name] = np.empty(self.capacity, dtype=np.float64)
+            self._count[name] = 0
+            self._flushed[name] = 0
+
+        count = self._count[name]
+        if self.sink is not None and count - self._flushed[name] == self.capacity:
+            self._flush_metric(name)
+
+        step = self.step if step is None else step
+        self._steps[name][count % self.capacity] = step
+        self._values[name][count % self.capacity] = value
+        self._count[name] = count + 1
+
+        threshold = self._lookup(self.thresholds, name)
+        if threshold is not None and value > threshold:
+            print('WARNING: {} = {:.4f} at step {} exceeds {}'.format(name, value, step, threshold))
+
+        return value
+
+    def get(self, name):
+        """
+        Returns the samples of a metric in chronological order. With a sink, this
+        includes everything flushed to disk, otherwise only the last `capacity` samples.
+
+        :return: steps, values as 1D arrays
+        """
+        if self.sink is not None:
+            self.flush()
+            return load_stats(self.sink, names=[name]).get(name, (np.empty(0, np.int64), np.empty(0)))
+
+        if name not in self._values:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        count = self._count[name]
+        order = np.arange(max(0, count - self.capacity), count) % self.capacity
+        return self._steps[name][order], self._values[name][order]
+
+    def names(self):
+        return sorted(self._values.keys())
+
+    def flush(self):
+        """
+        Appends all samples not yet written to the sink. No-op without a sink.
+        """
+        if self.sink is None:
+            return
+        for name in self._values:
+            self._flush_metric(name)
+
+    def _flush_metric(self, name):
+        count, flushed = self._count[name], self._flushed[name]
+        if count == flushed:
+            return
+
+        order = np.arange(flushed, count) % self.capacity
+        samples = np.empty((len(order), 2), dtype=np.float64)
+        samples[:, 0] = self._steps[name][order]
+        samples[:, 1] = self._values[name][order]
+
+        with open(os.path.join(self.sink, name + '.bin'), 'ab') as f:
+            samples.tofile(f)
+        self._flushed[name] = count
+
+    def _interval(self, name):
+        if name not in self._interval_cache:
+            interval = self._lookup(self.intervals, name)
+            self._interval_cache[name] = max(1, self.default_interval if interval is None else interval)
+        return self._interval_cache[name]
+
+    @staticmethod
+    def _lookup(patterns, name):
+        for pattern, value in patterns.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                return value
+        return None
+
+
+def load_stats(path, names=None):
+    """
+    Reads metrics flushed by a StatsCollector.
+
+    :param path: sink directory
+    :param names: optional list of metric names, defaults to all metrics in the directory
+    :return: dict of name -> (steps, values)
+    """
+    if names is None:
+        names = [f[:-len('.bin')] for f in os.listdir(path) if f.endswith('.bin')]
+
+    stats = {}
+    for name in names:
+        filename = os.path.join(path, name + '.bin')
+        if not os.path.exists(filename):
+            continue
+        samples = np.fromfile(filename, dtype=np.float64).reshape(-1, 2)
+        stats[name] = samples[:, 0].astype(np.int64), samples[:, 1]
+    return stats